@@ -0,0 +1,420 @@
+"""benchmark: measure librarian log ingestion, query answering and round trips
+
+Writes synthetic imagehub event logs, seeded from real imagehub logs, into a
+temporary directory and measures:
+    1. HubData cold load time of all the event log files
+    2. Tail follow latency: time from appending lines to the current log until
+       HubData has loaded them
+    3. Memory used by HubData event_data per stored event
+    4. ChatBot.respond_to throughput
+    5. CLI channel round trip time over ZMQ, the same path as CLI_chat.py
+    6. SMS round trip time and throughput through a fake Gmail service:
+       SMS query -> Gmail.gmail_watcher -> ZMQ -> gmail channel -> ChatBot
+       -> gmail channel reply -> Gmail drafts.send
+    7. HubData load time with the dated logs read from columnar archives,
+       and the time to archive them
+    8. History query time: one hour of one node event from the dated logs,
+       read through memory maps and sparse indexes (HubData.fetch_history)
+
+Results are saved as JSON. Saving a results file for each librarian version
+and comparing them with --compare makes performance regressions visible:
+    python benchmark.py --output benchmark-0.1.1.json
+    python benchmark.py --compare benchmark-0.1.1.json
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import json
+import math
+import logging
+import argparse
+import platform
+import statistics
+import tempfile
+import threading
+import tracemalloc
+from time import perf_counter, sleep, time
+from pathlib import Path
+from datetime import datetime, timedelta
+from __version__ import __version__
+from helpers.loadgen import LogGenerator
+from helpers.data_tools import HubData
+from helpers.comms.chatbot import ChatBot
+
+class BenchmarkSettings:
+    """ The few settings used by HubData, CommChannel and Gmail, without a
+    yaml file
+
+    Parameters:
+        log_directory (str): directory of the synthetic imagehub event logs
+        log_check_interval (float): seconds between checks for new log lines
+        lib_dir (str): librarian data directory, holding gmail contacts
+    """
+    def __init__(self, log_directory, log_check_interval, lib_dir):
+        self.log_directory = log_directory
+        self.log_check_interval = log_check_interval
+        self.lib_dir = Path(lib_dir)
+        self.patience = 10
+        self.log_archive = False
+        self.retention = None
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format='%(asctime)s ~ %(message)s', level=logging.WARNING)
+    generator = LogGenerator(args.seed_logs, seed=args.seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as log_dir:
+        log_file = generator.write_logs(log_dir, args.days, args.lines_per_day)
+        settings = BenchmarkSettings(log_dir, args.log_check_interval, log_dir)
+        results['memory'] = bench_memory(settings)
+        hub, results['cold_load'] = bench_cold_load(settings)
+        results['archive_load'] = bench_archive_load(settings, hub)
+        results['tail_follow'] = bench_tail_follow(hub, generator, log_file,
+            args.tail_rounds, args.tail_lines)
+        results['respond_to'] = bench_respond_to(hub, generator, args.queries)
+        results['history'] = bench_history(hub, generator, args.days,
+                                           args.history_queries)
+        results['summary'] = bench_summary(hub, generator, args.days,
+                                           args.history_queries)
+        results['cli_round_trip'] = bench_cli_round_trip(hub, settings,
+            generator, args.round_trips, args.cli_port)
+        results['sms_round_trip'] = bench_sms_round_trip(hub, settings,
+            generator, args)
+        hub.close()  # stop saving tiers before the directory is removed
+    report = {
+        'librarian_version': __version__,
+        'python_version': platform.python_version(),
+        'machine': platform.machine(),
+        'node': platform.node(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'parameters': vars(args),
+        'results': results,
+    }
+    print(json.dumps(results, indent=2))
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Saved results to', args.output)
+    if args.compare:
+        compare(args.compare, report)
+
+def bench_memory(settings):
+    """ measure memory retained by a loaded HubData, per stored event value
+    """
+    tracemalloc.start()
+    hub = HubData(settings)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    hub.close()
+    values = hub.values_count()
+    return {
+        'stored_values': values,
+        'series': hub.series_count(),
+        'retained_bytes': retained,
+        'peak_bytes': peak,
+        'bytes_per_value': round(retained / values, 1) if values else None,
+        'estimated_bytes_per_value':  # the librarian_event_data_bytes gauge
+            round(hub.event_data_bytes() / values, 1) if values else None,
+    }
+
+def bench_cold_load(settings):
+    """ time a HubData load of all the event log files
+    """
+    start = perf_counter()
+    hub = HubData(settings)
+    seconds = perf_counter() - start
+    return hub, {
+        'lines_read': hub.line_count,
+        'seconds': round(seconds, 4),
+        'lines_per_second': round(hub.line_count / seconds),
+    }
+
+def bench_archive_load(settings, text_hub):
+    """ time archiving the dated logs, then a HubData load from the archives
+    """
+    from helpers.log_archive import convert_directory
+    with tempfile.TemporaryDirectory() as lib_dir:  # not in the log directory
+        archive_settings = BenchmarkSettings(settings.log_directory,
+            settings.log_check_interval, lib_dir)
+        archive_settings.log_archive = True
+        archive_dir = Path(lib_dir) / 'log_archive'
+        archive_dir.mkdir()
+        start = perf_counter()
+        archived = convert_directory(settings.log_directory, archive_dir,
+            Path(text_hub.log_file).name, HubData.parse_log_line)
+        convert_seconds = perf_counter() - start
+        log_bytes = sum(path.stat().st_size for path in archived)
+        archive_bytes = sum(path.stat().st_size for path in archive_dir.iterdir())
+        start = perf_counter()
+        hub = HubData(archive_settings)
+        seconds = perf_counter() - start
+        hub.close()  # stop saving tiers before lib_dir is removed
+    return {
+        'logs_archived': len(archived),
+        'convert_seconds': round(convert_seconds, 4),
+        'archive_to_log_size': round(archive_bytes / max(1, log_bytes), 3),
+        'seconds': round(seconds, 4),
+        'same_event_data': hub.event_data == text_hub.event_data,
+    }
+
+def bench_tail_follow(hub, generator, log_file, rounds, n_lines):
+    """ time from appending lines to the current log until HubData loads them
+    """
+    latencies = []
+    for _ in range(rounds):
+        newest = generator.append_lines(log_file, n_lines)[-1][:30]
+        start = perf_counter()
+        while hub.newest_log_line[:30] != newest:
+            if perf_counter() - start > 60:
+                return {'error': 'appended lines not loaded within 60 seconds'}
+            sleep(0.001)
+        latencies.append(perf_counter() - start)
+    return summarize(latencies, {'log_check_interval': hub.log_check_interval,
+                                 'lines_per_round': n_lines})
+
+def bench_respond_to(hub, generator, n_queries):
+    """ time ChatBot.respond_to over a mix of typical queries
+    """
+    chatbot = ChatBot(hub)
+    latencies = []
+    for query in generator.queries(n_queries):
+        start = perf_counter()
+        chatbot.respond_to(query)
+        latencies.append(perf_counter() - start)
+    return summarize(latencies, {'queries_per_second':
+                                 round(len(latencies) / sum(latencies))})
+
+def bench_history(hub, generator, days, n_queries):
+    """ time HubData.fetch_history for one hour ranges in the dated logs
+    """
+    now = datetime.now()
+    latencies = []
+    values = 0
+    for _ in range(n_queries):
+        node, event = generator.random.choice(generator.series)
+        start = now - timedelta(hours=generator.random.uniform(1, days * 24))
+        t = perf_counter()
+        values += len(hub.fetch_history(node, event, start,
+                                        start + timedelta(hours=1)))
+        latencies.append(perf_counter() - t)
+    return summarize(latencies, {
+        'values_per_query': round(values / max(1, n_queries), 1),
+        'bytes_decoded_per_query': round(hub.history.bytes_read.value /
+                                         max(1, n_queries))})
+
+def bench_summary(hub, generator, days, n_queries):
+    """ time HubData.fetch_summary of all the days of numeric series, hourly
+    """
+    now = datetime.now()
+    series = sorted(hub.tiers)
+    if not series:
+        return {'skipped': 'no numeric series'}
+    latencies = []
+    buckets = 0
+    for _ in range(n_queries):
+        node, event = generator.random.choice(series)
+        t = perf_counter()
+        buckets += len(hub.fetch_summary(node, event, now - timedelta(days=days),
+                                         now, timedelta(hours=1))[1])
+        latencies.append(perf_counter() - t)
+    return summarize(latencies, {
+        'buckets_per_query': round(buckets / max(1, n_queries), 1),
+        'tier_bytes': hub.tier_bytes()})
+
+def bench_cli_round_trip(hub, settings, generator, n_queries, port):
+    """ time queries sent as CLI_chat.py sends them, through the CLI channel
+    """
+    try:
+        from helpers.comms.communications import CommChannel
+        from helpers.comms.CLI_chat import QuerySender
+    except ImportError as ex:
+        return {'skipped': str(ex)}
+    channel = CommChannel(settings, 'CLI', {'port': port})
+    chatbot = ChatBot(hub)
+
+    def answer_queries():  # what the librarian.py main loop does
+        while True:
+            query = channel.query_q.get(block=True)
+            channel.send_reply(chatbot.respond_to(query))
+
+    t = threading.Thread(target=answer_queries)
+    t.daemon = True  # allows this thread to be auto-killed on program exit
+    t.name = 'Benchmark Responder'  # naming the thread helps with debugging
+    t.start()
+    sender = QuerySender(connect_to='tcp://127.0.0.1:' + str(port))
+    latencies = []
+    try:
+        for query in generator.queries(n_queries):
+            start = perf_counter()
+            sender.send_query(query)
+            latencies.append(perf_counter() - start)
+    finally:
+        sender.close()
+        channel.close()
+    return summarize(latencies, {})
+
+def bench_sms_round_trip(hub, settings, generator, args):
+    """ replay SMS queries through gmail_watcher and the gmail channel
+
+    Both Gmail instances, the one in gmail_watcher.py and the one in the
+    librarian gmail channel, use the same FakeGmailService mailbox. Queries
+    are added to the mailbox as SMS messages at --sms-rate per second; a
+    reply is complete when its draft is sent.
+    """
+    if not args.sms_queries:
+        return {'skipped': '--sms-queries is 0'}
+    try:
+        from helpers.comms.communications import CommChannel
+        from helpers.comms.gmail import Gmail
+        from helpers.comms.fake_gmail import FakeGmailService
+    except ImportError as ex:
+        return {'skipped': str(ex)}
+    phone = '8885551212'
+    for gmail_dir in ('gmail', 'gmail2'):  # librarian and gmail_watcher dirs
+        contacts_dir = settings.lib_dir / gmail_dir
+        contacts_dir.mkdir(exist_ok=True)
+        with open(contacts_dir / 'contacts.txt', 'w') as f:
+            f.write('name|full_name|canonical_name|mobile_phone|email\n')
+            f.write('Bench|Bench Mark|bench_mark|' + phone + '|bench@example.com\n')
+    service = FakeGmailService(latency=args.gmail_latency,
+                               error_rate=args.gmail_error_rate)
+    details = {'port': args.gmail_port,
+               'mail_check_seconds': args.mail_check_seconds}
+    channel = CommChannel(settings, 'Gmail', details, gmail_service=service)
+    watcher = Gmail(settings, details, service=service)
+    chatbot = ChatBot(hub)
+    failures = {'watcher_restarts': 0, 'reply_errors': 0}
+
+    def watch_gmail():  # what gmail_watcher.py does; systemd restarts it
+        while True:
+            try:
+                watcher.gmail_watcher(watcher.gmail, watcher.historyId,
+                    watcher.mail_check_seconds, watcher.phones_OK_list,
+                    watcher.emails_OK_list)
+            except Exception:
+                failures['watcher_restarts'] += 1
+
+    def answer_queries():  # what the librarian.py main loop does
+        while True:
+            query = channel.query_q.get(block=True)
+            try:
+                channel.send_reply(chatbot.respond_to(query))
+            except Exception:
+                failures['reply_errors'] += 1
+
+    for name, target in (('Benchmark Gmail Watcher', watch_gmail),
+                         ('Benchmark Responder', answer_queries)):
+        t = threading.Thread(target=target)
+        t.daemon = True  # allows this thread to be auto-killed on program exit
+        t.name = name  # naming the thread helps with debugging
+        t.start()
+    added = {}  # thread id -> time SMS was added to the mailbox
+    start = time()
+    for n, query in enumerate(generator.queries(args.sms_queries)):
+        if args.sms_rate:  # pace the queries at sms_rate per second
+            sleep(max(0, start + n / args.sms_rate - time()))
+        msg_id, thread_id = service.add_SMS(phone, query)
+        added[thread_id] = time()
+    all_sent = service.wait_for_sent(args.sms_queries, args.sms_timeout)
+    channel.close()
+    watcher.q_s.close()
+    latencies = [sent - added[thread_id]
+                 for sent, thread_id, text in service.sent if thread_id in added]
+    if not latencies:
+        return {'error': 'no replies sent within ' + str(args.sms_timeout) +
+                ' seconds', 'api_calls': service.calls}
+    replies = len(latencies)
+    summary = summarize(latencies, {
+        'queries': args.sms_queries,
+        'unanswered': args.sms_queries - replies,
+        'replies_per_second': round(replies / (max(s[0] for s in
+            service.sent) - start), 2),
+        'mail_check_seconds': args.mail_check_seconds,
+        'api_calls': service.calls,
+        'api_errors': service.errors,
+    })
+    summary.update(failures)
+    if not all_sent:
+        summary['timed_out'] = True
+    return summary
+
+def summarize(seconds, extra):
+    """ return count, mean, median, 95th percentile and max in milliseconds
+    """
+    ms = sorted(s * 1000 for s in seconds)
+    summary = {
+        'count': len(ms),
+        'mean_ms': round(statistics.mean(ms), 4),
+        'median_ms': round(statistics.median(ms), 4),
+        'p95_ms': round(ms[math.ceil(0.95 * len(ms)) - 1], 4),  # nearest rank
+        'max_ms': round(ms[-1], 4),
+    }
+    summary.update(extra)
+    return summary
+
+def compare(old_file, report):
+    """ print each numeric result next to the same result from an older run
+    """
+    with open(old_file) as f:
+        old = json.load(f)
+    print('Compared to librarian', old.get('librarian_version'), 'on',
+          old.get('date'), 'from', old_file + ':')
+    for bench, results in report['results'].items():
+        old_results = old['results'].get(bench, {})
+        for name, value in results.items():
+            old_value = old_results.get(name, None)
+            if not isinstance(value, (int, float)) or not old_value:
+                continue
+            change = 100 * (value - old_value) / old_value
+            print('  {:<16} {:<26} {:>12} {:>12} {:>+8.1f}%'.format(
+                bench, name, old_value, value, change))
+
+def parse_args():
+    default_seed_logs = Path(__file__).resolve().parent.parent.joinpath(
+        'test-data', 'imagehub_data', 'logs')
+    parser = argparse.ArgumentParser(description='benchmark librarian log '
+        'ingestion, query answering and CLI channel round trips')
+    parser.add_argument('--seed-logs', default=str(default_seed_logs),
+        help='directory of real imagehub event logs to imitate')
+    parser.add_argument('--days', type=int, default=3,
+        help='number of daily rotated logs to generate')
+    parser.add_argument('--lines-per-day', type=int, default=10000,
+        help='event log lines per day of generated logs')
+    parser.add_argument('--log-check-interval', type=float, default=2,
+        help='seconds between HubData checks for new log lines')
+    parser.add_argument('--tail-rounds', type=int, default=5,
+        help='number of appends to time for tail follow latency')
+    parser.add_argument('--tail-lines', type=int, default=20,
+        help='lines appended to the current log in each round')
+    parser.add_argument('--queries', type=int, default=10000,
+        help='number of queries to time for respond_to throughput')
+    parser.add_argument('--history-queries', type=int, default=200,
+        help='number of one hour history queries of the dated logs')
+    parser.add_argument('--round-trips', type=int, default=200,
+        help='number of CLI queries to time over ZMQ')
+    parser.add_argument('--cli-port', type=int, default=5599,
+        help='local port for the CLI round trip benchmark')
+    parser.add_argument('--sms-queries', type=int, default=1000,
+        help='number of SMS queries to replay through a fake Gmail; 0 for none')
+    parser.add_argument('--sms-rate', type=float, default=50,
+        help='SMS queries added to the fake mailbox per second; 0 for all at once')
+    parser.add_argument('--sms-timeout', type=float, default=300,
+        help='seconds to wait for all SMS replies')
+    parser.add_argument('--gmail-latency', type=float, default=0.0,
+        help='seconds each fake Gmail API request takes')
+    parser.add_argument('--gmail-error-rate', type=float, default=0.0,
+        help='fraction of fake Gmail API requests that raise an error')
+    parser.add_argument('--mail-check-seconds', type=float, default=0.1,
+        help='seconds between gmail_watcher mailbox history checks')
+    parser.add_argument('--gmail-port', type=int, default=5598,
+        help='local port for the gmail channel in the SMS benchmark')
+    parser.add_argument('--seed', type=int, default=0,
+        help='random number seed for generated logs and queries')
+    parser.add_argument('--output', default='benchmark-results.json',
+        help='JSON file to save results in')
+    parser.add_argument('--compare', metavar='JSON_FILE',
+        help='results file of an earlier run to compare against')
+    return parser.parse_args()
+
+if __name__ == '__main__' :
+    main()
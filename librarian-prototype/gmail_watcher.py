@@ -38,6 +38,8 @@ def main():
         settings = Settings()  # get settings for communications channels
         details = settings.comm_channels.get('gmail', {})
         gmail = Gmail(settings, details)
+        # reload contacts and mail_check_seconds when SIGHUP received
+        signal.signal(signal.SIGHUP, lambda *args: reload_settings(gmail))
         gmail.gmail_watcher(gmail.gmail, gmail.historyId,
                             gmail.mail_check_seconds, gmail.phones_OK_list,
                             gmail.emails_OK_list)
@@ -51,6 +53,18 @@ def main():
         log.info('Exiting gmail_watcher.py')
         sys.exit()
 
+def reload_settings(gmail):
+    """ reload librarian.yaml and refresh the gmail contacts and intervals
+    """
+    log = logging.getLogger()
+    try:
+        settings = Settings()
+        gmail.refresh_settings(settings, settings.comm_channels.get('gmail', {}))
+    except Exception:
+        log.exception('Reload of librarian.yaml failed; no changes made.')
+    else:
+        log.warning('Reloaded gmail settings from librarian.yaml')
+
 def start_logging():
     log = logging.getLogger()
     handler = logging.handlers.RotatingFileHandler('gmail_watcher.log',
@@ -0,0 +1,216 @@
+"""alerts: rules that watch the imagehub event stream and send alert messages
+
+Provides the AlertRules class which holds alert rules from the alerts section
+of the librarian.yaml file. Each rule is checked as new event log lines are
+added to HubData. When a rule matches, an alert message is sent via the
+Gmail SMS interface.
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import logging
+import threading
+from queue import Queue, Full
+from datetime import datetime, timedelta
+from helpers.utils import interval_timer, YamlOptionsError
+
+log = logging.getLogger(__name__)
+
+class AlertRule:
+    """ A single alert rule from the alerts section of the yaml file
+
+    Rules are of 3 kinds, depending on which options are given in the yaml
+    file. Every rule has a node and an event; the other options are:
+        value: match only events with this value, e.g. moving
+        above / below: match only numeric values above or below a limit
+        between: match only events in a time of day window ['23:00', '05:00']
+        minutes: match only when value has persisted for this many minutes
+
+    Parameters:
+        name (str): name of the rule from the yaml file
+        specs (dict): rule options from the yaml file
+    """
+    def __init__(self, name, specs):
+        self.name = name
+        try:
+            self.node_name = specs['node']
+            self.event_name = specs['event']
+        except KeyError:
+            raise YamlOptionsError('Alert ' + name + ' needs a node and event.')
+        self.node = self.node_name.strip().lower()
+        self.event = self.event_name.strip().lower()
+        value = specs.get('value', None)
+        self.value = str(value).strip().lower() if value is not None else None
+        self.above = specs.get('above', None)
+        self.below = specs.get('below', None)
+        between = specs.get('between', None)
+        if between:  # between is a list of 2 times like ['23:00', '05:00']
+            self.between = [datetime.strptime(t, '%H:%M').time() for t in between]
+        else:
+            self.between = None
+        minutes = specs.get('minutes', None)
+        self.duration = timedelta(minutes=minutes) if minutes else None
+        self.repeat = timedelta(minutes=specs.get('repeat_minutes', 60))
+        self.phone = str(specs.get('phone', ''))
+        self.message = specs.get('message', '')
+        if not self.message:
+            self.message = ' '.join([self.node_name, self.event_name, 'alert'])
+        self.last_sent = None  # datetime of last alert sent for debouncing
+        self.armed_since = None  # datetime a 'minutes' rule started matching
+
+    def matches(self, when, value):
+        """ check whether an event value matches this rule (ignores duration)
+
+        Parameters:
+            when (datetime): datetime of the event
+            value (str): event value, stripped and lower case
+
+        Returns:
+            True if the event matches the rule; False if not
+        """
+        if self.value is not None and value != self.value:
+            return False
+        if self.above is not None or self.below is not None:
+            try:
+                number = float(value)
+            except ValueError:
+                return False
+            if self.above is not None and not number > self.above:
+                return False
+            if self.below is not None and not number < self.below:
+                return False
+        if self.between:
+            start, end = self.between
+            t = when.time()
+            if start <= end:
+                if not start <= t <= end:
+                    return False
+            elif end < t < start:  # window wraps around midnight
+                return False
+        return True
+
+    def debounced(self, now):
+        """ return True if an alert for this rule was sent too recently
+        """
+        return self.last_sent is not None and now - self.last_sent < self.repeat
+
+class AlertRules:
+    """ Methods and attributes to check alert rules against new events
+
+    Rules are indexed by (node, event) so each new event is checked only
+    against the rules that apply to it. Matching alerts are debounced and put
+    into a queue; a sender thread sends them via gmail_send_SMS so that a slow
+    Gmail send does not hold up the reading of new event log lines. Events are
+    checked as soon as HubData is loaded; alerts wait in the queue until the
+    Gmail channel, which can take a while to start, is ready.
+
+    Parameters:
+        settings (Settings object): settings object created from YAML file
+        wait_for_gmail (function): blocks until the Gmail channel is ready and
+            returns its Gmail object, used to send alerts; None if no channel
+    """
+    def __init__(self, settings, wait_for_gmail):
+        self.wait_for_gmail = wait_for_gmail
+        self.gmail = None  # set by the sender thread when Gmail is ready
+        self.rules = {}  # (node, event) -> list of AlertRule
+        self.duration_rules = []  # rules that need a periodic duration check
+        self.newest = {}  # (node, event) -> datetime of newest event checked
+        self.rules_lock = threading.Lock()
+        self.load_rules(settings.alerts)
+        self.alert_q = Queue(maxsize=settings.queuemax)
+        t = threading.Thread(target=self.alert_sender)
+        t.daemon = True  # allows this thread to be auto-killed on program exit
+        t.name = 'Alert Sender'  # naming the thread helps with debugging
+        t.start()
+        self.duration_check_seconds = 60
+        t = threading.Thread(target=lambda: interval_timer(
+            self.duration_check_seconds, self.check_durations))
+        t.daemon = True
+        t.name = 'Alert Duration Checker'
+        t.start()
+
+    def load_rules(self, alerts):
+        """ build the (node, event) rule index from the yaml alerts section
+
+        Parameters:
+            alerts (dict): alert rules from the yaml file, keyed by rule name
+        """
+        rules = {}
+        duration_rules = []
+        if alerts:
+            for name, specs in alerts.items():
+                rule = AlertRule(name, specs)
+                rules.setdefault((rule.node, rule.event), []).append(rule)
+                if rule.duration:
+                    duration_rules.append(rule)
+        with self.rules_lock:
+            self.rules = rules
+            self.duration_rules = duration_rules
+
+    def check_event(self, node_tuple):
+        """ check a newly added event against the rules for its node and event
+
+        Called from the HubData thread that reads newly added log lines.
+
+        Parameters:
+            node_tuple (tuple): (node, event, when, value) from parse_log_line
+        """
+        key = (node_tuple[0].strip().lower(), node_tuple[1].strip().lower())
+        when = node_tuple[2]
+        value = node_tuple[3].strip().lower()
+        with self.rules_lock:
+            rules = self.rules.get(key, None)
+            if not rules:
+                return
+            newest = self.newest.get(key, None)
+            if newest and when <= newest:  # already checked this event
+                return
+            self.newest[key] = when
+            for rule in rules:
+                if rule.duration:  # arm or disarm; check_durations sends it
+                    if rule.matches(when, value):
+                        if rule.armed_since is None:
+                            rule.armed_since = when
+                    else:
+                        rule.armed_since = None
+                elif rule.matches(when, value):
+                    self.send_alert(rule, when)
+
+    def check_durations(self):
+        """ send alerts for 'minutes' rules that have matched long enough
+        """
+        now = datetime.now()
+        with self.rules_lock:
+            for rule in self.duration_rules:
+                if rule.armed_since and now - rule.armed_since >= rule.duration:
+                    self.send_alert(rule, now)
+
+    def send_alert(self, rule, now):
+        """ queue an alert message unless the rule was alerted recently
+
+        Parameters:
+            rule (AlertRule): the rule that matched
+            now (datetime): datetime of the match
+        """
+        if rule.debounced(now):
+            return
+        rule.last_sent = now
+        log.warning('Alert ' + rule.name + ': ' + rule.message)
+        try:
+            self.alert_q.put((rule.phone, rule.message), block=False)
+        except Full:
+            log.error('Alert queue full; dropped alert ' + rule.name)
+
+    def alert_sender(self):
+        """ alert_sender: thread to send queued alerts via Gmail SMS
+        """
+        self.gmail = self.wait_for_gmail()  # alerts are queued until then
+        while True:
+            phone, message = self.alert_q.get(block=True)
+            if self.gmail is None or not phone:
+                continue  # no way to send it; alert was already logged
+            try:
+                self.gmail.gmail_send_SMS(phone, message)
+            except Exception:
+                log.exception('Error sending alert via gmail_send_SMS')
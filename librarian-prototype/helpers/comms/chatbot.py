@@ -14,9 +14,10 @@ import pprint
 import logging
 import threading
 from time import sleep
-from datetime import datetime
+from datetime import datetime, timedelta
 from collections import deque
-from ..data_tools import HubData
+from ..data_tools import HubData, Detection
+from helpers.tracing import tracer
 
 class Conversation:
     """ Methods and attributes that track conversations by (channel, person)
@@ -35,11 +36,32 @@ class ChatBot:
     Parameters:
         imagehubs (dict): dictionary of all known imagehubs
         memories (dict): pandas data series, one per imagedode per data type
+        detections (DetectionStore): detected objects, or None if not set up
+        event_images (EventImages): images of motion events, or None
+        previews (PreviewCache): small JPEGs of motion bursts, or None
+        loading (set): names of the stores above that are still loading, e.g.
+            {'detections'}; each is set later by attach()
 
     """
-    def __init__(self, data=None):
+    def __init__(self, data=None, detections=None, event_images=None,
+                 previews=None, loading=()):
         self.data = data
+        self.detections = detections
+        self.event_images = event_images
+        self.previews = previews
+        self.loading = set(loading)
 
+    def attach(self, **stores):
+        """ set stores that have finished loading, e.g. detections=store
+
+        Queries about a store that is still loading are answered with a
+        "still loading" reply until it is attached.
+        """
+        for name, store in stores.items():
+            setattr(self, name, store)
+            self.loading.discard(name)
+
+    @tracer.traced('ChatBot.respond_to')
     def respond_to(self, request_str):
         """ Composes and returns a response to a request.
 
@@ -120,8 +142,15 @@ class ChatBot:
         #   so append reports to a compound sentence.
         if intents['water']:
             sentences.append(self.report_water())
-        # This simple test only reports temperature, nothing else
-        if intents['location']:  # at least one location was explicitly named
+        # This simple test only reports images, detected objects or temperature
+        if intents['images']:  # images of the latest motion at a node
+            sentences.append(self.report_images(intents['images']))
+        elif intents['seen']:  # detected objects, e.g. coyote or mail truck
+            sentences.append(self.report_seen(intents['seen'], intents['period']))
+        elif intents['loading']:  # e.g. asked for images before they are indexed
+            sentences.append('Still loading {0}; ask again in a minute.'.format(
+                ' and '.join(sorted(intents['loading']))))
+        elif intents['location']:  # at least one location was explicitly named
             sentences.append(self.report_temperature(intents['location']))
         elif intents['temperature']:
             intents['location'].add('barn')
@@ -159,6 +188,7 @@ class ChatBot:
         punctuation_pattern = ' |\.$|\. |, |\/|\(|\)|\'|\"|\!|\?|\+'
         ltext = request.lower()
         list_of_words = [w for w in re.split(punctuation_pattern, ltext) if w]
+        seen_labels, label_words = self.find_labels(list_of_words)
         list_of_words = self.remove_stopwords(list_of_words)
         request_words = set(list_of_words)
         water_words = {'water', 'flow', 'flowing', 'watering', 'meter'}
@@ -186,6 +216,38 @@ class ChatBot:
         intents['location'] = set(request_words & location_words)
         intents['location_helpers'] = set(request_words & location_helpers)
         intents['unknown'] = request_words.difference(known_words)
+        # detected object labels, e.g. "coyotes this week?"
+        seen_words = {'seen', 'see', 'saw', 'spotted', 'detected', 'last', 'any'}
+        period_words = ['today', 'yesterday', 'night', 'tonight', 'week', 'month']
+        intents['seen'] = seen_labels
+        intents['period'] = None
+        image_words = {'picture', 'pictures', 'image', 'images', 'photo',
+                       'photos', 'pic', 'pics', 'frames'}
+        intents['images'] = set(request_words & image_words)
+        intents['loading'] = set()  # stores the request needs; still loading
+        if intents['images'] and 'event_images' in self.loading:
+            intents['loading'].add('images')
+            intents['unknown'] = set()
+        if intents['images'] and self.event_images is not None:
+            intents['images'] = set()  # replaced by names of matching nodes
+            for node in self.event_images.catalog.nodes():
+                if request_words & set(node.split()):
+                    intents['images'].add(node)
+            if not intents['images']:
+                intents['images'] = {''}  # asked for images; node unknown
+            intents['unknown'] = set()
+        else:
+            intents['images'] = set()
+        if (request_words & {'seen', 'saw', 'spotted', 'detected'} and
+                'detections' in self.loading):
+            intents['loading'].add('detected objects')
+            intents['unknown'] = set()
+        if seen_labels:
+            intents['unknown'] -= label_words | seen_words | set(period_words)
+            for word in period_words:
+                if word in request_words:
+                    intents['period'] = word
+                    break
         # intents['open'] = set(request_words & open_words)
         # intents['light'] = set(request_words & light_words)
         # intents['motion'] = set(request_words & motion_words)
@@ -203,6 +265,35 @@ class ChatBot:
         # print('type(intents["water"]):', type(intents['water']))
         return intents
 
+    def find_labels(self, words):
+        """ find detected object labels, like 'coyote' or 'mail truck', in words
+
+        Labels of more than one word match consecutive words. The last word
+        may be plural, so 'coyotes' matches the label 'coyote'.
+
+        Parameters:
+          words (list): words of the request, lower case, in order
+
+        Returns:
+          labels (set): labels found
+          label_words (set): the request words that matched labels
+        """
+        labels = set()
+        label_words = set()
+        if self.detections is None:
+            return labels, label_words
+        for label in self.detections.labels():
+            lwords = label.split()
+            n = len(lwords)
+            last = lwords[-1]
+            for i in range(len(words) - n + 1):
+                window = words[i:i + n]
+                if (window[:-1] == lwords[:-1] and
+                        window[-1] in (last, last + 's', last + 'es')):
+                    labels.add(label)
+                    label_words.update(window)
+        return labels, label_words
+
     def cleanup_intents(self, intents):
         # Do simple minded cleanup of some specific words & word combinations.
         # Also replace synonyms with "canonical names" for things.
@@ -250,6 +341,102 @@ class ChatBot:
             reply = 'Water is {0}; last status unknown'.format(status_now)
         return reply
 
+    def report_images(self, nodes):
+        """ report the images of the latest motion event (or latest image)
+
+        Parameters:
+          nodes (set): normalized node names; '' if no node was named
+
+        Returns:
+          reply (str): a sentence for each node, citing its image files; a
+            motion burst is cited by its preview, if there is a PreviewCache
+        """
+        now = datetime.now()
+        sentences = []
+        for node in sorted(nodes):
+            if not node:
+                nodes = self.event_images.catalog.nodes()
+                sentences.append('Images from which camera? I have images ' +
+                    'from ' + ', '.join(sorted(nodes)) + '.')
+                continue
+            burst = self.event_images.latest_burst(node)
+            if burst is None:  # no motion events; report its latest image
+                image = self.event_images.catalog.latest(node)
+                detection = Detection(image.when, node, None, None, '', None)
+                sentences.append('Latest image {0}: {1}.'.format(
+                    self.seen_text(detection, now), image.path.rsplit('/', 1)[-1]))
+                continue
+            count = len(burst.images)
+            detection = Detection(burst.when, node, None, None, '', None)
+            preview = None
+            if self.previews is not None:
+                preview = self.previews.burst_preview(burst)
+            if preview is not None:
+                cited = 'preview ' + str(preview)
+            else:
+                first = burst.images[0].rsplit('/', 1)[-1]
+                cited = ('first ' if count > 1 else '') + first
+            sentences.append('Motion {0}: {1} image{2}, {3}.'.format(
+                self.seen_text(detection, now), count,
+                's' if count > 1 else '', cited))
+        return ' '.join(sentences)
+
+    def report_seen(self, labels, period):
+        """ report when detected objects were seen, e.g. coyotes this week
+
+        Parameters:
+          labels (set): detected object labels (each a str)
+          period (str): 'today', 'yesterday', 'night', 'tonight', 'week',
+                        'month' or None for the last time seen
+
+        Returns:
+          reply (str): a sentence for each label
+        """
+        now = datetime.now()
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        periods = {  # period word -> (start, end, description)
+            'today': (midnight, now, 'today'),
+            'yesterday': (midnight - timedelta(days=1), midnight, 'yesterday'),
+            'night': (midnight - timedelta(hours=6),
+                      midnight + timedelta(hours=7), 'last night'),
+            'tonight': (midnight + timedelta(hours=18), now, 'tonight'),
+            'week': (now - timedelta(days=7), now, 'this week'),
+            'month': (now - timedelta(days=30), now, 'this month'),
+        }
+        sentences = []
+        for label in sorted(labels):
+            name = label.capitalize()
+            if period:
+                start, end, description = periods[period]
+                seen = self.detections.seen_between(label, start, end)
+                if seen:
+                    times = 'once' if len(seen) == 1 else str(len(seen)) + ' times'
+                    sentences.append('{0} seen {1} {2}, last {3}.'.format(
+                        name, times, description, self.seen_text(seen[-1], now)))
+                else:
+                    sentences.append('No {0} seen {1}.'.format(label, description))
+            else:
+                last = self.detections.last_seen(label)
+                if last:
+                    sentences.append('{0} last seen {1}.'.format(
+                        name, self.seen_text(last, now)))
+                else:
+                    sentences.append('{0} has not been seen.'.format(name))
+        return ' '.join(sentences)
+
+    def seen_text(self, detection, now):
+        """ describe when and where a detection was, e.g. 'at 9:05 PM at barn'
+        """
+        when = detection.when
+        time_str = when.strftime('%I:%M %p').lstrip('0')
+        if when.date() == now.date():
+            day = ' today'
+        elif (now.date() - when.date()).days == 1:
+            day = ' yesterday'
+        else:
+            day = ' on {0}/{1}'.format(when.month, when.day)
+        return 'at {0}{1} at {2}'.format(time_str, day, detection.node)
+
     def report_temperature(self, locations):
         """ report temperature by location
 
@@ -16,9 +16,11 @@ import threading
 from time import sleep
 from pathlib import Path
 from collections import namedtuple
-from helpers.comms.gmail import Gmail
 from imagezmq import ImageHub, ImageSender
 from queue import Queue, Empty, Full
+from helpers.utils import YamlOptionsError, heartbeats
+from helpers.metrics import metrics
+from helpers.tracing import tracer
 from collections import deque
 
 logger = logging.getLogger(__name__)
@@ -29,6 +31,9 @@ class QueryReceiver(ImageHub):
     def receive_query(self):
         query, buf = self.recv_jpg()
         return query  # may return buf (binary buffer) in further development
+    def query_waiting(self, timeout):
+        # True if a query arrives within timeout seconds
+        return bool(self.zmq_socket.poll(int(timeout * 1000)))
 
 class CommChannel:
     """ Methods and attributes for a communications channel
@@ -59,20 +64,28 @@ class CommChannel:
                        Example channels include gmail and CLI, but can also
                        include audio
         details (dict): Channel options & details specificed for this channel
+        gmail_service (object): Gmail API service for the gmail channel to use
+            instead of building one from credentials, e.g. FakeGmailService
 
     """
-    def __init__(self, settings, comm_channel, details):
+    def __init__(self, settings, comm_channel, details, gmail_service=None):
         # print('channel, details', channel)
         # pprint.pprint(details)
         self.query_q = None  # replaced with a specific queue by channel setup
+        self.stopping = threading.Event()  # set by close to stop the receiver
+        self.poll_seconds = 0.5  # receiver checks stopping this often
+        self.channel_type = comm_channel  # key in comm_channels of yaml file
         self.reply_q = None  # ditto
         if comm_channel.lower().strip() == 'gmail':  # set up gmail
-            self.setup_gmail(settings, comm_channel, details)
+            self.setup_gmail(settings, comm_channel, details, gmail_service)
         elif comm_channel.lower().strip() == 'cli':  # command line interface
             self.setup_cli(comm_channel, details)
         else:
             raise YamlOptionsError('Unknown comm channel in yaml file.')
+        metrics.gauge('librarian_query_queue_depth', 'Queries waiting in ' +
+            'channel query_q', {'channel': self.name}, self.query_q.qsize)
 
+    @tracer.traced('CommChannel.next_query')
     def next_query(self):
         """ next_query: return the next query to Librarian
 
@@ -107,11 +120,31 @@ class CommChannel:
     def close(self):
         """ close the communications channel
 
-        This is a placeholder method. It will be replaced with a chennel
-        specific close method as each channel is initialized.
+        Stops the QueryReceiver thread before closing its ZMQ socket, since
+        closing a socket that another thread is using can abort the program.
+        """
+        self.stopping.set()
+        self.receiver.join(timeout=5 * self.poll_seconds)
+        self.q_r.close()
+
+    def refresh(self, settings):
+        """ refresh channel options from newly loaded settings
+
+        Contact lists and polling intervals are updated in place. A changed
+        port needs a librarian restart, since the ZMQ port stays bound.
 
+        Parameters:
+            settings (Settings object): settings reloaded from YAML file
         """
-        pass
+        details = settings.comm_channels.get(self.channel_type, None)
+        if details is None:
+            logger.warning('Restart librarian to remove channel ' + self.name)
+            return
+        if str(details.get('port', self.port)) != str(self.port):
+            logger.warning('Restart librarian to change port of ' + self.name)
+        if self.name == 'Gmail':
+            self.patience = settings.patience
+            self.gmail.refresh_settings(settings, details)
 
     def setup_cli(self, comm_channel, details):
         """ setup_cli: set up the "8 items" for the CLI comm channel
@@ -141,27 +174,38 @@ class CommChannel:
         t.daemon = True  # allows this thread to be auto-killed on program exit
         t.name = 'CLI QueryReceiver'  # naming the thread helps with debugging
         t.start()
+        self.receiver = t
         # next, set up send_reply function specific to CLI.
         self.reply_q = Queue(maxsize=maxsize)  # queue for ZMQ REP replies
         self.send_reply = self.CLI_send_reply  # specific CLI_send_reply method
-        # finally, set the specific close function for CLI
-        self.close = self.q_r.close
 
     def CLI_query_put(self):
         """ CLI_query_put: receive query via QueryReceiver; put into self.query_q
 
         Receives inbound CLI query from CLI_chat.py which runs as a separate
-        program. This methods runs in a Thread, loops forever and puts every
-        query received into the Librarian query_q. Waits until reply has been
-        sent (via ZMQ REP portion of REQ/REP cycle) before next receive_query.
+        program. This methods runs in a Thread, loops until the channel is
+        closed and puts every query received into the Librarian query_q. Waits
+        until reply has been sent (via ZMQ REP portion of REQ/REP cycle) before
+        next receive_query.
         """
-        while True:
-            query = self.q_r.receive_query()  # will block until CLI query recvd
+        while not self.stopping.is_set():
+            heartbeats.idle('CLI QueryReceiver')  # waiting for a query is OK
+            if not self.q_r.query_waiting(self.poll_seconds):
+                continue  # check whether the channel is being closed
+            query = self.q_r.receive_query()  # a CLI query has arrived
+            heartbeats.stamp('CLI QueryReceiver')  # query_q must have room
             self.query_q.put(query)
+            # the main loop, which has its own heartbeat, composes the reply
+            heartbeats.idle('CLI QueryReceiver')
             # Need to block here until REP has been sent in CLI_send_reply
-            self.OK = self.reply_q.get(block=True)  # wait for reply...
-            # got the OK from CLI_send_reply so can fetch the next query
-
+            while not self.stopping.is_set():
+                try:
+                    self.OK = self.reply_q.get(timeout=self.poll_seconds)
+                    break  # got the OK from CLI_send_reply; fetch next query
+                except Empty:
+                    pass
+
+    @tracer.traced('CommChannel.send_reply')
     def CLI_send_reply(self, reply):
         """ send_reply: push the CLI reply from the Librarian onto reply queue
 
@@ -179,12 +223,13 @@ class CommChannel:
         self.reply_q.put('OK')  # having sent the ZMQ REP, put OK into reply_q
         #                    so that next REQ can be fetched in CLI_query_put()
 
-    def setup_gmail(self, settings, comm_channel, details):
+    def setup_gmail(self, settings, comm_channel, details, gmail_service=None):
         """ setup_gmail: set up the "8 items" for the gmail comm channel
 
         Parameters:
             comm_channel (dict): The dictionary holding options for gmail
             details (dict): indiviual options in comm_channel
+            gmail_service (object): Gmail API service; None to build one
 
         """
 
@@ -208,30 +253,36 @@ class CommChannel:
         t.daemon = True  # allows this thread to be auto-killed on program exit
         t.name = 'Gmail QueryReceiver'  # naming the thread helps with debugging
         t.start()
+        self.receiver = t
         # Start python gmail.py to wath gmail & send inbound queries to above
         self.send_reply = self.gmail_send_reply  # set a specific gemail method
-        # finally, set the specific close function for gmail
-        self.close = self.q_r.close
-        self.gmail = self.setup_gmail_sender(settings, details)
+        self.gmail = self.setup_gmail_sender(settings, details, gmail_service)
 
     def gmail_query_put(self):
         """ gmail_query_put: receive query via QueryReceiver; put into self.query_q
 
         Receives inbound gmail query from gmail_watcher which runs as a separate
-        process. This methods runs in a Thread, loops forever and puts every
-        query received into the Librarian query_q.
+        process. This methods runs in a Thread, loops until the channel is
+        closed and puts every query received into the Librarian query_q.
         """
-        while True:
-            query = self.q_r.receive_query()  # will block until gmail query recvd
+        while not self.stopping.is_set():
+            heartbeats.idle('Gmail QueryReceiver')  # waiting for a query is OK
+            if not self.q_r.query_waiting(self.poll_seconds):
+                continue  # check whether the channel is being closed
+            query = self.q_r.receive_query()  # a gmail query has arrived
+            heartbeats.stamp('Gmail QueryReceiver')  # query_q must have room
             self.query_q.put(query)
             self.q_r.send_reply(b'OK')  # sends reply acknoledgment via ZMQ REP
 
-    def setup_gmail_sender(self, settings, details):
+    def setup_gmail_sender(self, settings, details, gmail_service=None):
         """ Instantiates a GMail instance to be used by gmail_send_reply().
 
         Parameters:
             settings (Settings object): holds the settings from the yaml file
+            gmail_service (object): Gmail API service; None to build one
         """
+        # Gmail imports the Google API packages; import only if channel is used
+        from helpers.comms.gmail import Gmail
         gmail = None
         gmail_dir = settings.lib_dir / Path('gmail')  # gmail directory
         # self.contacts = details.get('contacts', 'contacts.txt')
@@ -243,9 +294,11 @@ class CommChannel:
         # print('Emails:', *emails_OK_list)
         # print('Instantiating Gmail().')
         # print()
-        gmail = Gmail(settings, details, use_q_s=False)  # no QuerySender needed
+        gmail = Gmail(settings, details, use_q_s=False,  # no QuerySender needed
+                      service=gmail_service)
         return gmail
 
+    @tracer.traced('CommChannel.send_reply')
     def gmail_send_reply(self, reply):
         """ send reply to gmail using gmail api
 
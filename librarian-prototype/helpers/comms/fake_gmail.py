@@ -0,0 +1,250 @@
+"""fake_gmail.py: an in-process fake of the Gmail API subset used by Gmail
+
+Provides the FakeGmailService class, which stands in for the service object
+returned by googleapiclient.discovery.build('gmail', 'v1', ...). It holds a
+mailbox in memory and implements only the methods the Gmail class calls:
+    users().history().list()
+    users().messages().list(), .get(), .modify(), .send()
+    users().drafts().create(), .send()
+
+Every request can be given a latency and an error rate, so that the gmail
+channel can be tested for throughput and error handling without Google
+credentials or network access. SMS messages are added to the mailbox in the
+format that Google Voice uses, so that Gmail.get_new_messages() finds them.
+
+Example:
+    service = FakeGmailService(latency=0.05, error_rate=0.01)
+    gmail = Gmail(settings, details, service=service)
+    service.add_SMS('8885551212', 'Is the water running?')
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import base64
+import random
+import threading
+from time import time, sleep
+from email import message_from_string
+
+class FakeHttpError(Exception):
+    """ Raised by an injected error; stands in for googleapiclient HttpError
+    """
+    pass
+
+class FakeRequest:
+    """ A Gmail API request, executed by calling execute() like a real one
+    """
+    def __init__(self, service, method, function, kwargs):
+        self.service = service
+        self.method = method
+        self.function = function
+        self.kwargs = kwargs
+
+    def execute(self):
+        return self.service.execute(self.method, self.function, self.kwargs)
+
+class FakeResource:
+    """ A Gmail API resource, e.g. users().messages(), with request methods
+    """
+    def __init__(self, service, name, functions):
+        for method, function in functions.items():
+            setattr(self, method, self.request_maker(
+                service, name + '.' + method, function))
+
+    @staticmethod
+    def request_maker(service, method, function):
+        return lambda **kwargs: FakeRequest(service, method, function, kwargs)
+
+class FakeGmailService:
+    """ Methods and attributes of an in-memory Gmail mailbox and API
+
+    Parameters:
+        latency (float or dict): seconds each request takes; a dict gives
+            seconds by method name, e.g. {'drafts.send': 0.5}
+        error_rate (float or dict): fraction of requests that raise
+            FakeHttpError; a dict gives the fraction by method name
+        voice_number (str): 10 digit Google Voice number that receives SMS
+        seed (int): random number seed for error injection
+    """
+    def __init__(self, latency=0.0, error_rate=0.0,
+                 voice_number='8885550000', seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.voice_number = voice_number
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.mailbox = {}  # message id -> message dict, as messages.get returns
+        self.order = []  # message ids, newest first
+        self.changes = []  # (historyId, message id) of each mailbox change
+        self.history_id = 1000
+        self.next_id = 1
+        self.draft_bodies = {}  # draft id -> message body from drafts.create
+        self.sent = []  # (time sent, threadId, text) of each message sent
+        self.sent_event = threading.Condition(self.lock)
+        self.calls = {}  # method name -> number of requests
+        self.errors = {}  # method name -> number of injected errors
+        self.resources = {
+            'history': FakeResource(self, 'history', {'list': self.history_list}),
+            'messages': FakeResource(self, 'messages', {
+                'list': self.messages_list, 'get': self.messages_get,
+                'modify': self.messages_modify, 'send': self.messages_send}),
+            'drafts': FakeResource(self, 'drafts', {
+                'create': self.drafts_create, 'send': self.drafts_send}),
+        }
+        for n in range(4):  # gmail_start_service() needs 4 messages
+            self.add_message('Welcome to Gmail', 'Gmail Team <team@gmail.com>',
+                             'Welcome', labels=['INBOX'])
+
+    def users(self):
+        return self
+
+    def history(self):
+        return self.resources['history']
+
+    def messages(self):
+        return self.resources['messages']
+
+    def drafts(self):
+        return self.resources['drafts']
+
+    def execute(self, method, function, kwargs):
+        """ run a request, after its latency, unless an error is injected
+        """
+        latency = self.for_method(self.latency, method)
+        if latency:
+            sleep(latency)
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if self.random.random() < self.for_method(self.error_rate, method):
+                self.errors[method] = self.errors.get(method, 0) + 1
+                raise FakeHttpError('Injected error in ' + method)
+            return function(**kwargs)
+
+    @staticmethod
+    def for_method(option, method):
+        if isinstance(option, dict):
+            return option.get(method, 0)
+        return option
+
+    def add_message(self, text, from_value, subject, labels=None,
+                    thread_id=None, sms_from=None):
+        """ add a message to the mailbox, as if it had just arrived
+
+        Returns:
+            (message id, thread id) of the new message
+        """
+        with self.lock:
+            msg_id = '{:016x}'.format(self.next_id)
+            self.next_id += 1
+            thread_id = thread_id or msg_id
+            self.mailbox[msg_id] = {
+                'id': msg_id,
+                'threadId': thread_id,
+                'labelIds': labels or ['UNREAD', 'INBOX'],
+                'internalDate': str(int(time() * 1000)),
+                'snippet': text,
+                'sms_from': sms_from,  # not a Gmail field; used for searches
+                'payload': {'headers': [
+                    {'name': 'From', 'value': from_value},
+                    {'name': 'Subject', 'value': subject},
+                    {'name': 'To', 'value': 'librarian@gmail.com'}]},
+            }
+            self.order.insert(0, msg_id)
+            self.changed(msg_id)
+        return msg_id, thread_id
+
+    def add_SMS(self, phone, text):
+        """ add an unread SMS text message from phone, as Google Voice does
+
+        Parameters:
+            phone (str): 10 digit phone number of the sender
+            text (str): text of the SMS message
+
+        Returns:
+            (message id, thread id) of the new message
+        """
+        from_value = ('"(SMS) ' + phone + '" <1' + self.voice_number + '.1' +
+                      phone + '.fake@txt.voice.google.com>')
+        snippet = 'Google Voice ' + text + ' YOUR ACCOUNT HELP CENTER'
+        return self.add_message(snippet, from_value, 'SMS from ' + phone,
+                                sms_from=phone)
+
+    def changed(self, msg_id):
+        # called with self.lock held
+        self.history_id += 1
+        self.changes.append((self.history_id, msg_id))
+
+    def history_list(self, userId, startHistoryId, maxResults=100, **kwargs):
+        start = int(startHistoryId)
+        changes = [{'id': str(h), 'messages': [{'id': m}]}
+                   for h, m in self.changes if h > start][:maxResults]
+        results = {'historyId': str(self.history_id)}
+        if changes:
+            results['history'] = changes
+        return results
+
+    def messages_list(self, userId, maxResults=100, labelIds=None, q=None,
+                      includeSpamTrash=False, **kwargs):
+        found = []
+        for msg_id in self.order:
+            message = self.mailbox[msg_id]
+            if labelIds and not set(labelIds) <= set(message['labelIds']):
+                continue
+            if q and q.startswith('SMS '):  # e.g. 'SMS 888 555 1212'
+                if message['sms_from'] != ''.join(q.split()[1:]):
+                    continue
+            found.append({'id': msg_id, 'threadId': message['threadId']})
+            if len(found) >= maxResults:
+                break
+        results = {'resultSizeEstimate': len(found)}
+        if found:
+            results['messages'] = found
+        return results
+
+    def messages_get(self, userId, id, format='full', **kwargs):
+        message = dict(self.mailbox[id])
+        message['historyId'] = str(self.history_id)
+        return message
+
+    def messages_modify(self, userId, id, body, **kwargs):
+        message = self.mailbox[id]
+        labels = [label for label in message['labelIds']
+                  if label not in body.get('removeLabelIds', [])]
+        labels.extend(body.get('addLabelIds', []))
+        message['labelIds'] = labels
+        self.changed(id)
+        return {'id': id, 'threadId': message['threadId'], 'labelIds': labels}
+
+    def messages_send(self, userId, body, **kwargs):
+        self.record_sent(body)
+        return {'id': 'sent', 'threadId': body.get('threadId', '')}
+
+    def drafts_create(self, userId, body, **kwargs):
+        draft_id = 'r{:015x}'.format(self.next_id)
+        self.next_id += 1
+        self.draft_bodies[draft_id] = body['message']
+        return {'id': draft_id, 'message': {'threadId':
+                body['message'].get('threadId', '')}}
+
+    def drafts_send(self, userId, body, **kwargs):
+        message = self.draft_bodies.pop(body['id'])
+        self.record_sent(message)
+        return {'id': body['id'], 'threadId': message.get('threadId', '')}
+
+    def record_sent(self, message):
+        # called with self.lock held
+        raw = base64.urlsafe_b64decode(message['raw'].encode()).decode()
+        text = message_from_string(raw).get_payload(decode=True).decode()
+        self.sent.append((time(), message.get('threadId', ''), text))
+        self.sent_event.notify_all()
+
+    def wait_for_sent(self, n_sent, timeout):
+        """ wait until n_sent messages have been sent, or until timeout
+
+        Returns:
+            True if n_sent messages have been sent; False on timeout
+        """
+        with self.lock:
+            return self.sent_event.wait_for(
+                lambda: len(self.sent) >= n_sent, timeout)
@@ -20,20 +20,24 @@ import base64
 import pprint
 import pickle  # used for storing / reading back credentials
 import logging
-from time import sleep
+from time import sleep, perf_counter
 from pathlib import Path
 from datetime import datetime
 from collections import namedtuple
 from helpers.utils import Patience
+from helpers.metrics import metrics
+from helpers.tracing import tracer
 from multiprocessing import Process
 from email.mime.text import MIMEText
 from imagezmq import ImageHub, ImageSender
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
 
 log = logging.getLogger(__name__)
 
+# Gmail API usage limit "Quota Units" used by each API method
+QUOTA_UNITS = {'history.list': 2, 'messages.list': 5, 'messages.get': 5,
+               'messages.modify': 5, 'messages.send': 100,
+               'drafts.create': 10, 'drafts.send': 100}
+
 class QuerySender(ImageSender):
     def __init__(self, connect_to='tcp://*:5555', REQ_REP = True):
         ImageSender.__init__(self, connect_to=connect_to, REQ_REP = REQ_REP)
@@ -51,9 +55,12 @@ class Gmail:
     Parameters:
         settings (str): settings & options from libarian.yaml.
         details (dict): channel options & details specificed for Gmail channel
+        use_q_s (bool): True to send queries to the librarian via ZMQ
+        service (object): Gmail API service to use instead of building one
+            from the credentials files, e.g. a FakeGmailService for testing
 
     """
-    def __init__(self, settings, details, use_q_s=True):
+    def __init__(self, settings, details, use_q_s=True, service=None):
         # pprint.pprint(details)
         gmail_dir = settings.lib_dir / Path('gmail')  # gmail directory
         token = Path("token1.pickle")  # token1 when use_q_s=False
@@ -72,11 +79,13 @@ class Gmail:
             self.token_file = str(gmail_dir / token)
             creds = Path("credentials.json")
             self.credentials_file = str(gmail_dir / creds)
+        self.gmail_dir = gmail_dir
         contacts = self.get_contacts(gmail_dir, details)
         self.phones_OK_list = [contact.mobile_phone for contact in contacts]
         self.emails_OK_list = [contact.email for contact in contacts]
         self.mail_check_seconds = details.get('mail_check_seconds', 5)
         self.patience = settings.patience
+        self.service = service
 
         self.gmail, self.historyId = self.gmail_start_service()
 
@@ -94,12 +103,17 @@ class Gmail:
             historyId: a current historyId
 
         """
-        creds = self.get_credentials()
-        # initialize gmail service
-        gmail = build('gmail', 'v1', credentials=creds, cache_discovery=False)
+        if self.service is None:
+            # the Google API packages are only needed for the real service
+            from googleapiclient.discovery import build
+            creds = self.get_credentials()
+            # initialize gmail service
+            gmail = build('gmail', 'v1', credentials=creds, cache_discovery=False)
+        else:  # use the service passed in, e.g. a FakeGmailService
+            gmail = self.service
         # get list of messages: first step in getting a historyId
-        results = gmail.users().messages().list(userId='me',
-            maxResults=10,includeSpamTrash=False).execute()
+        results = self.execute(gmail.users().messages().list(userId='me',
+            maxResults=10,includeSpamTrash=False), 'messages.list')
         num_msgs = results.get('resultSizeEstimate', -1)
         messages = results.get('messages', [])
         if not messages:
@@ -128,8 +142,8 @@ class Gmail:
         # then message is the first message in a new thread
         # get a single message & get its historyId
         # results is a dict of all the fields of a single message; see API docs
-        results = gmail.users().messages().get(userId='me',
-            id=latestMessageId, format='minimal').execute()
+        results = self.execute(gmail.users().messages().get(userId='me',
+            id=latestMessageId, format='minimal'), 'messages.get')
         if not results:
             # print('No message retrieved')
             pass
@@ -140,6 +154,27 @@ class Gmail:
             # pprint.pprint(results)
         return gmail, historyId
 
+    def execute(self, request, method):
+        """ execute a Gmail API request, recording its latency and quota units
+
+        Parameters:
+            request (HttpRequest): Gmail API request, e.g. from messages().list()
+            method (str): API method name for metrics, e.g. 'messages.list'
+
+        Returns:
+            results of request.execute()
+        """
+        labels = {'method': method}
+        start = perf_counter()
+        try:
+            with tracer.span('Gmail.' + method):
+                return request.execute()
+        finally:
+            metrics.histogram('librarian_gmail_api_seconds',
+                'Gmail API call latency', labels).observe(perf_counter() - start)
+            metrics.counter('librarian_gmail_quota_units_total',
+                'Gmail API quota units used', labels).inc(QUOTA_UNITS.get(method, 0))
+
     def get_credentials(self):
         """Gets valid user credentials from token.pickle storage.
 
@@ -153,6 +188,8 @@ class Gmail:
         # If modifying these scopes, delete the file token.pickle.
         # Then, next get_credentials() will build new token with new SCOPES.
         SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from google.auth.transport.requests import Request
 
         creds = None
         # The file token.pickle stores the user's access and refresh tokens, and is
@@ -184,6 +221,22 @@ class Gmail:
                 pickle.dump(creds, token)
         return creds
 
+    def refresh_settings(self, settings, details):
+        """ refresh contact lists and polling interval from reloaded settings
+
+        The OK lists are updated in place, so a running gmail_watcher loop
+        sees the new contacts at its next mailbox change.
+
+        Parameters:
+            settings (Settings object): settings reloaded from YAML file
+            details (dict): channel options & details specificed for Gmail channel
+        """
+        contacts = self.get_contacts(self.gmail_dir, details)
+        self.phones_OK_list[:] = [contact.mobile_phone for contact in contacts]
+        self.emails_OK_list[:] = [contact.email for contact in contacts]
+        self.mail_check_seconds = details.get('mail_check_seconds', 5)
+        self.patience = settings.patience
+
     def gmail_watcher(self, gmail, historyId, mail_check_seconds,
                       phones_OK_list, emails_OK_list):
         # By putting historyId into a list, it becomes mutable and holds updates
@@ -193,6 +246,7 @@ class Gmail:
         while True:    # forever loop watching gmail mailbox for changes
             if self.mailbox_changed(gmail, history_list, next_page_token,
                                     mail_check_seconds):
+                mail_check_seconds = self.mail_check_seconds  # may be reloaded
                 # get new messages from gmail, but only the ones that are from
                 # senders on our OK lists; others are skipped.
                 new_messages = self.get_new_messages(gmail,
@@ -245,9 +299,14 @@ class Gmail:
         # The startHistoryId was obtained by gmail_start_service().
         # print("startHistoryId: ", startHistoryId, "is type: ", type(startHistoryId))
 
-        last_results = gmail.users().history().list(userId='me',
+        last_results = self.execute(gmail.users().history().list(userId='me',
             startHistoryId=startHistoryId,
-            maxResults=10).execute()
+            maxResults=10), 'history.list')
+        if 'history' in last_results:  # changes since startHistoryId, e.g.
+            # messages that arrived while the last batch was being handled
+            history_list[0] = last_results.get('historyId', startHistoryId)
+            next_page_token[0] = last_results.get('nextPageToken', 'emptyToken')
+            return True
         i = 0    # number of history changes checks
         num_err_results = 0
 
@@ -255,9 +314,9 @@ class Gmail:
             # Do not check history more often than mail_check_seconds
             sleep(mail_check_seconds)
             try:
-                results = gmail.users().history().list(userId='me',
+                results = self.execute(gmail.users().history().list(userId='me',
                     startHistoryId=startHistoryId,
-                    maxResults=10).execute()
+                    maxResults=10), 'history.list')
             except Exception as ex:
                 num_err_results += 1
                 log.error("Error raised in gmail.history.list() num = " + str(num_err_results))
@@ -303,9 +362,9 @@ class Gmail:
 
         '''
         # print("Fetching message list")
-        results = gmail.users().messages().list(userId='me',
+        results = self.execute(gmail.users().messages().list(userId='me',
             labelIds=['UNREAD', 'INBOX'],
-            maxResults=n).execute()
+            maxResults=n), 'messages.list')
 
         message_list = []
         if 'messages' in results:
@@ -319,8 +378,8 @@ class Gmail:
         new_messages = []
         for message in message_list:
             msg_id = message.get('id', None)
-            message = gmail.users().messages().get(userId='me',
-                id=msg_id).execute()
+            message = self.execute(gmail.users().messages().get(userId='me',
+                id=msg_id), 'messages.get')
             thread_id = message.get('threadId', None)
             labels = message.get('labelIds', None)
             message_internalDate = message['internalDate']
@@ -389,8 +448,8 @@ class Gmail:
             return
         for message in new_messages:
             msg_id = message[1]
-            gmail.users().messages().modify(userId='me',
-                id=msg_id,body={'removeLabelIds': ['UNREAD']}).execute()
+            self.execute(gmail.users().messages().modify(userId='me',
+                id=msg_id,body={'removeLabelIds': ['UNREAD']}), 'messages.modify')
 
     def gmail_send_reply(self, gmail, reply_str):
         """ gmail_send_reply: send reply from the Librarian back via gmail
@@ -425,10 +484,11 @@ class Gmail:
         raw = base64.urlsafe_b64encode(to_send.as_string().encode(encoding='UTF-8'))
         raw = raw.decode(encoding='UTF-8')  # convert back to string
         message = {'message': {'raw': raw, 'threadId': threadid}}
-        draft = gmail.users().drafts().create(userId="me", body=message).execute()
+        draft = self.execute(gmail.users().drafts().create(userId="me",
+                body=message), 'drafts.create')
         draftid = draft['id']
-        gmail.users().drafts().send(userId='me',
-                body={ 'id': draftid }).execute()
+        self.execute(gmail.users().drafts().send(userId='me',
+                body={ 'id': draftid }), 'drafts.send')
 
     def gmail_send_SMS(self, phone_number, message_text):
         """ gmail_send_SMS: send SMS text message via Gmail
@@ -460,8 +520,8 @@ class Gmail:
         # print('    first_3:', area_code)
         # print('     last_4:', area_code)
         # print('Search string for Gmail:', search)
-        results = gmail.users().messages().list(userId='me',
-            maxResults=10,includeSpamTrash=False,q=search).execute()
+        results = self.execute(gmail.users().messages().list(userId='me',
+            maxResults=10,includeSpamTrash=False,q=search), 'messages.list')
         num_msgs = results.get('resultSizeEstimate', -1)
         messages = results.get('messages', [])
         num_messages = len(messages)
@@ -473,8 +533,8 @@ class Gmail:
             latestMessageId = messages[0].get('id', None)
             latestMessageThreadId = messages[0].get('threadId', None)
             msg_id = messages[0].get('id', None)
-            message = gmail.users().messages().get(userId='me',
-                id=msg_id).execute()
+            message = self.execute(gmail.users().messages().get(userId='me',
+                id=msg_id), 'messages.get')
             thread_id = message.get('threadId', None)
             labels = message.get('labelIds', None)
             message_internalDate = message['internalDate']
@@ -8,16 +8,27 @@ Copyright (c) 2018 by Jeff Bass.
 License: MIT, see LICENSE for more details.
 """
 
+import os
 import sys
+import mmap
 import pprint
 import logging
 import threading
 import subprocess
 from time import sleep
 from pathlib import Path
-from datetime import datetime
-from collections import deque
-from helpers.utils import YamlOptionsError
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from array import array
+from collections import deque, namedtuple, Counter
+from helpers.utils import YamlOptionsError, heartbeats
+from helpers.metrics import metrics
+from helpers.tracing import tracer
+
+log = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)  # naive, like the datetimes in the event log
+NUMERIC = set('0123456789-+.')  # first characters of numeric event values
 
 class HubData:
     """ Methods and attributes to transfer data from imagehub data files
@@ -29,6 +40,9 @@ class HubData:
         settings (Settings object): settings object created from YAML file
 
     """
+    # bytes of a (datetime, value) tuple and its datetime; value is extra
+    pair_bytes = sys.getsizeof((0, 0)) + sys.getsizeof(datetime(2021, 1, 1))
+
     def __init__(self, settings):
         # log directory and log file refer to the event log of the imagehub
         ld = Path(settings.log_directory)
@@ -38,24 +52,65 @@ class HubData:
             raise YamlOptionsError('Log directory in YAML file is not a directory.')
 
         self.log_dir = ld
-        self.max_days = 3  # Number of days of hub log files to be loaded
-        self.max_history = 300  # Maximum size of the event_deque history
+        self.retention = Retention(settings.retention)  # how long series are kept
+        self.max_days = self.retention.max_days  # days of hub log files to load
         self.event_data = {}  # see description in load_log_data function
+        self.policies = {}  # (node, event) -> retention Policy of the series
+        self.series_bytes = {}  # (node, event) -> estimated bytes of its values
+        self.data_bytes = 0  # estimated bytes of all the values in event_data
+        self.tiers = {}  # (node, event) -> SeriesTiers of a numeric series
         self.newest_log_line = ''  # keep track of last text line read from log
         self.line_count = 0  # total lines read into event_data since program startup; useful for librarian status
         self.event_data_lock = threading.RLock()
+        self.event_listeners = []  # functions called with each new node_tuple
+        self.lines_read = metrics.counter('librarian_log_lines_total',
+            'Event log lines read into event_data')
+        self.parse_errors = metrics.counter('librarian_log_parse_errors_total',
+            'Event log lines without a valid datetime')
+        self.evicted = metrics.counter('librarian_event_values_evicted_total',
+            'Event values removed from event_data by retention policies')
+        metrics.gauge('librarian_event_series', 'Number of (node, event) ' +
+            'series in event_data', function=self.series_count)
+        metrics.gauge('librarian_event_values', 'Number of data values in ' +
+            'event_data', function=self.values_count)
+        metrics.gauge('librarian_event_data_bytes', 'Estimated memory used ' +
+            'by event_data', function=self.event_data_bytes)
+        metrics.gauge('librarian_tier_bytes', 'Memory used by downsampling ' +
+            'tiers of numeric series', function=self.tier_bytes)
 
+        self.archive_dir = None  # columnar archives of the dated logs
+        if settings.log_archive:
+            self.archive_dir = settings.lib_dir / 'log_archive'
+            self.archive_dir.mkdir(exist_ok=True)
+        # downsampling tiers are saved, so they outlast the logs loaded
+        self.tiers_file = settings.lib_dir / 'series_tiers.npz'
+        self.tiers_interval = 600  # seconds between saves of the tiers
+        self.stopping = threading.Event()  # set by close to stop saving tiers
+        if self.retention.downsample:
+            self.load_tiers()
         self.load_log_data(self.log_dir, self.max_days) # inital load self.event_data()
+        self.history = LogHistory(self.log_file, self.parse_log_line)  # older events
         # pprint.pprint(self.event_data)
 
         # start thread receive & add data to self.event_data as new lines are
         # added to the imagehub log.
-        self.log_check_interval = 2  # seconds: how often check for added log lines
+        self.log_check_interval = settings.log_check_interval  # seconds
+        self.archive_interval = 600  # seconds between checks for rotated logs
         t = threading.Thread(target=self.watch_for_new_log_lines)
         # print('Starting watch_for_new_log_lines thread.')
         t.daemon = True  # allows this thread to be auto-killed on program exit
         t.name = 'watch_for_new_log_lines'  # naming the thread helps with debugging
         t.start()
+        if self.archive_dir:  # archive dated logs now and after each rotation
+            t = threading.Thread(target=self.archive_rotated_logs)
+            t.daemon = True  # allows this thread to be auto-killed on program exit
+            t.name = 'archive_rotated_logs'  # naming the thread helps with debugging
+            t.start()
+        t = threading.Thread(target=self.save_tiers_periodically)
+        t.daemon = True  # allows this thread to be auto-killed on program exit
+        t.name = 'save_series_tiers'  # naming the thread helps with debugging
+        t.start()
+        self.tiers_saver = t
 
         """ # this is the block of lines used to test self.add_new_log_lines()
         print('Total number of lines read from all log files:', self.line_count)
@@ -113,14 +168,155 @@ class HubData:
             all_logs.sort(reverse=True)
             logs_to_load = all_logs[:self.max_days]  # most recent ones
             logs_to_load.sort()  # sort them in time order: oldest to newest
+            if self.retention.downsample:  # older archived logs fill the tiers
+                for log in sorted(all_logs[self.max_days:]):
+                    self.load_log_archive(log, events=False)
         logs_to_load.append(current_log)  # append the current log last
 
         for log in logs_to_load:
+            if log != current_log and self.load_log_archive(log):
+                continue  # loaded from its archive, without parsing lines
             with open(log, 'r') as f:
                 lines = f.readlines()
             self.load_log_event_lines(lines)
 
-    def load_log_event_lines(self, lines):
+    def load_log_archive(self, log_path, events=True):
+        """ load the events of a dated log from its archive, if it is current
+
+        Only the newest 'count' events of each series (see Retention) are
+        kept in event_data, so only those rows of the archive are turned into
+        Python datetimes and strings; the other rows are never touched. The
+        numeric values of every row are added to the downsampling tiers with
+        NumPy, a few operations per series.
+
+        Parameters:
+          log_path (Path): a dated imagehub event log file
+          events (bool): False to add to the downsampling tiers only
+
+        Returns:
+          loaded (bool): True if loaded; False if there is no current archive
+        """
+        if self.archive_dir is None:
+            return False
+        import numpy as np
+        from helpers.log_archive import LogArchive, archive_path, is_current
+        archive_file = archive_path(log_path, self.archive_dir)
+        if not is_current(log_path, archive_file):
+            return False
+        archive = LogArchive(archive_file)
+        times_ms = archive.times_ms()
+        values = archive.columns['value']
+        # float64 numbers from the value table, exactly as the text log path
+        # converts them; the archive's float32 number column would round them
+        numbers = np.array([self.to_number(value.strip().lower())
+                            for value in archive.values], dtype=np.float64)[values]
+        rows = []
+        for s, (node, event) in enumerate(archive.series):
+            key = (node.strip().lower(), event.strip().lower())
+            series_rows = archive.rows_of(s)
+            if self.retention.downsample:
+                with self.event_data_lock:
+                    self.downsample_many(key, times_ms[series_rows] / 1000,
+                                         numbers[series_rows])
+            if not events:
+                continue
+            count = self.retention.policy(*key).count
+            if count is not None:
+                series_rows = series_rows[-count:]
+            for row in series_rows:
+                rows.append((times_ms[row], node, event, archive.values[values[row]]))
+        if not events:
+            return True
+        rows.sort(key=lambda row: row[0])  # oldest first, as in the log
+        for ms, node, event, value in rows:
+            self.load_log_event((node, event, archive.to_datetime(ms), value),
+                                downsample=False)  # all rows were added above
+        self.enforce_memory_cap()
+        self.line_count += archive.rows
+        self.lines_read.inc(archive.rows)
+        return True
+
+    def archive_rotated_logs(self):
+        """ archive_rotated_logs: thread to archive dated logs after rotation
+        """
+        from helpers.log_archive import convert_directory
+        while True:
+            try:
+                convert_directory(self.log_dir, self.archive_dir,
+                                  Path(self.log_file).name, self.parse_log_line)
+            except Exception:  # try again later; the imagehub may be rotating
+                log.exception('Error archiving dated event logs')
+            sleep(self.archive_interval)
+
+    def save_tiers_periodically(self):
+        """ save_tiers_periodically: thread to save the downsampling tiers
+        """
+        while not self.stopping.is_set():
+            if self.retention.downsample:
+                try:
+                    self.save_tiers()
+                except Exception:  # try again later, e.g. if the disk is full
+                    log.exception('Error saving downsampling tiers')
+            self.stopping.wait(self.tiers_interval)
+
+    def close(self):
+        """ stop saving the downsampling tiers, e.g. before lib_dir is removed
+        """
+        self.stopping.set()
+        self.tiers_saver.join()
+
+    def save_tiers(self):
+        """ save the downsampling tiers of all numeric series to tiers_file
+
+        Each tier's columns are saved as one array, under a name like
+        'barn|temp|1' (node|event|tier number); 'barn|temp|through' is the
+        time of the newest value in the series' tiers.
+        """
+        import numpy as np
+        arrays = {}
+        with self.event_data_lock:
+            for (node, event), tiers in self.tiers.items():
+                prefix = node + '|' + event + '|'
+                arrays[prefix + 'through'] = np.array([tiers.newest])
+                for i, (name, rollup) in enumerate(tiers.tiers):
+                    arrays[prefix + str(i)] = np.array(
+                        [rollup.starts, rollup.mins, rollup.maxs, rollup.sums,
+                         rollup.counts], dtype=np.float64)
+        partial = self.tiers_file.with_name(self.tiers_file.name + '.part')
+        with open(partial, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(partial, self.tiers_file)  # readers never see a partial file
+
+    def load_tiers(self):
+        """ load the downsampling tiers saved by save_tiers, if any
+
+        Values from the event logs that are not newer than a series' saved
+        tiers are already in them, so SeriesTiers skips them.
+        """
+        if not self.tiers_file.exists():
+            return
+        import numpy as np
+        try:
+            with np.load(self.tiers_file) as saved:
+                arrays = {name: saved[name] for name in saved.files}
+        except (OSError, ValueError):
+            log.exception('Could not read downsampling tiers; starting anew')
+            return
+        for name, through in arrays.items():
+            node, event, field = name.rsplit('|', 2)
+            if field != 'through':
+                continue
+            tiers = self.tiers[(node, event)] = SeriesTiers()
+            tiers.newest = tiers.loaded_through = float(through[0])
+            for i, (tier_name, rollup) in enumerate(tiers.tiers):
+                columns = arrays.get(node + '|' + event + '|' + str(i), None)
+                if columns is None:
+                    continue
+                for column, values in zip((rollup.starts, rollup.mins,
+                        rollup.maxs, rollup.sums, rollup.counts), columns):
+                    column.extend(values.tolist())
+
+    def load_log_event_lines(self, lines, notify=False):
         """ loads lines from a log file into the event_data dict()
 
         Loads event lines from the log files. Loads one line at
@@ -135,26 +331,80 @@ class HubData:
 
         Each data tuple is (datetime, event_value) where each
         event_value is a measure like "77 degrees" or a state like "motion".
-        This deque is of fixed length, so as new data points are left_appended,
-        those data points beyond max_history are discarded from the event_data
+        As new data points are left_appended, the oldest data points beyond
+        the retention policy of the series are discarded from the event_data
         dictionary (but not from the event log files; those are "read only"
         from the perspective of the librarian; they are written ONLY by the
         imagehub program).
 
+        If notify is True, each node_tuple is also passed to every function in
+        self.event_listeners (e.g., alert rule checks). This is done only for
+        lines newly added to the log, not for the initial load of log files.
+
         Parameters:
             lines (list): lines from an imagehub event log file
+            notify (bool): True to pass new events to self.event_listeners
 
         """
 
+        node_tuples = []
         for line in lines:
             self.line_count += 1
             # node_tuple is (node, event, when, value)
             node_tuple = self.parse_log_line(line)  # returns "None" if invalid
-            if node_tuple:  # only load a valid node_tuple that is not "None"
-                self.load_log_event(node_tuple)
+            if node_tuple is not None:  # only load a valid node_tuple
+                node_tuples.append(node_tuple)
+        self.load_events(node_tuples, notify)
+        self.lines_read.inc(len(lines))
+        self.parse_errors.inc(len(lines) - len(node_tuples))
         self.newest_log_line = lines[-1]
 
-    def load_log_event(self, node_tuple):
+    def load_events(self, node_tuples, notify=False):
+        """ load node_tuples into event_data; then enforce the memory cap
+
+        Parameters:
+            node_tuples (list): (node, event, when, value) tuples, oldest first
+            notify (bool): True to pass each event to self.event_listeners
+        """
+        for node_tuple in node_tuples:
+            self.load_log_event(node_tuple)
+            if notify:
+                for listener in self.event_listeners:
+                    try:
+                        listener(node_tuple)
+                    except Exception:  # keep reading new log lines
+                        log.exception('Error in HubData event listener')
+        self.enforce_memory_cap()
+
+    def record_events(self, node_tuples):
+        """ load events measured by the librarian itself, like new log lines
+
+        Image skills measure values (e.g. water flow estimates) that are not
+        in the imagehub event log. They are loaded the same way as newly added
+        log lines: event listeners are notified and the memory cap is
+        enforced. Each series is held newest first, so an event older than
+        the newest value already in its series is skipped.
+
+        Parameters:
+            node_tuples (list): (node, event, when, value) tuples
+        """
+        newest = {}  # (node, event) -> datetime of newest value
+        in_order = []
+        with self.event_data_lock:
+            for node_tuple in sorted(node_tuples, key=lambda t: t[2]):
+                key = (node_tuple[0].strip().lower(),
+                       node_tuple[1].strip().lower())
+                if key not in newest:
+                    values = self.event_data.get(key[0], {}).get(key[1], None)
+                    newest[key] = values[0][0] if values else None
+                if newest[key] is not None and node_tuple[2] < newest[key]:
+                    continue
+                newest[key] = node_tuple[2]
+                in_order.append(node_tuple)
+        self.load_events(in_order, notify=True)
+
+    @tracer.traced('HubData.load_log_event')
+    def load_log_event(self, node_tuple, downsample=True):
         """ load a single node event into the self.event_data dict()
 
         Creates a single entry in the self.event_data dict() which holds all
@@ -171,8 +421,8 @@ class HubData:
 
         Each data tuple is (datetime, event_value) where each
         event_value is a measure like "77 degrees" or a state like "motion".
-        This deque is of fixed length, so as new data points are left_appended,
-        those data points beyond max_history are discarded from the event_data
+        As new data points are left_appended, the oldest data points beyond
+        the retention policy of the series are discarded from the event_data
         dictionary (but not from the event log files; those are "read only"
         from the perspective of the librarian; they are written ONLY by the
         imagehub program).
@@ -182,8 +432,12 @@ class HubData:
 
         'when' is a datetime value and is stored as is.
 
+        A numeric value (e.g. a Temp) is also added to the downsampling tiers
+        of its series, which keep summaries after the raw value is discarded.
+
         Parameters:
           node_tuple (tuple): parsed values from a single event log line
+          downsample (bool): False if the value is already in the tiers
         """
 
         # node_tuple is (node, event, when, value)
@@ -194,22 +448,127 @@ class HubData:
         with self.event_data_lock:
             if node not in self.event_data:
                 self.event_data[node] = {}
-            if event not in self.event_data[node]:
-                self.event_data[node][event] = deque(maxlen=self.max_history)
-            self.event_data[node][event].appendleft((when, value))
+            values = self.event_data[node].get(event, None)
+            if values is None:
+                values = self.event_data[node][event] = deque()
+                self.policies[(node, event)] = self.retention.policy(node, event)
+                self.series_bytes[(node, event)] = 0
+            values.appendleft((when, value))
+            size = self.pair_bytes + sys.getsizeof(value)
+            self.series_bytes[(node, event)] += size
+            self.data_bytes += size
+            self.trim((node, event))
+            if downsample and self.retention.downsample:
+                number = self.to_number(value)
+                if number != number:  # NaN; not a number
+                    return
+                tiers = self.tiers.get((node, event), None)
+                if tiers is None:
+                    tiers = self.tiers[(node, event)] = SeriesTiers()
+                tiers.add(when, number)
+
+    @staticmethod
+    def to_number(value):
+        """ return a stripped, lower case event value as a float; NaN if the
+        value is not a number, like 'moving'
+        """
+        # a quick check of the first character skips 'moving', 'still', etc.
+        if value[:1] in NUMERIC:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+        return float('nan')
+
+    def downsample_many(self, key, ts, numbers):
+        """ add arrays of times (seconds since EPOCH) and numbers to the tiers
+        of a series; NaN numbers (non-numeric values) are skipped
+        """
+        import numpy as np
+        if not len(numbers) or np.isnan(numbers).all():
+            return
+        tiers = self.tiers.get(key, None)
+        if tiers is None:
+            tiers = self.tiers[key] = SeriesTiers()
+        tiers.add_many(np.asarray(ts, dtype=np.float64), np.asarray(numbers))
+
+    def trim(self, key):
+        """ discard the oldest values of a series beyond its retention policy
+
+        The newest value of a series is always kept. Called with
+        self.event_data_lock held.
+
+        Parameters:
+          key (tuple): (node, event) of the series
+        """
+        values = self.event_data[key[0]][key[1]]
+        count, age, max_bytes = self.policies[key]
+        while len(values) > 1 and (
+                (count is not None and len(values) > count) or
+                (age is not None and values[-1][0] < values[0][0] - age) or
+                (max_bytes is not None and self.series_bytes[key] > max_bytes)):
+            self.discard_oldest(key, values)
+
+    def discard_oldest(self, key, values):
+        when, value = values.pop()
+        size = self.pair_bytes + sys.getsizeof(value)
+        self.series_bytes[key] -= size
+        self.data_bytes -= size
+        self.evicted.inc()
+
+    def enforce_memory_cap(self):
+        """ discard the oldest values of the largest series until event_data
+        fits in the memory_mb of the retention settings
+        """
+        cap = self.retention.max_bytes
+        if cap is None or self.data_bytes <= cap:
+            return
+        with self.event_data_lock:
+            while self.data_bytes > cap:
+                ranked = sorted(self.series_bytes, key=self.series_bytes.get,
+                                reverse=True)
+                key = ranked[0]
+                values = self.event_data[key[0]][key[1]]
+                if len(values) <= 1:  # each series is down to its newest value
+                    break
+                # shrink the largest series until the next one is larger
+                floor = self.series_bytes[ranked[1]] if len(ranked) > 1 else 0
+                while (self.data_bytes > cap and len(values) > 1 and
+                       self.series_bytes[key] >= floor):
+                    self.discard_oldest(key, values)
+
+    def set_retention(self, options):
+        """ apply new retention policies to the series already in event_data
+
+        A change of the number of days of logs loaded takes effect when the
+        librarian is restarted, as does turning downsampling back on.
+
+        Parameters:
+          options (dict): the retention section of the yaml file, or None
+        """
+        retention = Retention(options)
+        if retention.max_days != self.max_days:
+            log.warning('Restart librarian to change days of logs loaded')
+        with self.event_data_lock:
+            self.retention = retention
+            if not retention.downsample:
+                self.tiers = {}
+            for key in self.policies:
+                self.policies[key] = retention.policy(*key)
+                self.trim(key)
+            self.enforce_memory_cap()
 
-    def parse_log_line(self, line):
+    @staticmethod
+    @tracer.traced('HubData.parse_log_line')
+    def parse_log_line(line):
         """ parse a single line from a log file returning a tuple of values
 
         Parses a single event line of text from a log file and returns a tuple
         (node_name, event_type, <<datetime>>, event_value)
 
         An event_value is a measure like "77 degrees" or a state like "motion".
-        This deque is of fixed length, so as new data points are left_appended,
-        those data points beyond 'max_history' are discarded from the event_data
-        dictionary (but not from the event log files; those are "read only"
-        from the perspective of the librarian; they are written ONLY by the
-        imagehub program).
+        The log files are "read only" from the perspective of the librarian;
+        they are written ONLY by the imagehub program.
 
         Example:
         Input Log data lines like these:
@@ -249,9 +608,12 @@ class HubData:
         """ watch_for_new_log_lines: thread to fetch newly added log lines
         """
         while True:
+            heartbeats.set_interval('HubData ingest', self.log_check_interval)
+            heartbeats.stamp('HubData ingest')  # progress seen by stall_watcher
             self.add_new_log_lines()
             sleep(self.log_check_interval)
 
+    @tracer.traced('HubData.add_new_log_lines')
     def add_new_log_lines(self):
         """ add new event log data lines to self.event_data dict()
 
@@ -296,14 +658,14 @@ class HubData:
             # print('len(lines) vs. n_lines:')
             # print("D: len(lines) is ", len(lines), 'n_lines:', n_lines)
             if len(lines) > n_lines:  # added a 2nd log file, load all lines
-                self.load_log_event_lines(lines)
+                self.load_log_event_lines(lines, notify=True)
                 return
             for n, line in enumerate(lines):  # is newest log line in tail?
                 if line[:30] == self.newest_log_line[:30]:  # found a match line
                     # print('About to add lines from', n, ' to ', len(lines)-1 )
                     # for i, l in enumerate(lines[n+1:]):
                         # print('Line', i, ':', l)
-                    self.load_log_event_lines(lines[n+1:])
+                    self.load_log_event_lines(lines[n+1:], notify=True)
                     return
         return
 
@@ -341,6 +703,91 @@ class HubData:
         # print('Number of lines returned from log_tail:', len(lines))
         return lines
 
+    def series_count(self):
+        """ return the number of (node, event) series in self.event_data
+        """
+        with self.event_data_lock:
+            return sum(len(events) for events in self.event_data.values())
+
+    def values_count(self):
+        """ return the number of data values in self.event_data
+        """
+        with self.event_data_lock:
+            return sum(len(values) for events in self.event_data.values()
+                       for values in events.values())
+
+    def event_data_bytes(self):
+        """ return an estimate of the memory used by self.event_data
+
+        Counts the deques, the (datetime, value) tuples, the datetimes and the
+        value strings. Strings shared between values are counted each time.
+        The values are counted as they are added and discarded, in data_bytes.
+        """
+        size = sys.getsizeof(self.event_data)
+        with self.event_data_lock:
+            for events in self.event_data.values():
+                size += sys.getsizeof(events)
+                for values in events.values():
+                    size += sys.getsizeof(values)
+            return size + self.data_bytes
+
+    def tier_bytes(self):
+        """ return the memory used by the buckets of the downsampling tiers
+        """
+        with self.event_data_lock:
+            return sum(tiers.bytes() for tiers in self.tiers.values())
+
+    def fetch_summary(self, node, event, start, end, resolution):
+        """ fetch min, max, mean and count of a numeric series over time
+
+        Uses the coarsest downsampling tier whose buckets are no wider than
+        resolution and that still holds data back to start. For example, a
+        week at hourly resolution uses the hourly tier; a year of daily
+        values uses the daily tier. If resolution is finer than 5 minutes
+        and the raw values go back to start, each raw value is returned.
+        If no tier is fine enough and old enough, the finest tier that goes
+        back far enough is used.
+
+        Parameters:
+          node (str): what node to fetch data for, e.g., barn
+          event (str): what numeric event, e.g. Temp
+          start (datetime): datetime of the oldest bucket to fetch
+          end (datetime): datetime of the newest bucket to fetch
+          resolution (timedelta): widest buckets wanted
+
+        Returns:
+          (tier, buckets): tier is '5 minutes', 'hour', 'day' or 'raw';
+            buckets is a list of (datetime, min, max, mean, count), oldest
+            first. (None, []) if the series has no numeric values.
+        """
+        key = (node.strip().lower(), event.strip().lower())
+        with self.event_data_lock:
+            tiers = self.tiers.get(key, None)
+            if tiers is None or not tiers.tiers[-1][1].starts:
+                return None, []
+            oldest = tiers.tiers[-1][1].starts[0]  # oldest daily bucket
+            t0 = max((start - EPOCH).total_seconds(), oldest)
+            t1 = (end - EPOCH).total_seconds()
+            raw = self.event_data[key[0]].get(key[1], ())
+            if (resolution < timedelta(seconds=tiers.tiers[0][1].seconds) and
+                    raw and (raw[-1][0] - EPOCH).total_seconds() <= t0):
+                buckets = []
+                for when, value in reversed(raw):
+                    if start <= when <= end:
+                        try:
+                            x = float(value)
+                        except ValueError:
+                            continue
+                        buckets.append((when, x, x, x, 1))
+                return 'raw', buckets
+            covering = [(name, rollup) for name, rollup in tiers.tiers
+                        if rollup.starts and rollup.starts[0] <= t0]
+            fine_enough = [(name, rollup) for name, rollup in covering
+                           if rollup.seconds <= resolution.total_seconds()]
+            name, rollup = (fine_enough or covering)[-1 if fine_enough else 0]
+            return name, [(EPOCH + timedelta(seconds=b[0]),) + b[1:]
+                          for b in rollup.between(t0, t1)]
+
     def fetch_event_data(self, node, event):
         """ fetch some specified data from event logs or images
 
@@ -378,3 +825,687 @@ class HubData:
                     return None, " ".join(["Don't know", node, event])
             else:
                 return None,  " ".join(["Don't know", node])
+
+    def fetch_history(self, node, event, start, end):
+        """ fetch the values of a node event from the event logs
+
+        Unlike fetch_event_data(), which holds only recent values in memory,
+        this reads the event log files, so it can answer questions about
+        events from any day the imagehub logs are kept.
+
+        Parameters:
+          node (str): what node to fetch data for, e.g., barn
+          event (str): what event or measurement, e.g. Temp or motion
+          start (datetime): datetime of the oldest value to fetch
+          end (datetime): datetime of the newest value to fetch
+
+        Returns:
+          values (list): (datetime, value) tuples, oldest first
+        """
+        node = node.strip().lower()
+        event = event.strip().lower()
+        contains = ' ' + node + '|' + event + '|'  # e.g. '~ Barn|Temp|83 F'
+        return [(when, value.strip().lower()) for n, e, when, value
+                in self.history.read(start, end, contains)
+                if n.strip().lower() == node and e.strip().lower() == event]
+
+# Retention policy of a series: most values, longest time span before its
+# newest value (timedelta) and most bytes of values; None is no limit
+Policy = namedtuple('Policy', 'count age max_bytes')
+
+class Retention:
+    """ Retention policies for the series of events that HubData keeps
+
+    Each (node, event) series, like Barn Temp, keeps its values in memory
+    while they are within the limits of its policy: a number of values, a
+    time span before its newest value and a memory budget. The 'default'
+    policy applies to every series without its own policy in 'series'. A
+    global memory cap discards the oldest values of the largest series. The
+    retention section of the yaml file looks like:
+
+        retention:
+            memory_mb: 64  # all series together
+            downsample: True  # keep 5 minute, hourly & daily numeric summaries
+            default:
+                count: 300
+            series:
+                FrontWindow Sidewalk|motion:
+                    days: 2
+                BackDeck|Temp:
+                    days: 30
+                    memory_kb: 512
+
+    Parameters:
+        options (dict): the retention section of the yaml file, or None
+    """
+    default_count = 300  # values kept of each series with no retention section
+    default_days = 3  # days of dated logs loaded if no policy needs more
+
+    def __init__(self, options):
+        options = options or {}
+        self.default = self.make_policy(options.get('default',
+                                                    {'count': self.default_count}))
+        self.series = {}  # (node, event) -> Policy, lower case
+        for name, policy in (options.get('series', None) or {}).items():
+            if '|' not in name:
+                raise YamlOptionsError('Retention series must be node|event, '
+                                       'not ' + name)
+            node, event = name.split('|', 1)
+            self.series[(node.strip().lower(), event.strip().lower())] = (
+                self.make_policy(policy))
+        self.downsample = options.get('downsample', True)  # numeric series
+        memory_mb = options.get('memory_mb', 0)
+        self.max_bytes = int(memory_mb * 1024 * 1024) if memory_mb else None
+        if 'max_days' in options:
+            self.max_days = options['max_days']
+        else:  # load enough dated logs for the longest time span
+            spans = [policy.age.days + (policy.age.seconds > 0)
+                     for policy in [self.default, *self.series.values()]
+                     if policy.age is not None]
+            self.max_days = max(spans + [self.default_days])
+
+    @staticmethod
+    def make_policy(options):
+        options = options or {}
+        days = options.get('days', None)
+        memory_kb = options.get('memory_kb', None)
+        return Policy(options.get('count', None),
+                      timedelta(days=days) if days is not None else None,
+                      int(memory_kb * 1024) if memory_kb is not None else None)
+
+    def policy(self, node, event):
+        """ return the Policy of a series; node and event are lower case
+        """
+        return self.series.get((node, event), self.default)
+
+class Rollup:
+    """ Buckets of the min, max, sum and count of a numeric series
+
+    One downsampling tier of a series, e.g. its hourly buckets. Buckets are
+    kept in arrays of doubles by bucket start (seconds since EPOCH), so a
+    year of daily buckets takes about 15 kilobytes. Buckets older than 'keep'
+    seconds before the newest one are discarded.
+
+    Parameters:
+        seconds (int): width of a bucket, e.g. 3600 for hourly
+        keep (int): seconds of buckets to keep; None to keep them all
+    """
+    def __init__(self, seconds, keep):
+        self.seconds = seconds
+        self.keep = keep
+        self.starts = array('d')  # bucket start times, sorted
+        self.mins = array('d')
+        self.maxs = array('d')
+        self.sums = array('d')
+        self.counts = array('d')
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, ts, x):
+        """ add a value x at ts seconds since EPOCH
+        """
+        self.merge(ts - ts % self.seconds, x, x, x, 1)
+
+    def merge(self, start, low, high, total, count):
+        """ merge a summary of values into the bucket that begins at start
+        """
+        starts = self.starts
+        if starts and start == starts[-1]:  # usual case: the newest bucket
+            i = len(starts) - 1
+        elif not starts or start > starts[-1]:  # a new newest bucket
+            for column, value in ((starts, start), (self.mins, low),
+                                  (self.maxs, high), (self.sums, total),
+                                  (self.counts, count)):
+                column.append(value)
+            self.prune()
+            return
+        else:  # an older bucket; values loaded out of time order
+            i = bisect_left(starts, start)
+            if i == len(starts) or starts[i] != start:
+                if self.keep is not None and start < starts[-1] - self.keep:
+                    return  # too old to keep
+                for column, value in ((starts, start), (self.mins, low),
+                                      (self.maxs, high), (self.sums, total),
+                                      (self.counts, count)):
+                    column.insert(i, value)
+                return
+        self.mins[i] = min(self.mins[i], low)
+        self.maxs[i] = max(self.maxs[i], high)
+        self.sums[i] += total
+        self.counts[i] += count
+
+    def prune(self):
+        # discard old buckets in chunks, so each one is not a copy of the arrays
+        if self.keep is None:
+            return
+        cutoff = self.starts[-1] - self.keep
+        if self.starts[0] < cutoff - self.keep / 10:
+            n = bisect_left(self.starts, cutoff)
+            for column in (self.starts, self.mins, self.maxs, self.sums,
+                           self.counts):
+                del column[:n]
+
+    def between(self, start, end):
+        """ return (start, min, max, mean, count) of buckets in start..end
+
+        Buckets that overlap the range are included; times are seconds.
+        """
+        i = bisect_right(self.starts, start - self.seconds)
+        j = bisect_right(self.starts, end)
+        return [(self.starts[k], self.mins[k], self.maxs[k],
+                 self.sums[k] / self.counts[k], int(self.counts[k]))
+                for k in range(i, j)]
+
+class SeriesTiers:
+    """ Downsampling tiers of a numeric series, e.g. Barn Temp
+
+    Every value added to the series is also added to its 5 minute, hourly
+    and daily buckets. HubData keeps only recent raw values (see Retention);
+    each tier keeps its buckets for longer, the coarser the longer. So older
+    history is kept as summaries, in under 200 kilobytes per series. HubData
+    saves the tiers and loads them at startup; values no newer than the
+    saved tiers (loaded_through) are already in them and are skipped.
+    """
+    # name, bucket seconds and seconds of buckets kept (None for no limit)
+    TIERS = (('5 minutes', 300, 7 * 86400),
+             ('hour', 3600, 90 * 86400),
+             ('day', 86400, None))
+
+    def __init__(self):
+        self.tiers = [(name, Rollup(seconds, keep))
+                      for name, seconds, keep in self.TIERS]
+        self.newest = float('-inf')  # seconds since EPOCH of newest value
+        self.loaded_through = None  # newest value in tiers loaded from a file
+
+    def add(self, when, x):
+        ts = (when - EPOCH).total_seconds()
+        if self.loaded_through is not None and ts <= self.loaded_through:
+            return
+        self.newest = max(self.newest, ts)
+        for name, rollup in self.tiers:
+            rollup.add(ts, x)
+
+    def add_many(self, ts, xs):
+        """ add arrays of times (seconds since EPOCH) and values, any order
+
+        Values are summarized per bucket with NumPy, then each bucket is merged.
+        """
+        import numpy as np
+        keep = ~np.isnan(xs)
+        if self.loaded_through is not None:
+            keep &= ts > self.loaded_through
+        ts, xs = ts[keep], xs[keep].astype(np.float64)
+        if not len(ts):
+            return
+        self.newest = max(self.newest, float(ts.max()))
+        for name, rollup in self.tiers:
+            starts = ts - ts % rollup.seconds
+            order = np.argsort(starts, kind='stable')
+            starts, values = starts[order], xs[order]
+            firsts = np.flatnonzero(np.diff(starts, prepend=-1.0))
+            counts = np.diff(np.append(firsts, len(starts)))
+            for summary in zip(starts[firsts], np.minimum.reduceat(values, firsts),
+                               np.maximum.reduceat(values, firsts),
+                               np.add.reduceat(values, firsts), counts):
+                rollup.merge(*(float(n) for n in summary))
+
+    def bytes(self):
+        return sum(len(rollup) * 5 * 8 for name, rollup in self.tiers)
+
+class MappedLog:
+    """ A memory-mapped event log file with a sparse datetime index
+
+    The index holds the datetime and byte offset of the first line after
+    every index_bytes bytes of the file, so it has one entry for every few
+    hundred lines. A time range is found with a binary search of the index,
+    and only the bytes of that region of the file are decoded and parsed.
+    The operating system reads only the pages of the file that are used.
+
+    Parameters:
+        path (Path): an imagehub event log file
+    """
+    index_bytes = 16384  # bytes of log file between sparse index entries
+
+    def __init__(self, path):
+        self.path = path
+        self.inode = None
+        self.size = 0
+        self.mm = None
+        self.times = []  # sorted datetimes of index entries
+        self.offsets = []  # byte offset of the line at each index entry
+        self.refresh()
+
+    def refresh(self):
+        """ map the file again if it has grown or was replaced; update the index
+        """
+        stat = os.stat(self.path)
+        if stat.st_ino == self.inode and stat.st_size == self.size:
+            return
+        if stat.st_ino != self.inode or stat.st_size < self.size:
+            self.times, self.offsets = [], []  # a new file; index it all
+        self.close()
+        self.inode, self.size = stat.st_ino, stat.st_size
+        if not self.size:  # an empty file can not be mapped
+            return
+        with open(self.path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        pos = 0
+        if self.offsets:  # the file grew; resume at the last index entry
+            pos = self.offsets.pop()
+            self.times.pop()
+        self.extend_index(pos)
+
+    def extend_index(self, pos):
+        while pos < self.size:
+            when = self.line_time(pos)
+            if when is not None and (not self.times or when >= self.times[-1]):
+                self.times.append(when)
+                self.offsets.append(pos)
+            newline = self.mm.find(b'\n', pos + self.index_bytes)
+            if newline < 0:
+                break
+            pos = newline + 1
+
+    def line_time(self, pos):
+        # every event log line starts with a datetime like 2021-09-24 06:25:04,959
+        try:
+            return datetime.strptime(self.mm[pos:pos + 23].decode(),
+                                     "%Y-%m-%d %H:%M:%S,%f")
+        except ValueError:
+            return None
+
+    def lines_between(self, start, end):
+        """ return the lines of the index regions that hold start through end
+
+        Lines just outside the range are included; the caller checks the
+        datetime of each line.
+        """
+        if self.mm is None or not self.times:
+            return []
+        # the last entry before start; lines at start can precede an entry
+        # that has the same datetime as start
+        i = bisect_left(self.times, start) - 1
+        j = bisect_right(self.times, end)  # first entry after end
+        first = self.offsets[i] if i >= 0 else 0
+        last = self.offsets[j] if j < len(self.offsets) else self.size
+        if first >= last:
+            return []
+        data = self.mm[first:last]
+        return data.decode('utf-8', errors='replace').splitlines()
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+class LogHistory:
+    """ Methods and attributes to read time ranges of older event log files
+
+    HubData keeps only the recent events in memory. Questions about older
+    events read the dated event logs (imagehub.log.2021-09-23, ...) with
+    memory maps and sparse indexes (see MappedLog), so a question about one
+    hour of a month of logs decodes about one hour of log lines instead of
+    reading every line of every file. A dated log is indexed the first time
+    it is read; the current log is indexed again only where it has grown.
+
+    Parameters:
+        log_file (str): path of the current imagehub event log
+        parse_line (function): parses a log line into a node_tuple or None,
+            e.g. HubData.parse_log_line
+    """
+    def __init__(self, log_file, parse_line):
+        self.log_file = Path(log_file)
+        self.parse_line = parse_line
+        self.logs = {}  # path -> MappedLog
+        self.lock = threading.Lock()
+        self.bytes_read = metrics.counter('librarian_history_bytes_total',
+            'Bytes of event log files decoded for history queries')
+
+    def logs_between(self, start, end):
+        """ return the paths of the log files that may hold start through end
+        """
+        dated = {}
+        for path in self.log_file.parent.glob(self.log_file.name + '.*'):
+            try:  # e.g. imagehub.log.2021-09-23 holds the lines of that day
+                day = datetime.strptime(path.name[len(self.log_file.name) + 1:],
+                                        '%Y-%m-%d').date()
+            except ValueError:
+                continue
+            dated[path] = day
+        paths = sorted((day, path) for path, day in dated.items()
+                       if start.date() <= day <= end.date())
+        paths = [path for day, path in paths]
+        if not dated or end.date() > max(dated.values()):
+            paths.append(self.log_file)  # current log holds the newest lines
+        for path in set(self.logs) - set(dated) - {self.log_file}:
+            self.logs.pop(path).close()  # dated log was removed
+        return paths
+
+    def read(self, start, end, contains=None):
+        """ return the node_tuples of event log lines from start through end
+
+        Parameters:
+            start (datetime): datetime of the oldest line to return
+            end (datetime): datetime of the newest line to return
+            contains (str): only parse lines with this lower case text
+
+        Returns:
+            node_tuples (list): (node, event, when, value), oldest first
+        """
+        node_tuples = []
+        with self.lock:
+            for path in self.logs_between(start, end):
+                mapped = self.logs.get(path, None)
+                try:
+                    if mapped is None:
+                        mapped = self.logs[path] = MappedLog(path)
+                    else:
+                        mapped.refresh()
+                except FileNotFoundError:  # rotated or removed meanwhile
+                    continue
+                lines = mapped.lines_between(start, end)
+                self.bytes_read.inc(sum(len(line) + 1 for line in lines))
+                for line in lines:
+                    if contains and contains not in line.lower():
+                        continue
+                    node_tuple = self.parse_line(line)
+                    if node_tuple and start <= node_tuple[2] <= end:
+                        node_tuples.append(node_tuple)
+        return node_tuples
+
+class TimeIndex:
+    """ Items kept sorted by datetime for O(log n) time range lookups
+
+    Items usually arrive in time order, so adding one is an append; an item
+    that arrives out of order is inserted in its sorted place.
+    """
+    def __init__(self):
+        self.times = []  # sorted datetimes
+        self.items = []  # item for each datetime in self.times
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, when, item):
+        if not self.times or when >= self.times[-1]:
+            self.times.append(when)
+            self.items.append(item)
+        else:
+            i = bisect_right(self.times, when)
+            self.times.insert(i, when)
+            self.items.insert(i, item)
+
+    def extend(self, pairs):
+        """ add a batch of (datetime, item) pairs, in any order
+        """
+        pairs = sorted(pairs, key=lambda pair: pair[0])
+        if not pairs:
+            return
+        if self.times and pairs[0][0] < self.times[-1]:  # merge and re-sort
+            pairs = sorted(list(zip(self.times, self.items)) + pairs,
+                           key=lambda pair: pair[0])
+            self.times, self.items = [], []
+        self.times.extend(when for when, item in pairs)
+        self.items.extend(item for when, item in pairs)
+
+    def bisect(self, when, left=False):
+        """ return the position of a datetime in the index
+
+        Returns the position after any items at the same datetime, or before
+        them if left is True.
+        """
+        if left:
+            return bisect_left(self.times, when)
+        return bisect_right(self.times, when)
+
+    def between(self, start, end):
+        """ return the items from start through end, oldest first
+        """
+        return self.items[self.bisect(start, left=True):self.bisect(end)]
+
+    def latest(self, before=None):
+        """ return the newest item, or the newest item at or before a datetime
+        """
+        if before is None:
+            i = len(self.times)
+        else:
+            i = bisect_right(self.times, before)
+        return self.items[i - 1] if i else None
+
+    def discard_oldest(self, n):
+        """ discard the n oldest items
+        """
+        del self.times[:n]
+        del self.items[:n]
+
+# One line of a detected-objects file; node and label are lower case
+Detection = namedtuple('Detection', 'when node label confidence image box')
+
+class DetectionStore:
+    """ Methods and attributes to index detected objects label files
+
+    Object detection programs read the imagehub images and write one line
+    per detected object to detected-objects files. Lines have the same
+    datetime format and ' ~ ' separator as imagehub event log lines:
+
+        2021-09-23 16:58:47,437 ~ Driveway Mailbox|mail truck|0.92|Driveway-Mailbox-2021-09-23T16.58.47.437149.jpg|12,40,210,180
+
+    The fields after the datetime are node|label|confidence|image|box; only
+    node and label are required. Every file whose name contains
+    'detected-objects' in the detections directory (or its subdirectories,
+    e.g. one per detector) is loaded and then followed for newly added lines.
+
+    Detections are indexed by label, by node and by hour, so questions like
+    "coyotes this week?" are answered by index lookups, not file scans.
+
+    Parameters:
+        settings (Settings object): settings object created from YAML file
+    """
+    def __init__(self, settings):
+        dd = Path(settings.detections_directory)
+        if not dd.is_dir():
+            raise YamlOptionsError('Detections directory in YAML file is not a directory.')
+        self.detections_dir = dd
+        self.by_label = {}  # label -> TimeIndex of Detections
+        self.by_node = {}  # node -> TimeIndex of Detections
+        self.by_label_node = {}  # (label, node) -> TimeIndex of Detections
+        self.by_hour = {}  # datetime of start of hour -> Counter of labels
+        self.lock = threading.RLock()
+        self.read_lock = threading.Lock()  # one reader of the files at a time
+        self.offsets = {}  # file path -> (inode, offset of next unread line)
+        # Detections from the librarian's own image skills are saved here
+        self.skills_file = dd / 'librarian-detected-objects.txt'
+        self.detections_read = metrics.counter('librarian_detections_total',
+            'Detected object lines read into DetectionStore')
+        self.check_for_new_detections()  # initial load of all the files
+        self.check_interval = settings.log_check_interval  # seconds
+        t = threading.Thread(target=self.watch_for_new_detections)
+        t.daemon = True  # allows this thread to be auto-killed on program exit
+        t.name = 'watch_for_new_detections'  # naming the thread helps with debugging
+        t.start()
+
+    def watch_for_new_detections(self):
+        """ watch_for_new_detections: thread to load newly added label lines
+        """
+        while True:
+            sleep(self.check_interval)
+            try:
+                self.check_for_new_detections()
+            except Exception:  # keep watching; the files may be rewritten
+                log.exception('Error reading detected objects files')
+
+    def check_for_new_detections(self):
+        """ load lines added to any detected-objects file since the last check
+        """
+        for path in sorted(self.detections_dir.rglob('*detected-objects*')):
+            if path.is_file():
+                with self.read_lock:
+                    lines = self.read_new_lines(path)
+                if lines:
+                    self.load_detection_lines(lines)
+
+    def record_detections(self, detections):
+        """ save Detections made by the librarian's image skills
+
+        They are appended to the librarian's own detected-objects file, so
+        they are kept across restarts, and loaded like the lines of any other
+        object detector, but right away.
+
+        Parameters:
+            detections (list): Detections, e.g. from ImageSkills
+        """
+        lines = [self.format_detection(detection) for detection in detections]
+        with self.read_lock:
+            with open(self.skills_file, 'a') as f:
+                f.writelines(lines)
+            lines = self.read_new_lines(self.skills_file)
+        self.load_detection_lines(lines)
+
+    @staticmethod
+    def format_detection(detection):
+        """ return a Detection as a detected-objects file line
+        """
+        confidence = ('{:.3f}'.format(detection.confidence)
+                      if detection.confidence is not None else '')
+        box = ','.join(str(n) for n in detection.box) if detection.box else ''
+        image = os.path.basename(detection.image) if detection.image else ''
+        return (detection.when.strftime('%Y-%m-%d %H:%M:%S,') +
+                '{:03d}'.format(detection.when.microsecond // 1000) + ' ~ ' +
+                '|'.join([detection.node, detection.label, confidence, image,
+                          box]) + '\n')
+
+    def read_new_lines(self, path):
+        """ return complete lines added to a file since it was last read
+
+        Like following the event log with tail, only the new end of the file
+        is read. A file that was replaced (new inode) or truncated is read
+        again from its start. A partly written last line is left for the
+        next check.
+
+        Parameters:
+            path (Path): a detected-objects file
+
+        Returns:
+            lines (list): new complete lines
+        """
+        stat = os.stat(path)
+        inode, offset = self.offsets.get(path, (stat.st_ino, 0))
+        if inode != stat.st_ino or stat.st_size < offset:  # rotated
+            offset = 0
+        if stat.st_size == offset:
+            return []
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1  # keep any partial last line for later
+        self.offsets[path] = (stat.st_ino, offset + end)
+        return data[:end].decode('utf-8', errors='replace').splitlines()
+
+    def load_detection_lines(self, lines):
+        """ parse detected object lines and add them to the indexes
+
+        Parameters:
+            lines (list): lines from detected-objects files
+        """
+        loaded = 0
+        with self.lock:
+            for line in lines:
+                detection = self.parse_detection_line(line)
+                if detection is None:
+                    continue
+                self.by_label.setdefault(detection.label,
+                    TimeIndex()).add(detection.when, detection)
+                self.by_node.setdefault(detection.node,
+                    TimeIndex()).add(detection.when, detection)
+                self.by_label_node.setdefault((detection.label, detection.node),
+                    TimeIndex()).add(detection.when, detection)
+                hour = detection.when.replace(minute=0, second=0, microsecond=0)
+                self.by_hour.setdefault(hour, Counter())[detection.label] += 1
+                loaded += 1
+        self.detections_read.inc(loaded)
+
+    def parse_detection_line(self, line):
+        """ parse a detected objects line into a Detection
+
+        Returns:
+            Detection, or None if the line has no valid datetime, node & label
+        """
+        two_parts = line.split('~', 1)
+        if len(two_parts) < 2:  # no ' ~ ' separator
+            return None
+        try:
+            when = datetime.strptime(two_parts[0].strip(), "%Y-%m-%d %H:%M:%S,%f")
+        except ValueError:
+            return None
+        fields = [field.strip() for field in two_parts[1].split('|')]
+        if len(fields) < 2 or not fields[1]:
+            return None
+        fields.extend([''] * (5 - len(fields)))  # optional fields
+        try:
+            confidence = float(fields[2]) if fields[2] else None
+        except ValueError:
+            confidence = None
+        try:
+            box = (tuple(int(n) for n in fields[4].split(','))
+                   if fields[4] else None)
+        except ValueError:  # e.g. '1.5,2,3,4'; the detection is still kept
+            box = None
+        return Detection(when, fields[0].lower(), fields[1].lower(),
+                         confidence, fields[3], box)
+
+    def labels(self):
+        """ return the set of all labels detected so far
+        """
+        with self.lock:
+            return set(self.by_label)
+
+    def last_seen(self, label, node=None):
+        """ return the most recent Detection of a label, or None
+
+        Parameters:
+            label (str): object label, e.g. 'coyote'
+            node (str): only detections from this node, if given
+        """
+        label = label.strip().lower()
+        with self.lock:
+            if node is None:
+                index = self.by_label.get(label, None)
+            else:
+                index = self.by_label_node.get((label, node.strip().lower()),
+                                               None)
+            return index.latest() if index else None
+
+    def seen_between(self, label, start, end):
+        """ return Detections of a label from start through end, oldest first
+        """
+        with self.lock:
+            index = self.by_label.get(label.strip().lower(), None)
+            return index.between(start, end) if index else []
+
+    def node_detections(self, node, start, end):
+        """ return Detections from a node from start through end, oldest first
+        """
+        with self.lock:
+            index = self.by_node.get(node.strip().lower(), None)
+            return index.between(start, end) if index else []
+
+    def label_counts(self, start, end):
+        """ return a Counter of labels detected in the hours from start to end
+
+        Counts are per whole hour, so detections in the hours holding start
+        and end are counted even if slightly outside the range.
+        """
+        hour = start.replace(minute=0, second=0, microsecond=0)
+        counts = Counter()
+        with self.lock:
+            if len(self.by_hour) < (end - hour) / timedelta(hours=1):
+                hours = [h for h in self.by_hour if hour <= h <= end]
+            else:  # fewer hours in the range than hours with detections
+                hours = []
+                while hour <= end:
+                    hours.append(hour)
+                    hour += timedelta(hours=1)
+            for h in hours:
+                counts.update(self.by_hour.get(h, {}))
+        return counts
@@ -7,11 +7,318 @@ Copyright (c) 2020 by Jeff Bass.
 License: MIT, see LICENSE for more details.
 """
 
+import os
+import re
 import sys
+import hashlib
+import importlib.util
 import logging
 import threading
-from time import sleep
-from collections import deque
+import multiprocessing
+from time import time, sleep
+from queue import Queue, Empty, Full
+from pathlib import Path
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque, namedtuple, OrderedDict
+from helpers.utils import YamlOptionsError
+from helpers.metrics import metrics
+from helpers.data_tools import TimeIndex, Detection
+
+log = logging.getLogger(__name__)
+
+# imagehub image file names are <Node>-<ISO timestamp>.jpg, with periods in
+# place of colons, e.g. Driveway-Mailbox-2021-09-04T08.02.38.105390.jpg
+IMAGE_NAME = re.compile(r'^(.+)-(\d{4}-\d\d-\d\dT\d\d\.\d\d\.\d\d(?:\.\d{1,6})?)\.jpg$')
+
+# An image file in the ImageCatalog; node is normalized by normalize_node()
+ImageFile = namedtuple('ImageFile', 'when node path')
+
+def normalize_node(name):
+    """ return a node name in the form used for lookups, e.g. 'driveway mailbox'
+
+    Event logs use node names with spaces ("Driveway Mailbox") and image
+    file names use hyphens ("Driveway-Mailbox-..."); both normalize to the
+    same lower case name with single spaces.
+    """
+    return ' '.join(re.split(r'[\s_-]+', name.strip().lower())).strip()
+
+def parse_image_name(name):
+    """ parse node and datetime from an imagehub image file name
+
+    Parameters:
+        name (str): file name like Barn-2021-04-19T23.43.20.867255.jpg
+
+    Returns:
+        (node, when): normalized node name and datetime, or None if the name
+            is not an imagehub image file name
+    """
+    match = IMAGE_NAME.match(name)
+    if not match:
+        return None
+    node, ts = match.groups()
+    # slicing is much faster than strptime over hundreds of thousands of files
+    microsecond = int(ts[20:].ljust(6, '0')) if len(ts) > 19 else 0
+    try:
+        when = datetime(int(ts[0:4]), int(ts[5:7]), int(ts[8:10]),
+                        int(ts[11:13]), int(ts[14:16]), int(ts[17:19]),
+                        microsecond)
+    except ValueError:
+        return None
+    return normalize_node(node), when
+
+class ImageCatalog:
+    """ Methods and attributes to find imagehub images by node and time
+
+    The imagehub writes images into directories nested by date. The catalog
+    scans the image directory once at startup, keeping a TimeIndex of image
+    paths for each node. Then it watches for new images by checking the
+    modification times of the directories; only a directory that has changed
+    (usually just today's) is scanned again. Lookups like "latest image from
+    Barn" or "Driveway Mailbox images between 10:40 and 10:50" are binary
+    searches of the node's index, without any glob of the image directories.
+
+    The frames of a burst are often nearly identical. If dedupe_images is set,
+    each new image gets a difference hash (dHash) of a tiny grayscale copy,
+    and a frame whose hash is within max_distance bits of the first frame of
+    the node's current group joins that group as a near-duplicate. Previews and
+    image skills then need to process only the first frame of each group.
+    Images already on disk at startup are hashed by the watching thread
+    before it looks for new ones, so startup is not delayed.
+
+    Parameters:
+        settings (Settings object): settings object created from YAML file
+    """
+    max_distance = 5  # hash bits that may differ in a near-duplicate
+    max_gap = timedelta(seconds=10)  # longest time between frames of a group
+
+    def __init__(self, settings):
+        image_dir = Path(settings.image_directory)
+        if not image_dir.is_dir():
+            raise YamlOptionsError('Image directory in YAML file is not a directory.')
+        self.image_dir = image_dir
+        self.by_node = {}  # normalized node name -> TimeIndex of paths
+        self.dir_mtimes = {}  # directory -> mtime when it was last scanned
+        self.dir_files = {}  # directory -> set of image file names in it
+        self.dir_subdirs = {}  # directory -> list of its subdirectories
+        self.image_listeners = []  # functions called with each new ImageFile
+        self.lock = threading.RLock()
+        self.duplicate_of = {}  # image path -> first image path of its group
+        self.group_heads = {}  # node -> (path, hash, when of last frame) of group
+        self.hash_pool = None  # threads hashing new images, if dedupe_images
+        metrics.gauge('librarian_images_indexed', 'Number of images in ' +
+            'ImageCatalog', function=self.image_count)
+        metrics.gauge('librarian_duplicate_images', 'Number of images that ' +
+            'are near-duplicates of an earlier frame',
+            function=lambda: len(self.duplicate_of))
+        initial_images = self.check_for_new_images()  # scan all directories
+        if settings.dedupe_images:  # OpenCV is only needed to hash images
+            if importlib.util.find_spec('cv2') is None:
+                log.warning('OpenCV is not installed; images are not deduped.')
+            else:  # OpenCV releases the GIL, so hashing threads run in parallel
+                self.hash_pool = ThreadPoolExecutor(max_workers=2,
+                                                    thread_name_prefix='image hash')
+        self.check_interval = settings.log_check_interval  # seconds
+        t = threading.Thread(target=self.watch_for_new_images,
+                             args=(initial_images,))
+        t.daemon = True  # allows this thread to be auto-killed on program exit
+        t.name = 'watch_for_new_images'  # naming the thread helps with debugging
+        t.start()
+
+    def watch_for_new_images(self, initial_images=()):
+        """ watch_for_new_images: thread to add newly written images
+
+        Parameters:
+            initial_images (list): ImageFiles of the startup scan, oldest
+                first; grouped as near-duplicates first, if dedupe_images
+        """
+        if self.hash_pool is not None and initial_images:
+            try:
+                self.group_duplicates(initial_images)
+            except Exception:
+                log.exception('Error hashing images found at startup')
+        while True:
+            sleep(self.check_interval)
+            try:
+                self.check_for_new_images()
+            except Exception:  # keep watching; directories may be pruned
+                log.exception('Error scanning image directories')
+
+    def check_for_new_images(self):
+        """ scan directories that are new or changed since the last check
+
+        Returns:
+            new_images (list): ImageFiles added to the catalog, oldest first
+        """
+        new_images = []
+        removed = False
+        pending = [str(self.image_dir)]
+        seen_dirs = set()
+        while pending:  # walk the directory tree; it is only a few levels deep
+            directory = pending.pop()
+            seen_dirs.add(directory)
+            try:
+                mtime = os.stat(directory).st_mtime
+            except FileNotFoundError:
+                continue
+            if self.dir_mtimes.get(directory) == mtime:  # no files added
+                pending.extend(self.dir_subdirs[directory])  # or removed
+                continue
+            names = set()
+            subdirs = []
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        subdirs.append(entry.path)
+                    elif entry.name.endswith('.jpg'):
+                        names.add(entry.name)
+            pending.extend(subdirs)
+            self.dir_subdirs[directory] = subdirs
+            self.dir_mtimes[directory] = mtime
+            old_names = self.dir_files.get(directory, set())
+            if old_names - names:
+                removed = True
+            for name in names - old_names:
+                parsed = parse_image_name(name)
+                if parsed:
+                    node, when = parsed
+                    new_images.append(ImageFile(when, node,
+                                                os.path.join(directory, name)))
+            self.dir_files[directory] = names
+        for directory in set(self.dir_files) - seen_dirs:  # pruned directories
+            del self.dir_files[directory]
+            self.dir_mtimes.pop(directory, None)
+            self.dir_subdirs.pop(directory, None)
+            removed = True
+        self.add_images(new_images)
+        if removed:
+            self.rebuild()
+        new_images.sort()
+        if self.hash_pool is not None and new_images:
+            self.group_duplicates(new_images)
+        for listener in self.image_listeners:
+            for image in new_images:
+                try:
+                    listener(image)
+                except Exception:  # keep watching for images
+                    log.exception('Error in ImageCatalog image listener')
+        return new_images
+
+    def add_images(self, images):
+        by_node = {}
+        for image in images:
+            by_node.setdefault(image.node, []).append((image.when, image.path))
+        with self.lock:
+            for node, pairs in by_node.items():
+                self.by_node.setdefault(node, TimeIndex()).extend(pairs)
+
+    def rebuild(self):
+        """ rebuild the node indexes after image files or directories are removed
+        """
+        images = []
+        for directory, names in self.dir_files.items():
+            for name in names:
+                parsed = parse_image_name(name)
+                if parsed:
+                    images.append(ImageFile(parsed[1], parsed[0],
+                                            os.path.join(directory, name)))
+        paths = set(image.path for image in images)
+        with self.lock:
+            self.by_node = {}
+            self.add_images(images)
+            self.duplicate_of = {path: head for path, head
+                                 in self.duplicate_of.items() if path in paths}
+
+    @staticmethod
+    def image_hash(path):
+        """ return the 64 bit difference hash (dHash) of an image, or None
+
+        The image is decoded at 1/8 size in grayscale, which is much faster
+        than a full decode, and shrunk to 9x8 pixels. Each bit of the hash is
+        whether a pixel is brighter than its left neighbor.
+        """
+        import cv2
+        import numpy as np
+        image = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if image is None:
+            return None
+        small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+        bits = np.packbits(small[:, 1:] > small[:, :-1])
+        return int.from_bytes(bits.tobytes(), 'big')
+
+    def group_duplicates(self, images):
+        """ hash new images and group each one with its near-duplicates
+
+        Parameters:
+            images (list): new ImageFiles, oldest first
+        """
+        hashes = self.hash_pool.map(self.image_hash,
+                                    [image.path for image in images])
+        with self.lock:
+            for image, dhash in zip(images, hashes):
+                if dhash is None:  # image could not be read
+                    continue
+                head = self.group_heads.get(image.node, None)
+                if (head is not None and image.when - head[2] <= self.max_gap
+                        and bin(dhash ^ head[1]).count('1') <= self.max_distance):
+                    self.duplicate_of[image.path] = head[0]
+                    self.group_heads[image.node] = (head[0], head[1], image.when)
+                else:  # image starts a new group
+                    self.group_heads[image.node] = (image.path, dhash, image.when)
+
+    def is_duplicate(self, path):
+        """ return True if an image is a near-duplicate of an earlier frame
+        """
+        with self.lock:
+            return path in self.duplicate_of
+
+    def unique(self, paths):
+        """ return the image paths that are not near-duplicates, in order
+        """
+        with self.lock:
+            return [path for path in paths if path not in self.duplicate_of]
+
+    def image_count(self):
+        with self.lock:
+            return sum(len(index) for index in self.by_node.values())
+
+    def nodes(self):
+        """ return the normalized names of all nodes that have images
+        """
+        with self.lock:
+            return set(self.by_node)
+
+    def latest(self, node, before=None):
+        """ return the newest ImageFile from a node, or None
+
+        Parameters:
+            node (str): node name, e.g. 'Barn' or 'Driveway Mailbox'
+            before (datetime): newest at or before this datetime, if given
+        """
+        node = normalize_node(node)
+        with self.lock:
+            index = self.by_node.get(node, None)
+            if index is None or not len(index):
+                return None
+            if before is None:
+                i = len(index)
+            else:
+                i = index.bisect(before)
+            if not i:
+                return None
+            return ImageFile(index.times[i - 1], node, index.items[i - 1])
+
+    def between(self, node, start, end):
+        """ return ImageFiles from a node from start through end, oldest first
+        """
+        node = normalize_node(node)
+        with self.lock:
+            index = self.by_node.get(node, None)
+            if index is None:
+                return []
+            i, j = index.bisect(start, left=True), index.bisect(end)
+            return [ImageFile(when, node, path) for when, path
+                    in zip(index.times[i:j], index.items[i:j])]
 
 class ImageReader:
     """ Methods and attributes to read images
@@ -28,16 +335,637 @@ class ImageReader:
     def fetch_images():
         pass
 
-class ImageSkills:
-    """ Methods and attributes to process images, e.g. detect_objects
+class MotionBurst:
+    """ A motion event and the burst of images an imagenode sent with it
 
     Parameters:
-        event_q (deque): queue for holding newly added imagehub log lines
+        node (str): normalized node name, e.g. 'driveway mailbox'
+        when (datetime): datetime of the 'moving' event
+    """
+    def __init__(self, node, when):
+        self.node = node
+        self.when = when
+        self.end = None  # datetime of the next event from the node, e.g. 'still'
+        self.images = []  # image paths, oldest first
+
+    def add_image(self, image):
+        if image.path not in self.images:
+            self.images.append(image.path)
+            self.images.sort()  # names sort by time within a node
+
+class EventImages:
+    """ Methods and attributes to link motion events to their images
+
+    When an imagenode detects motion, it sends a 'moving' event and a burst of
+    images; the images are written a few milliseconds after the event line,
+    often just after the following 'still' event. EventImages joins the event
+    stream from HubData with the new images from ImageCatalog by node name and
+    time window, so each motion event carries its image paths as soon as both
+    have arrived, without a directory search at query time.
 
+    An image belongs to the most recent motion burst of its node that started
+    at most lead seconds after the image and did not end more than tail
+    seconds before it. A burst with no end yet is open for max_seconds.
+
+    Each time images are linked to a burst, whether the image or the event
+    line was read first, the functions in burst_listeners are called with the
+    burst (e.g. to make its preview).
+
+    Parameters:
+        hub_data (HubData): event data; the events already loaded are linked
+        catalog (ImageCatalog): images indexed by node and time
     """
-    def __init__(self, skill):
-        self.skill = skill
-        pass
+    lead = timedelta(seconds=1)  # images may be a little before the event
+    tail = timedelta(seconds=2)  # ...and a little after the 'still' event
+    max_burst = timedelta(seconds=60)  # longest burst with no ending event
 
-    def read_digits():
-        pass
+    def __init__(self, hub_data, catalog):
+        self.catalog = catalog
+        self.bursts = {}  # normalized node name -> TimeIndex of MotionBursts
+        self.burst_listeners = []  # functions called with each changed burst
+        self.lock = threading.RLock()
+        with hub_data.event_data_lock:  # link the events already loaded
+            events = [(node, when, value)
+                      for node, node_events in hub_data.event_data.items()
+                      for when, value in reversed(node_events.get('motion', ()))]
+        for node, when, value in events:
+            self.add_event(node, when, value)
+        hub_data.event_listeners.append(self.record_event)
+        catalog.image_listeners.append(self.record_image)
+
+    def record_event(self, node_tuple):
+        """ HubData event listener; node_tuple is (node, event, when, value)
+        """
+        if node_tuple[1].strip().lower() == 'motion':
+            self.add_event(node_tuple[0], node_tuple[2],
+                           node_tuple[3].strip().lower())
+
+    def add_event(self, node, when, value):
+        node = normalize_node(node)
+        changed = []
+        with self.lock:
+            index = self.bursts.setdefault(node, TimeIndex())
+            last = index.latest()
+            if last is not None and last.end is None and last.when <= when:
+                last.end = when  # any later event ends the open burst
+            if value == 'moving':
+                burst = MotionBurst(node, when)
+                index.add(when, burst)
+                if self.fill(burst):  # images indexed before the event line
+                    changed.append(burst)
+            if last is not None:  # its window was shortened or overlapped
+                if self.fill(last):
+                    changed.append(last)
+        self.notify(changed)
+
+    def fill(self, burst):
+        """ set the images of a burst from the images already in the catalog
+
+        Returns:
+            True if images were linked and the burst's images changed
+        """
+        end = burst.end if burst.end is not None else burst.when + self.max_burst
+        images = self.catalog.between(burst.node, burst.when - self.lead,
+                                      end + self.tail)
+        paths = [image.path for image in images
+                 if self.burst_for(burst.node, image.when) is burst]
+        changed = paths != burst.images
+        burst.images = paths
+        return changed and bool(paths)
+
+    def record_image(self, image):
+        """ ImageCatalog image listener; adds a new image to its motion burst
+        """
+        with self.lock:
+            burst = self.burst_for(image.node, image.when)
+            if burst is not None:
+                burst.add_image(image)
+        if burst is not None:
+            self.notify([burst])
+
+    def notify(self, bursts):
+        """ call the burst_listeners, outside self.lock, for changed bursts
+        """
+        for burst in bursts:
+            for listener in self.burst_listeners:
+                try:
+                    listener(burst)
+                except Exception:  # keep linking events and images
+                    log.exception('Error in EventImages burst listener')
+
+    def burst_for(self, node, when):
+        """ return the MotionBurst an image taken at 'when' belongs to, or None
+        """
+        index = self.bursts.get(node, None)
+        if index is None:
+            return None
+        burst = index.latest(before=when + self.lead)
+        if burst is None:
+            return None
+        end = burst.end if burst.end is not None else burst.when + self.max_burst
+        if when > end + self.tail:
+            return None
+        return burst
+
+    def images_for(self, node, when):
+        """ return the image paths of the motion burst at or before 'when'
+
+        Parameters:
+            node (str): node name, e.g. 'Driveway Mailbox'
+            when (datetime): datetime of the motion event
+
+        Returns:
+            images (list): image paths, oldest first; empty if none
+        """
+        with self.lock:
+            index = self.bursts.get(normalize_node(node), None)
+            burst = index.latest(before=when) if index else None
+            return list(burst.images) if burst else []
+
+    def latest_burst(self, node, with_images=True):
+        """ return the most recent MotionBurst of a node, or None
+
+        Parameters:
+            node (str): node name, e.g. 'Barn'
+            with_images (bool): skip bursts that have no images
+        """
+        with self.lock:
+            index = self.bursts.get(normalize_node(node), None)
+            if index is None:
+                return None
+            for burst in reversed(index.items):
+                if burst.images or not with_images:
+                    return burst
+            return None
+
+    def nodes(self):
+        """ return the normalized names of all nodes with motion events
+        """
+        with self.lock:
+            return set(self.bursts)
+
+class PreviewCache:
+    """ Methods and attributes to make small preview JPEGs of imagehub images
+
+    Full imagehub frames are too large to attach to a text message. A preview
+    is the image shrunk to 'width' pixels wide and encoded again as a JPEG.
+    Previews are stored in a size limited cache directory; a preview file name
+    is a hash of the source image path and modification time, so a changed
+    image gets a new preview. The least recently used previews are removed
+    when the cache is larger than max_bytes. The modification time of each
+    preview file is its last use, so the LRU order survives a restart.
+
+    When EventImages links images to a motion burst (whether the images or
+    the motion event arrived first), the preview of the burst's
+    representative frame is made in a pool of worker threads, so it is ready
+    before anyone asks for it. Without EventImages, each new image that is
+    not a near-duplicate is previewed. OpenCV releases the GIL while it
+    decodes, resizes and encodes, so the workers run in parallel.
+
+    Parameters:
+        settings (Settings object): settings object created from YAML file
+        catalog (ImageCatalog): images whose previews are made as they arrive
+        event_images (EventImages): motion bursts; None to preview each image
+    """
+    def __init__(self, settings, catalog, event_images=None):
+        self.cache_dir = settings.lib_dir / 'previews'
+        self.cache_dir.mkdir(exist_ok=True)
+        self.width = settings.preview_width  # pixels
+        self.quality = 70  # JPEG quality of previews
+        self.max_bytes = int(settings.preview_cache_mb * 1024 * 1024)
+        self.catalog = catalog
+        self.event_images = event_images
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # preview file name -> size, oldest first
+        self.size = 0  # total bytes of preview files
+        self.pending = set()  # preview file names waiting for a worker
+        entries = []
+        with os.scandir(self.cache_dir) as files:
+            for entry in files:
+                if entry.name.endswith('.jpg'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for mtime, name, size in sorted(entries):
+            self.entries[name] = size
+            self.size += size
+        self.made = metrics.counter('librarian_previews_made_total',
+                                    'Number of preview images made')
+        self.hits = metrics.counter('librarian_preview_hits_total',
+                                    'Number of previews found in cache')
+        metrics.gauge('librarian_preview_cache_bytes', 'Bytes of preview ' +
+            'images in cache', function=lambda: self.size)
+        self.pool = ThreadPoolExecutor(max_workers=settings.preview_workers,
+                                       thread_name_prefix='preview worker')
+        if event_images is not None:  # images not in a burst are not previewed
+            event_images.burst_listeners.append(self.record_burst)
+        else:
+            catalog.image_listeners.append(self.record_image)
+
+    def record_burst(self, burst):
+        """ EventImages burst listener; previews the burst's images so far
+        """
+        with self.event_images.lock:
+            path = self.representative(burst) if burst.images else None
+        if path is not None:
+            self.submit(path)
+
+    def record_image(self, image):
+        """ ImageCatalog image listener; previews each image as it arrives
+        """
+        if self.catalog.is_duplicate(image.path):  # its group has a preview
+            return
+        self.submit(image.path)
+
+    def submit(self, path):
+        """ make the preview of an image in a worker thread, if not cached
+        """
+        try:
+            name = self.preview_name(path)
+        except FileNotFoundError:  # image was pruned before it was previewed
+            return
+        with self.lock:
+            if name in self.entries or name in self.pending:
+                return
+            self.pending.add(name)
+        self.pool.submit(self.make_preview, path, name)
+
+    def representative(self, burst):
+        """ return the image path that best represents a motion burst
+
+        The frames of a burst are nearly identical, so one preview is enough;
+        the middle frame is usually the one with the moving object in view.
+        Near-duplicate frames are skipped when choosing the middle frame.
+        """
+        images = self.catalog.unique(burst.images) or burst.images
+        return images[len(images) // 2]
+
+    @staticmethod
+    def preview_name(path):
+        stat = os.stat(path)
+        key = '{0}|{1}'.format(path, stat.st_mtime_ns)
+        return hashlib.sha1(key.encode()).hexdigest() + '.jpg'
+
+    def preview(self, path):
+        """ return the path of the preview of an image, making it if needed
+
+        Parameters:
+            path (str): path of an imagehub image
+
+        Returns:
+            preview (Path): path of the preview JPEG, or None if the image
+                could not be read
+        """
+        try:
+            name = self.preview_name(path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                self.hits.inc()
+                touch = True
+            else:
+                touch = False
+        if touch:
+            try:
+                os.utime(self.cache_dir / name)  # LRU order survives restart
+                return self.cache_dir / name
+            except FileNotFoundError:  # removed from the directory by hand
+                with self.lock:
+                    self.size -= self.entries.pop(name, 0)
+        return self.make_preview(path, name)
+
+    def burst_preview(self, burst):
+        """ return the preview path of a MotionBurst's representative frame
+        """
+        if not burst.images:
+            return None
+        return self.preview(self.representative(burst))
+
+    def make_preview(self, path, name):
+        """ shrink an image, encode it as a JPEG and add it to the cache
+        """
+        import cv2  # OpenCV is only needed if previews are made
+        try:
+            image = cv2.imread(str(path))
+            if image is None:
+                log.warning('Could not read image for preview: ' + str(path))
+                return None
+            height, width = image.shape[:2]
+            if width > self.width:
+                image = cv2.resize(image, (self.width, height * self.width // width),
+                                   interpolation=cv2.INTER_AREA)
+            ok, jpg = cv2.imencode('.jpg', image,
+                                   [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+            if not ok:
+                log.warning('Could not encode preview of ' + str(path))
+                return None
+            preview = self.cache_dir / name
+            partial = self.cache_dir / (name + '.part')
+            partial.write_bytes(jpg.tobytes())
+            os.replace(partial, preview)  # readers never see a partial file
+            self.made.inc()
+            with self.lock:
+                self.size += len(jpg) - self.entries.pop(name, 0)
+                self.entries[name] = len(jpg)
+                self.evict()
+            return preview
+        except Exception:  # a worker thread must keep running
+            log.exception('Error making preview of ' + str(path))
+            return None
+        finally:
+            with self.lock:
+                self.pending.discard(name)
+
+    def evict(self):
+        # called with self.lock held; the newest preview is always kept
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.cache_dir / name)
+            except FileNotFoundError:
+                pass
+
+class WaterMeter:
+    """ Image skill that detects water flow from bursts of water meter images
+
+    When the water starts or stops flowing, the WaterMeter imagenode sends a
+    burst of images of the meter. The needle spins when water flows. Like the
+    imagenode's own motion detector, this skill crops each frame to a region
+    of interest (ROI) around the needle, converts it to grayscale, thresholds
+    it so the dark needle is white, dilates it and differences each pair of
+    consecutive frames. Every step works on the whole burst as one NumPy
+    array, with no Python loop over frames, so one core keeps up with the
+    16 frames per second a node can send.
+
+    For each batch of frames it returns one Detection labeled 'water flowing'
+    or 'water off'; its confidence is the fraction of frame pairs that agree.
+    The flow estimate of each frame pair is the fraction of ROI pixels that
+    changed per second, which grows with the speed of the needle. Estimates
+    are loaded into HubData as the event series 'WaterMeter|water_flow'
+    (node|water_flow), so they can be queried, are downsampled and are
+    limited by their retention policy like any other numeric series.
+
+    Parameters:
+        options (dict): options from the image_skills section of yaml file:
+            node: node name of the water meter imagenode (default WaterMeter)
+            roi: [x1, y1, x2, y2] pixel box around the needle (default all)
+            threshold: gray level; darker pixels are the needle (default 100)
+            min_changed: fraction of ROI pixels changed between two frames
+                for the needle to be moving (default 0.01)
+        hub_data (HubData): stores the flow estimates; None to not store them
+    """
+    name = 'water_meter'
+    every_frame = True  # slow needle motion looks like near-duplicate frames
+    max_pair_gap = 2.0  # seconds; farther apart frames are not differenced
+
+    def __init__(self, options, hub_data=None):
+        self.node = options.get('node', 'WaterMeter')
+        self.nodes = {normalize_node(self.node)}
+        self.hub_data = hub_data
+        self.roi = options.get('roi', None)
+        self.threshold = options.get('threshold', 100)
+        self.min_changed = options.get('min_changed', 0.01)
+        self.latest = 0.0  # newest flow estimate, changed per second
+        self.last = None  # (when, needle mask) of the last frame processed
+        metrics.gauge('librarian_water_flow', 'Latest water meter needle ' +
+            'motion estimate', function=lambda: self.latest)
+
+    def needle_masks(self, frames):
+        """ return the thresholded and dilated needle masks of a frame stack
+
+        Parameters:
+            frames (array): frames, shape (n, height, width, 3), BGR
+
+        Returns:
+            masks (array): bool array, shape (n, roi height, roi width)
+        """
+        import numpy as np
+        if self.roi:
+            x1, y1, x2, y2 = self.roi
+            frames = frames[:, y1:y2, x1:x2]  # a view; nothing is copied
+        gray = frames.dot(np.array([0.114, 0.587, 0.299], dtype=np.float32))
+        masks = gray < self.threshold  # the needle is dark on a light dial
+        dilated = masks.copy()  # 3x3 dilation by OR of shifted masks
+        dilated[:, 1:] |= masks[:, :-1]
+        dilated[:, :-1] |= masks[:, 1:]
+        rows = dilated.copy()
+        dilated[:, :, 1:] |= rows[:, :, :-1]
+        dilated[:, :, :-1] |= rows[:, :, 1:]
+        return dilated
+
+    def process(self, node, images, frames):
+        """ detect whether water is flowing in a batch of water meter frames
+        """
+        import numpy as np
+        masks = self.needle_masks(frames)
+        seconds = np.array([(image.when - images[0].when).total_seconds()
+                            for image in images])
+        if self.last is not None:  # difference across the batch boundary too
+            gap = (images[0].when - self.last[0]).total_seconds()
+            if (0 < gap <= self.max_pair_gap and
+                    self.last[1].shape == masks.shape[1:]):
+                masks = np.concatenate([self.last[1][np.newaxis], masks])
+                seconds = np.concatenate([[-gap], seconds])
+        self.last = (images[-1].when, masks[-1])
+        if len(masks) < 2:
+            return None
+        changed = (masks[1:] ^ masks[:-1]).mean(axis=(1, 2))
+        intervals = np.diff(seconds)
+        close = (intervals > 0) & (intervals <= self.max_pair_gap)
+        if not close.any():
+            return None
+        changed, intervals = changed[close], intervals[close]
+        moving = changed > self.min_changed
+        pair_times = seconds[1:][close]
+        estimates = changed / intervals
+        self.latest = float(estimates[-1])
+        if self.hub_data is not None:  # ingested like new event log lines
+            self.hub_data.record_events([(self.node, 'water_flow',
+                images[0].when + timedelta(seconds=float(offset)),
+                str(float(estimate)))
+                for offset, estimate in zip(pair_times, estimates)])
+        flowing = moving.mean() >= 0.5
+        confidence = float(moving.mean() if flowing else 1 - moving.mean())
+        return [Detection(images[0].when, node,
+                          'water flowing' if flowing else 'water off',
+                          confidence, images[len(images) // 2].path,
+                          tuple(self.roi) if self.roi else None)]
+
+# Image skills by the name used in the image_skills section of the yaml file.
+# A skill is a class whose instances are made from their options dict and the
+# HubData that stores the values they measure (or None). Each has a name, a
+# nodes attribute (set of normalized node names it reads, or None for all
+# nodes), an every_frame attribute (True to also read near-duplicate frames)
+# and a process(node, images, frames) method. frames is a NumPy array of same
+# size frames stacked on a new first axis, one per ImageFile in images;
+# process() returns a list of Detections (or None).
+SKILLS = {'water_meter': WaterMeter}
+
+def decode_image(path):
+    """ decode an image file; runs in an ImageSkills decode worker process
+    """
+    import cv2
+    return cv2.imread(path)
+
+class ImageSkills:
+    """ Methods and attributes to run image skills on new images in batches
+
+    New images from the ImageCatalog are put into a bounded queue.
+    Near-duplicate frames are queued only for skills with every_frame set,
+    like WaterMeter, which differences consecutive frames; other skills never
+    see them. A pipeline thread takes up to batch_size images at a time from
+    the queue and decodes them in a pool of worker processes, so decoding runs
+    on all the cores instead of waiting on the GIL. Decoded frames from the
+    same node with the same size are stacked into one NumPy array, and each
+    skill that reads that node processes the whole batch at once. The next
+    batch is decoded while the skills process the current one. The Detections
+    the skills return are saved in the DetectionStore.
+
+    Memory use is bounded: at most image_queue paths are waiting and at most
+    two batches of frames are decoded. If the skills fall behind, new images
+    are dropped (and counted) rather than blocking the ImageCatalog.
+
+    Parameters:
+        settings (Settings object): settings object created from YAML file
+        catalog (ImageCatalog): images whose skills run as they arrive
+        detections (DetectionStore): saves the Detections skills return;
+            None to only count them
+        hub_data (HubData): stores the values skills measure, like water flow;
+            None to not store them
+    """
+    batch_size = 16  # most images decoded and processed together
+    batch_wait = 0.5  # seconds to wait for more images to fill a batch
+
+    def __init__(self, settings, catalog, detections=None, hub_data=None):
+        self.catalog = catalog
+        self.detections = detections
+        self.skills = []
+        for name, options in settings.image_skills.items():
+            if name not in SKILLS:
+                raise YamlOptionsError('Unknown image skill in YAML file: ' + name)
+            self.add_skill(SKILLS[name](options or {}, hub_data))
+        self.image_q = Queue(maxsize=settings.image_queue)
+        workers = settings.image_workers or max(1, (os.cpu_count() or 2) - 1)
+        # spawned workers do not inherit the locks of the librarian's threads
+        self.pool = ProcessPoolExecutor(max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'))
+        self.processed = metrics.counter('librarian_images_processed_total',
+            'Images decoded and processed by image skills')
+        self.dropped = metrics.counter('librarian_images_dropped_total',
+            'New images dropped because the image skills queue was full')
+        self.found = metrics.counter('librarian_skill_detections_total',
+            'Detections returned by image skills')
+        metrics.gauge('librarian_image_queue_depth', 'Images waiting for ' +
+            'image skills', function=self.image_q.qsize)
+        catalog.image_listeners.append(self.record_image)
+        t = threading.Thread(target=self.run_pipeline)
+        t.daemon = True  # allows this thread to be auto-killed on program exit
+        t.name = 'image_skills_pipeline'  # naming the thread helps with debugging
+        t.start()
+
+    def add_skill(self, skill):
+        """ add a skill to run on new images; see SKILLS for what a skill is
+        """
+        self.skills.append(skill)
+
+    @staticmethod
+    def reads(skill, node, duplicate):
+        """ return True if a skill reads an image from node
+
+        Parameters:
+            duplicate (bool): True if the image is a near-duplicate frame
+        """
+        return ((skill.nodes is None or node in skill.nodes) and
+                (not duplicate or skill.every_frame))
+
+    def record_image(self, image):
+        """ ImageCatalog image listener; queues a new image for the skills
+        """
+        duplicate = self.catalog.is_duplicate(image.path)
+        if not any(self.reads(skill, image.node, duplicate)
+                   for skill in self.skills):
+            return
+        try:
+            self.image_q.put_nowait(image)
+        except Full:  # never block the ImageCatalog watcher thread
+            self.dropped.inc()
+
+    def next_batch(self):
+        """ wait for an image, then return up to batch_size queued images
+        """
+        images = [self.image_q.get()]
+        deadline = time() + self.batch_wait
+        while len(images) < self.batch_size:
+            timeout = deadline - time()
+            if timeout <= 0:
+                break
+            try:
+                images.append(self.image_q.get(timeout=timeout))
+            except Empty:
+                break
+        return images
+
+    def run_pipeline(self):
+        """ run_pipeline: thread to decode batches of images and run the skills
+        """
+        pending = None  # (images, decode futures) of the batch being decoded
+        while True:
+            try:
+                if pending is None or not self.image_q.empty():
+                    images = self.next_batch()
+                    futures = [self.pool.submit(decode_image, image.path)
+                               for image in images]
+                    current, pending = pending, (images, futures)
+                else:  # no more images waiting; finish the decoded batch
+                    current, pending = pending, None
+                if current is not None:
+                    self.run_skills(*current)
+            except Exception:  # keep processing images
+                log.exception('Error in image skills pipeline')
+
+    def run_skills(self, images, futures):
+        """ stack the decoded frames of a batch and run the skills on them
+
+        Parameters:
+            images (list): ImageFiles of the batch
+            futures (list): futures of the decoded frames, one per image
+        """
+        import numpy as np
+        batches = {}  # (node, frame shape) -> list of (ImageFile, frame)
+        for image, future in zip(images, futures):
+            try:
+                frame = future.result()
+            except Exception:
+                log.exception('Error decoding ' + image.path)
+                continue
+            if frame is None:  # pruned, or not completely written
+                log.warning('Could not decode image ' + image.path)
+                continue
+            batches.setdefault((image.node, frame.shape), []).append((image, frame))
+        detections = []
+        for (node, shape), batch in batches.items():
+            batch_images = [image for image, frame in batch]
+            frames = np.stack([frame for image, frame in batch])
+            unique = [i for i, image in enumerate(batch_images)
+                      if not self.catalog.is_duplicate(image.path)]
+            for skill in self.skills:
+                if skill.nodes is not None and node not in skill.nodes:
+                    continue
+                skill_images, skill_frames = batch_images, frames
+                if not skill.every_frame and len(unique) < len(batch_images):
+                    if not unique:
+                        continue
+                    skill_images = [batch_images[i] for i in unique]
+                    skill_frames = frames[unique]
+                try:
+                    detections.extend(skill.process(node, skill_images,
+                                                    skill_frames) or [])
+                except Exception:  # one failing skill must not stop the others
+                    log.exception('Error in image skill ' + skill.name)
+            self.processed.inc(len(batch))
+        if detections:
+            self.found.inc(len(detections))
+            if self.detections is not None:
+                self.detections.record_detections(detections)
@@ -9,25 +9,22 @@ License: MIT, see LICENSE for more details.
 """
 
 import os
-import cv2
 import sys
 import yaml
 import pprint
 import signal
-import imutils
 import logging
-import imagezmq
-import itertools
 import threading
-import numpy as np
 from time import sleep
 from pathlib import Path
-from ast import literal_eval
-from imutils.video import VideoStream
+from helpers.alerts import AlertRules
 from helpers.schedules import Schedule
-from helpers.data_tools import HubData
-from helpers.utils import YamlOptionsError
+from helpers.data_tools import HubData, DetectionStore
+from helpers.utils import YamlOptionsError, startup_profiler
+from helpers.metrics import metrics
 from helpers.nodehealth import HealthMonitor
+from helpers.image_skills import ImageCatalog, EventImages, PreviewCache
+from helpers.image_skills import ImageSkills
 from helpers.comms.communications import CommChannel
 from helpers.comms.chatbot import ChatBot, Conversation
 
@@ -52,27 +49,172 @@ class Librarian:
 
     def __init__(self, settings):
         self.log = logging.getLogger()
-        # check that numpy and OpenCV are OK
-        self.tiny_image = np.zeros((3,3), dtype="uint8")  # tiny blank image
-        ret_code, jpg_buffer = cv2.imencode(
-            ".jpg", self.tiny_image, [int(cv2.IMWRITE_JPEG_QUALITY), 95])
-
-        self.health = HealthMonitor(settings)  # health check (RPi vs Mac etc.)
+        # heavy modules (OpenCV, numpy, Google APIs) are imported only by the
+        # subsystems that need them, when they are enabled in the yaml file
+        with startup_profiler.timing('HealthMonitor'):
+            self.health = HealthMonitor(settings)  # health check (RPi vs Mac etc.)
+        # Independent subsystems are initialized concurrently, each in its own
+        # thread; a subsystem thread first waits for the subsystems it needs.
+        self.ready = {}  # subsystem name -> threading.Event set when ready
+        self.init_errors = {}  # subsystem name -> exception raised by init
+        self.reload_pending = False  # yaml reload waiting for all subsystems
+        self.comm_channels = []  # each channel is appended when it is ready
+        self.comm_channels_lock = threading.Lock()
         if settings.comm_channels:  # need at least one comm channel in yaml file
             self.setup_comm_channels(settings)
         else:
             raise YamlOptionsError('No comm channels specified in YAML file.')
-        self.hub_data = HubData(settings) # imgagehub data class
-        self.chatbot = ChatBot(data=self.hub_data)  # conversation methods
-        gmail = None
-        for channel in self.comm_channels:
-            if channel.name == 'Gmail':
-                gmail = channel.gmail
-                # print('Set gmail object.')
-        self.schedule = Schedule(settings, gmail)  # start doing scheduled tasks
+
+        def init_hub_data():
+            self.hub_data = HubData(settings) # imgagehub data class
+            liveness = self.health.liveness  # learns when nodes go silent
+            liveness.learn(self.hub_data.event_data, self.hub_data.event_data_lock)
+            self.hub_data.event_listeners.append(liveness.record)
+
+        self.detections = None  # DetectionStore, if detections_directory set
+        self.images = None  # ImageCatalog, if there is an image directory
+        self.event_images = None  # EventImages, links motion events to images
+        self.previews = None  # PreviewCache, small JPEGs of motion bursts
+        self.image_skills = None  # ImageSkills, if image_skills are in yaml
+
+        def init_detections():
+            self.detections = DetectionStore(settings)  # detected objects
+
+        def init_images():
+            self.images = ImageCatalog(settings)  # imagehub images by node
+
+        def init_event_images():
+            self.event_images = EventImages(self.hub_data, self.images)
+
+        def init_previews():
+            self.previews = PreviewCache(settings, self.images, self.event_images)
+
+        def init_image_skills():
+            self.image_skills = ImageSkills(settings, self.images, self.detections,
+                                            self.hub_data)
+
+        def init_chatbot():  # stores still loading are attached when ready
+            loading = []
+            if settings.image_directory:
+                loading.append('event_images')
+            if settings.detections_directory:
+                loading.append('detections')
+            self.chatbot = ChatBot(data=self.hub_data,  # conversation methods
+                                   loading=loading)
+
+        def init_schedule():
+            self.schedule = Schedule(settings, self.gmail())  # scheduled tasks
+
+        def init_alerts():  # check every new event; send once Gmail is ready
+            self.alerts = AlertRules(settings, self.wait_for_gmail)
+            self.hub_data.event_listeners.append(self.alerts.check_event)
+
+        self.start_subsystem('HubData', init_hub_data)
+        # queries are answered as soon as HubData is loaded; the image and
+        # detection stores are attached to the ChatBot as each one is ready
+        self.start_subsystem('ChatBot', init_chatbot, after=['HubData'])
+        if settings.image_directory:
+            self.start_subsystem('ImageCatalog', init_images)
+            self.start_subsystem('EventImages', init_event_images,
+                                 after=['HubData', 'ImageCatalog'])
+            if settings.preview_cache_mb:
+                self.start_subsystem('PreviewCache', init_previews,
+                                     after=['EventImages'])
+                self.start_subsystem('ChatBot previews',
+                    lambda: self.chatbot.attach(previews=self.previews),
+                    after=['ChatBot', 'PreviewCache'])
+            self.start_subsystem('ChatBot event_images',
+                lambda: self.chatbot.attach(event_images=self.event_images),
+                after=['ChatBot', 'EventImages'])
+        if settings.detections_directory:
+            self.start_subsystem('DetectionStore', init_detections)
+            self.start_subsystem('ChatBot detections',
+                lambda: self.chatbot.attach(detections=self.detections),
+                after=['ChatBot', 'DetectionStore'])
+        if settings.image_skills and settings.image_directory:
+            skills_after = ['ImageCatalog', 'HubData']
+            if settings.detections_directory:
+                skills_after.append('DetectionStore')
+            self.start_subsystem('ImageSkills', init_image_skills,
+                                 after=skills_after)
+        self.start_subsystem('Schedule', init_schedule,
+                             after=self.gmail_channel_names)
+        self.start_subsystem('AlertRules', init_alerts, after=['HubData'])
+        if settings.metrics_port:  # serve metrics in Prometheus text format
+            metrics.start_http_server(settings.metrics_port)
         if settings.print:
             self.print_details(settings)
 
+    def start_subsystem(self, name, init, after=()):
+        """ Initialize a subsystem in its own thread after its dependencies
+
+        Sets self.ready[name] when init has finished. If init raises an
+        exception, it is saved in self.init_errors and raised again by
+        wait_until_ready() or check_subsystems() in the main thread.
+
+        Parameters:
+            name (str): name of the subsystem, e.g. 'HubData'
+            init (function): function that initializes the subsystem
+            after (list): names of subsystems that must be ready first
+        """
+        self.ready[name] = threading.Event()
+
+        def init_thread():
+            try:
+                for dependency in after:
+                    self.wait_until_ready(dependency)
+                with startup_profiler.timing(name):
+                    init()
+            except BaseException as ex:  # raised again in the main thread
+                self.init_errors[name] = ex
+            finally:
+                self.ready[name].set()
+
+        t = threading.Thread(target=init_thread)
+        t.daemon = True  # allows this thread to be auto-killed on program exit
+        t.name = 'Init ' + name  # naming the thread helps with debugging
+        t.start()
+
+    def wait_until_ready(self, name=None):
+        """ Block until a subsystem is ready, or all of them if name is None
+
+        Parameters:
+            name (str): name of the subsystem to wait for, or None for all
+        """
+        names = [name] if name else list(self.ready)
+        for name in names:
+            self.ready[name].wait()
+            if name in self.init_errors:
+                raise self.init_errors[name]
+
+    def check_subsystems(self):
+        """ Raise the exception of any subsystem whose initialization failed
+
+        Returns:
+            True if every subsystem is ready; False if some are still starting
+        """
+        for ex in list(self.init_errors.values()):
+            raise ex
+        return all(ready.is_set() for ready in self.ready.values())
+
+    def gmail(self):
+        """ Return the Gmail object of the Gmail channel, or None if no channel
+        """
+        for channel in self.comm_channels:
+            if channel.name == 'Gmail':
+                return channel.gmail
+        return None
+
+    def wait_for_gmail(self):
+        """ Block until the Gmail channel has started; return its Gmail object
+
+        Returns None if there is no Gmail channel or if it failed to start; a
+        failure is raised in the main thread by check_subsystems().
+        """
+        for name in self.gmail_channel_names:
+            self.ready[name].wait()
+        return self.gmail()
+
     def setup_comm_channels(self, settings):
         """ Create a list of channels from comm_channels section of YAML file
 
@@ -81,15 +223,31 @@ class Librarian:
         run a thread or a subprocess, etc.
 
         settings.comm_channels is a dictionary from comm_channels section of
-        the YAML file.
+        the YAML file. Each channel is set up in its own thread, so that a slow
+        channel (like Gmail, which starts the Gmail service) does not delay the
+        others. Each channel is added to self.comm_channels when it is ready.
 
         Parameters:
             settings (Settings object): settings object created from YAML file
+
+        Returns:
+            channel_names (list): subsystem names of all the channels
         """
-        self.comm_channels = []
+        channel_names = []
+        self.gmail_channel_names = []  # subsystem names of Gmail channels
         for channel_type, details in settings.comm_channels.items():
-            channel = CommChannel(settings, channel_type, details)
-            self.comm_channels.append(channel)
+            name = 'CommChannel ' + channel_type
+            if channel_type.lower().strip() == 'gmail':
+                self.gmail_channel_names.append(name)
+
+            def init_channel(channel_type=channel_type, details=details):
+                channel = CommChannel(settings, channel_type, details)
+                with self.comm_channels_lock:
+                    self.comm_channels.append(channel)
+
+            self.start_subsystem(name, init_channel)
+            channel_names.append(name)
+        return channel_names
 
     def print_details(self, settings):
         print('Librarian details:')
@@ -97,17 +255,93 @@ class Librarian:
         print('  System Type:', self.health.sys_type)
         print()
 
-    def compose_reply(self, request):
+    def compose_reply(self, request, channel_name=None):
+        """ Compose a reply to a request received on a comm channel
+
+        The CLI channel also answers the "status" command with a report of
+        the librarian metrics (queue depths, latencies, lines read, etc.).
+
+        Parameters:
+            request (str): the incoming request
+            channel_name (str): name of the channel, e.g. 'CLI' or 'Gmail'
+
+        Returns:
+            reply (str): the composed response to the request
+        """
+        if channel_name == 'CLI' and request.strip().lower() == 'status':
+            return metrics.status_text()
         reply = self.chatbot.respond_to(request)
         return reply
 
+    def reload_settings(self, settings):
+        """ Reload the YAML file and reapply only the settings that changed
+
+        Threads, communications links and in memory data such as the event
+        data in HubData keep running. Reminders are rescheduled, alert rules
+        and contact lists are reloaded and polling intervals are adjusted.
+        Settings that can only take effect at startup (such as ports and data
+        directories) are logged as needing a restart.
+
+        Every subsystem must exist to be changed, so the main loop calls this
+        only when check_subsystems() reports that all of them are ready; it
+        does not wait here, so queries are answered while subsystems start.
+
+        Parameters:
+            settings (Settings object): the settings currently in use
+
+        Returns:
+            settings (Settings object): the new settings, or the current ones
+                if the YAML file could not be loaded
+        """
+        self.reload_pending = False
+        try:
+            new_settings = Settings()
+        except Exception:
+            self.log.exception('Reload of librarian.yaml failed; no changes made.')
+            return settings
+        changed = settings.changes(new_settings)
+        if 'librarian' in changed:
+            self.hub_data.log_check_interval = new_settings.log_check_interval
+            if self.detections:
+                self.detections.check_interval = new_settings.log_check_interval
+            if self.images:
+                self.images.check_interval = new_settings.log_check_interval
+            self.health.set_patience(new_settings.patience)
+            self.health.liveness.silent_intervals = new_settings.silent_intervals
+            restart_needed = ['name', 'log_directory', 'log_file',
+                              'data_directory', 'heartbeat', 'stall_watcher',
+                              'metrics_port', 'log_archive',
+                              'detections_directory',
+                              'image_directory', 'dedupe_images',
+                              'preview_cache_mb', 'preview_width',
+                              'preview_workers', 'image_workers',
+                              'image_queue']
+            for option in restart_needed:
+                if (settings.config['librarian'].get(option) !=
+                        new_settings.config['librarian'].get(option)):
+                    self.log.warning('Restart librarian to change ' + option)
+        if 'comm_channels' in changed:
+            for channel in self.comm_channels:
+                channel.refresh(new_settings)
+        if 'schedules' in changed:
+            self.schedule.reschedule(new_settings)
+        if 'alerts' in changed:
+            self.alerts.load_rules(new_settings.alerts)
+        if 'retention' in changed:
+            self.hub_data.set_retention(new_settings.retention)
+        if 'image_skills' in changed:
+            self.log.warning('Restart librarian to change image_skills')
+        self.log.warning('Reloaded librarian.yaml; changed sections: ' +
+                         ', '.join(sorted(changed)))
+        return new_settings
+
     def closeall(self, settings):
         """ Close all resources, files and communications channels.
 
         Parameters:
             settings (Settings object): settings object created from YAML file
         """
-        for channel in self.comm_channels:
+        for channel in list(self.comm_channels):
             channel.close()
 
 class Settings:
@@ -129,7 +363,9 @@ class Settings:
 
     def __init__(self):
         userdir = os.path.expanduser("~")
-        with open(os.path.join(userdir,"librarian.yaml")) as f:
+        self.yaml_file = os.path.join(userdir,"librarian.yaml")
+        self.yaml_mtime = os.stat(self.yaml_file).st_mtime
+        with open(self.yaml_file) as f:
             self.config = yaml.safe_load(f)
         self.print_node = False
         if 'librarian' in self.config:
@@ -143,6 +379,9 @@ class Settings:
             self.print_settings('"librarian" is a required settings section but not present.')
             raise KeyboardInterrupt
         self.schedules = self.config.get('schedules', None)
+        self.alerts = self.config.get('alerts', None)
+        self.image_skills = self.config.get('image_skills', None)
+        self.retention = self.config.get('retention', None)
         if 'name' in self.config['librarian']:
             self.librarian_name = self.config['librarian']['name']
         else:
@@ -160,10 +399,26 @@ class Settings:
             self.heartbeat = self.config['librarian']['heartbeat']
         else:
             self.heartbeat = 0
+        if 'silent_intervals' in self.config['librarian']:
+            self.silent_intervals = self.config['librarian']['silent_intervals']
+        else:
+            self.silent_intervals = 3  # expected event intervals until silent
+        if 'metrics_port' in self.config['librarian']:
+            self.metrics_port = self.config['librarian']['metrics_port']
+        else:
+            self.metrics_port = 0  # no metrics HTTP endpoint
         if 'stall_watcher' in self.config['librarian']:
             self.stall_watcher = self.config['librarian']['stall_watcher']
         else:
             self.stall_watcher = False
+        if 'log_check_interval' in self.config['librarian']:
+            self.log_check_interval = self.config['librarian']['log_check_interval']
+        else:
+            self.log_check_interval = 2  # seconds between checks for new log lines
+        if 'reload_on_change' in self.config['librarian']:
+            self.reload_on_change = self.config['librarian']['reload_on_change']
+        else:
+            self.reload_on_change = False
         if 'send_threading' in self.config['librarian']:
             self.send_threading = self.config['librarian']['send_threading']
         else:
@@ -187,11 +442,79 @@ class Settings:
             self.log_file = self.config['librarian']['log_file']
         else:
             raise YamlOptionsError('No log file specified in YAML file.')
+        if 'image_directory' in self.config['librarian']:
+            self.image_directory = self.config['librarian']['image_directory']
+        else:  # imagehub keeps images next to its logs, e.g. imagehub_data/images
+            image_directory = Path(self.log_directory).parent / 'images'
+            self.image_directory = image_directory if image_directory.is_dir() else None
+        if 'detections_directory' in self.config['librarian']:
+            self.detections_directory = self.config['librarian']['detections_directory']
+        else:
+            self.detections_directory = None  # no detected objects files
+        if 'log_archive' in self.config['librarian']:
+            self.log_archive = self.config['librarian']['log_archive']
+        else:
+            self.log_archive = False  # True to archive dated logs for fast loads
+        if 'dedupe_images' in self.config['librarian']:
+            self.dedupe_images = self.config['librarian']['dedupe_images']
+        else:
+            self.dedupe_images = False  # group near-duplicate frames of bursts
+        if 'preview_cache_mb' in self.config['librarian']:
+            self.preview_cache_mb = self.config['librarian']['preview_cache_mb']
+        else:
+            self.preview_cache_mb = 0  # megabytes of preview images; 0 for none
+        if 'preview_width' in self.config['librarian']:
+            self.preview_width = self.config['librarian']['preview_width']
+        else:
+            self.preview_width = 320  # pixels wide
+        if 'preview_workers' in self.config['librarian']:
+            self.preview_workers = self.config['librarian']['preview_workers']
+        else:
+            self.preview_workers = 2  # threads making previews
+        if 'image_workers' in self.config['librarian']:
+            self.image_workers = self.config['librarian']['image_workers']
+        else:
+            self.image_workers = 0  # image decoding processes; 0 for cores - 1
+        if 'image_queue' in self.config['librarian']:
+            self.image_queue = self.config['librarian']['image_queue']
+        else:
+            self.image_queue = 64  # new images waiting for image skills
         if 'comm_channels' in self.config:
             self.comm_channels = self.config['comm_channels']
         else:
             raise YamlOptionsError('No comm channels specified in YAML file.')
 
+    def changes(self, new_settings):
+        """ compare these settings with newly loaded settings
+
+        Parameters:
+            new_settings (Settings object): settings reloaded from YAML file
+
+        Returns:
+            changed (set): names of root level yaml sections that changed
+        """
+        changed = set()
+        for section in set(self.config) | set(new_settings.config):
+            if self.config.get(section) != new_settings.config.get(section):
+                changed.add(section)
+        return changed
+
+    def file_changed(self):
+        """ return True if reload_on_change is set and YAML file was modified
+
+        Returns True only once for each modification of the YAML file.
+        """
+        if not self.reload_on_change:
+            return False
+        try:
+            mtime = os.stat(self.yaml_file).st_mtime
+        except OSError:  # file is being replaced by an editor; check next time
+            return False
+        if mtime == self.yaml_mtime:
+            return False
+        self.yaml_mtime = mtime
+        return True
+
     def print_settings(self, title=None):
         """ prints the settings in the yaml file using pprint()
         """
@@ -0,0 +1,140 @@
+"""loadgen: generate synthetic imagehub event logs for benchmarks
+
+Provides the LogGenerator class, which learns the nodes, events, values and
+relative event frequencies from real imagehub event logs (such as the logs in
+test-data/imagehub_data/logs) and then writes synthetic logs of any size in
+the same format:
+
+    2021-09-24 06:25:04,959 ~ Driveway Mailbox|motion|moving
+    2021-09-24 06:16:44,842 ~ BackDeck|Temp|55 F
+
+Synthetic logs are written with the same file names as the imagehub's daily
+rotated logs (imagehub.log, imagehub.log.2021-09-23, ...) so HubData loads
+them just as it loads real imagehub logs.
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import random
+from pathlib import Path
+from datetime import datetime, timedelta
+
+class LogGenerator:
+    """ Methods and attributes to generate synthetic imagehub event log lines
+
+    Parameters:
+        seed_dir (str or Path): directory of real imagehub event log files
+        seed (int): random number seed, so that runs are repeatable
+    """
+    def __init__(self, seed_dir, seed=0):
+        self.random = random.Random(seed)
+        self.values = {}  # (node, event) -> list of values seen in seed logs
+        self.other = []  # lines that are not node|event|value, e.g. restarts
+        for log_file in sorted(Path(seed_dir).glob('*log*')):
+            with open(log_file, 'r') as f:
+                for line in f:
+                    self.learn_line(line)
+        if not self.values:
+            raise ValueError('No node event lines in ' + str(seed_dir))
+        self.series = list(self.values)
+        # series are picked in proportion to their frequency in the seed logs
+        self.weights = [len(self.values[key]) for key in self.series]
+
+    def learn_line(self, line):
+        parts = line.rstrip('\n').split(' ~ ', 1)
+        if len(parts) < 2:
+            return
+        fields = parts[1].split('|')
+        if len(fields) < 3:
+            self.other.append(parts[1])
+        else:
+            self.values.setdefault((fields[0], fields[1]), []).append(fields[2])
+
+    def lines(self, start, n_lines, rate):
+        """ generate n_lines event log lines starting at a datetime
+
+        Parameters:
+            start (datetime): datetime of the first line
+            n_lines (int): number of lines to generate
+            rate (float): average lines per hour; intervals are exponential
+
+        Returns:
+            lines (list): event log lines, each ending in a newline
+        """
+        lines = []
+        when = start
+        choices = self.random.choices(self.series, self.weights, k=n_lines)
+        for node, event in choices:
+            value = self.random.choice(self.values[(node, event)])
+            lines.append(self.format_line(when, node + '|' + event + '|' + value))
+            when += timedelta(hours=self.random.expovariate(rate))
+        return lines
+
+    @staticmethod
+    def format_line(when, message):
+        # same format as the imagehub logging.Formatter: '%(asctime)s ~ %(message)s'
+        return (when.strftime('%Y-%m-%d %H:%M:%S,') +
+                '{:03d}'.format(when.microsecond // 1000) + ' ~ ' + message + '\n')
+
+    def write_logs(self, log_dir, days, lines_per_day, name='imagehub.log'):
+        """ write a current log and 'days' daily rotated logs to log_dir
+
+        The current log holds today's lines up to now; each rotated log holds
+        one earlier day of lines.
+
+        Parameters:
+            log_dir (str or Path): directory to write the log files into
+            days (int): number of daily rotated log files to write
+            lines_per_day (int): number of lines in each full day log file
+            name (str): file name of the current log
+
+        Returns:
+            path (Path): path of the current log file
+        """
+        log_dir = Path(log_dir)
+        log_dir.mkdir(parents=True, exist_ok=True)
+        now = datetime.now()
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        rate = lines_per_day / 24
+        for day in range(days, 0, -1):
+            start = today - timedelta(days=day)
+            lines = self.lines(start, lines_per_day, rate)
+            rotated = log_dir / (name + '.' + start.strftime('%Y-%m-%d'))
+            with open(rotated, 'w') as f:
+                f.writelines(lines)
+        # the current log covers midnight until now at the same rate
+        elapsed_hours = (now - today).total_seconds() / 3600
+        start = now - timedelta(hours=elapsed_hours)
+        lines = self.lines(start, max(1, int(rate * elapsed_hours)), rate)
+        path = log_dir / name
+        with open(path, 'w') as f:
+            f.writelines(lines)
+        return path
+
+    def append_lines(self, path, n_lines):
+        """ append n_lines lines, timestamped now, to a log file
+
+        Parameters:
+            path (str or Path): log file to append to
+            n_lines (int): number of lines to append
+
+        Returns:
+            lines (list): the lines appended
+        """
+        lines = self.lines(datetime.now(), n_lines, rate=3600 * 1000)
+        with open(path, 'a') as f:
+            f.writelines(lines)
+        return lines
+
+    def queries(self, n_queries):
+        """ generate n_queries questions like those asked of the librarian
+
+        Returns:
+            queries (list): query strings
+        """
+        questions = ['Is the water running?', 'What is the barn temperature?',
+                     'How hot is it on the back deck?', 'temperature inside',
+                     'Is it cold outside?', 'garage temp', 'water flow',
+                     'what is the weather like?']
+        return [self.random.choice(questions) for _ in range(n_queries)]
@@ -0,0 +1,217 @@
+"""log_archive: compact columnar archives of rotated imagehub event logs
+
+The imagehub rotates its event log at midnight. A rotated (dated) log, like
+imagehub.log.2021-09-23, is never changed again, but it was parsed line by
+line each time the librarian started. An archive holds the same events in
+columns that numpy.memmap maps without any parsing:
+
+    8 bytes   MAGIC, b'LIBARCH1'
+    4 bytes   length of the header, a little endian uint32
+    header    JSON: source log name, size and mtime, row count, datetime of
+              the first row, the series table of [node, event] pairs, the
+              value table of distinct value strings and the columns
+    columns   each starts on an 8 byte boundary; one entry per event line:
+        delta_ms  uint32   milliseconds since the previous row
+        series    uint16   index into the series table
+        value     uint32   index into the value table
+        number    float32  the value as a number, e.g. 83.0; NaN if none
+                           (for quick scans; exact numbers come from the
+                           value table)
+
+Datetimes are milliseconds since 1970-01-01 in the imagehub's local time,
+the same naive datetimes as in the log. Lines without a datetime are not
+archived. The text logs stay in place; they are the source of truth, and an
+archive is made again if its log file changes.
+
+Archives can also be made from the command line:
+    python -m helpers.log_archive ~/imagehub_data/logs ~/librarian_data/log_archive
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import os
+import sys
+import json
+import struct
+import logging
+from pathlib import Path
+from datetime import datetime, timedelta
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'LIBARCH1'
+SUFFIX = '.arc'
+EPOCH = datetime(1970, 1, 1)  # naive, like the datetimes in the event log
+COLUMNS = [('delta_ms', '<u4'), ('series', '<u2'), ('value', '<u4'),
+           ('number', '<f4')]
+
+def archive_path(log_path, archive_dir):
+    """ return the archive path for an event log, e.g. imagehub.log.2021-09-23.arc
+    """
+    return Path(archive_dir) / (Path(log_path).name + SUFFIX)
+
+def is_current(log_path, archive_file):
+    """ return True if archive_file exists and was made from log_path as it is now
+    """
+    try:
+        header = read_header(archive_file)[0]
+    except (OSError, ValueError):
+        return False
+    stat = os.stat(log_path)
+    return (header['source_size'] == stat.st_size and
+            header['source_mtime_ns'] == stat.st_mtime_ns)
+
+def read_header(archive_file):
+    """ return (header dict, offset of the first column) of an archive file
+    """
+    with open(archive_file, 'rb') as f:
+        start = f.read(12)
+        if len(start) < 12 or start[:8] != MAGIC:
+            raise ValueError('Not a log archive: ' + str(archive_file))
+        length = struct.unpack('<I', start[8:])[0]
+        header = json.loads(f.read(length).decode())
+    return header, 12 + length
+
+def to_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+def convert_log(log_path, archive_file, parse_line):
+    """ write the archive of an event log file
+
+    Parameters:
+        log_path (Path): a rotated imagehub event log
+        archive_file (Path): archive file to write
+        parse_line (function): parses a log line into a node_tuple
+            (node, event, when, value) or None, e.g. HubData.parse_log_line
+
+    Returns:
+        rows (int): number of events archived
+    """
+    stat = os.stat(log_path)
+    series, values = {}, {}  # table entry -> its index
+    times, series_ids, value_ids = [], [], []
+    with open(log_path, 'r') as f:
+        for line in f:
+            node_tuple = parse_line(line)
+            if node_tuple is None:
+                continue
+            node, event, when, value = node_tuple
+            times.append((when - EPOCH) // timedelta(milliseconds=1))
+            series_ids.append(series.setdefault((node, event), len(series)))
+            value_ids.append(values.setdefault(value, len(values)))
+    times = np.array(times, dtype=np.int64)
+    order = np.argsort(times, kind='stable')  # a clock change can reorder lines
+    times = times[order]
+    value_table = list(values)
+    numbers = np.array([to_number(v) for v in value_table], dtype=np.float32)
+    value_ids = np.array(value_ids, dtype=np.uint32)[order]
+    columns = {
+        'delta_ms': np.diff(times, prepend=times[:1]).astype(np.uint32),
+        'series': np.array(series_ids, dtype=np.uint16)[order],
+        'value': value_ids,
+        'number': numbers[value_ids],
+    }
+    header = {
+        'version': 1,
+        'source': Path(log_path).name,
+        'source_size': stat.st_size,
+        'source_mtime_ns': stat.st_mtime_ns,
+        'rows': len(times),
+        'start_ms': int(times[0]) if len(times) else 0,
+        'series': [list(pair) for pair in series],
+        'values': value_table,
+        'columns': {},
+    }
+    # column offsets depend on the header length, which depends on them
+    offset, fixed = 0, False
+    while not fixed:
+        text = json.dumps(header).encode()
+        start = 12 + len(text)
+        offset = start + (-start % 8)
+        fixed = True
+        for name, dtype in COLUMNS:
+            if header['columns'].get(name) != offset:
+                header['columns'][name] = offset
+                fixed = False
+            offset += columns[name].nbytes
+            offset += -offset % 8
+    partial = Path(str(archive_file) + '.part')
+    with open(partial, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(text)) + text)
+        for name, dtype in COLUMNS:
+            f.write(b'\0' * (header['columns'][name] - f.tell()))
+            f.write(columns[name].tobytes())
+    os.replace(partial, archive_file)  # readers never see a partial archive
+    return len(times)
+
+class LogArchive:
+    """ Columns of an archived event log, mapped into memory with numpy.memmap
+
+    Parameters:
+        archive_file (Path): an archive written by convert_log()
+    """
+    def __init__(self, archive_file):
+        self.header, _ = read_header(archive_file)
+        self.rows = self.header['rows']
+        self.series = [tuple(pair) for pair in self.header['series']]
+        self.values = self.header['values']
+        self.columns = {}
+        for name, dtype in COLUMNS:
+            self.columns[name] = (np.memmap(archive_file, dtype=dtype, mode='r',
+                offset=self.header['columns'][name], shape=(self.rows,))
+                if self.rows else np.zeros(0, dtype=dtype))
+
+    def times_ms(self):
+        """ return the datetime of each row, in ms since EPOCH, as int64
+        """
+        return (self.header['start_ms'] +
+                np.cumsum(self.columns['delta_ms'], dtype=np.int64))
+
+    def rows_of(self, series_index):
+        """ return the row numbers of one series, oldest first
+        """
+        return np.flatnonzero(self.columns['series'] == series_index)
+
+    @staticmethod
+    def to_datetime(ms):
+        return EPOCH + timedelta(milliseconds=int(ms))
+
+def convert_directory(log_dir, archive_dir, log_file, parse_line):
+    """ archive every rotated log of log_file that has no current archive
+
+    Parameters:
+        log_dir (Path): imagehub event log directory
+        archive_dir (Path): directory for the archive files
+        log_file (str): name of the current event log, e.g. imagehub.log
+        parse_line (function): parses a log line into a node_tuple or None
+
+    Returns:
+        archived (list): paths of the log files archived
+    """
+    archived = []
+    for path in sorted(Path(log_dir).glob(log_file + '.*')):
+        if path.name.endswith(SUFFIX) or path.name.endswith('.part'):
+            continue
+        target = archive_path(path, archive_dir)
+        if not is_current(path, target):
+            rows = convert_log(path, target, parse_line)
+            log.info('Archived {0} events of {1}'.format(rows, path.name))
+            archived.append(path)
+    return archived
+
+if __name__ == '__main__':
+    from helpers.data_tools import HubData
+    if len(sys.argv) not in (3, 4):
+        print('Usage: python -m helpers.log_archive LOG_DIR ARCHIVE_DIR [LOG_FILE]')
+        sys.exit(1)
+    archive_dir = Path(sys.argv[2])
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    log_file = sys.argv[3] if len(sys.argv) == 4 else 'imagehub.log'
+    for path in convert_directory(sys.argv[1], archive_dir, log_file,
+                                  HubData.parse_log_line):
+        print('Archived', path)
@@ -0,0 +1,228 @@
+"""metrics: counters, gauges and histograms of librarian operations
+
+Provides a registry of runtime metrics, such as event log lines read, query
+queue depths, query reply latency, Gmail API latency and scheduler lag. The
+metrics can be read in Prometheus text format from a local HTTP endpoint or
+as a short status report (the CLI "status" command).
+
+A single MetricsRegistry instance, metrics, is shared by all librarian
+modules. Updating a metric is a few Python operations, so metrics are always
+on; only the HTTP endpoint is optional.
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import math
+import logging
+import threading
+from time import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+class Counter:
+    """ A value that only goes up, like number of log lines read
+    """
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+class Gauge:
+    """ A value that goes up and down, like a queue depth
+
+    Parameters:
+        function (function): if given, called to get the value when read
+    """
+    kind = 'gauge'
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        value = self.function() if self.function else self.value
+        return [(name, labels, value)]
+
+class Histogram:
+    """ Counts of observed values in buckets, like reply latencies in seconds
+
+    Parameters:
+        buckets (tuple): upper bounds of the buckets, in increasing order
+    """
+    kind = 'histogram'
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.default_buckets) + (math.inf,)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            le = '+Inf' if bound == math.inf else repr(bound)
+            samples.append((name + '_bucket', labels + (('le', le),), cumulative))
+        samples.append((name + '_sum', labels, total))
+        samples.append((name + '_count', labels, count))
+        return samples
+
+class MetricsRegistry:
+    """ Holds all the librarian metrics, by name and labels
+
+    Asking for a metric that already exists returns the existing one, so
+    modules can simply ask for the metrics they update. A gauge asked for
+    again with a function reads the new function, so a second instance of a
+    class (e.g. a channel recreated by a settings reload) replaces the first.
+    """
+    def __init__(self):
+        self.families = {}  # name -> (kind, help text, {labels: metric})
+        self.lock = threading.Lock()
+        self.start_time = time()
+
+    def get(self, cls, name, help_text, labels, *args):
+        labels = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            kind, _, family = self.families.setdefault(
+                name, (cls.kind, help_text, {}))
+            if labels not in family:
+                family[labels] = cls(*args)
+            return family[labels]
+
+    def counter(self, name, help_text, labels=None):
+        return self.get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text, labels=None, function=None):
+        gauge = self.get(Gauge, name, help_text, labels, function)
+        if function is not None:  # do not keep reading an older instance
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help_text, labels=None, buckets=None):
+        return self.get(Histogram, name, help_text, labels, buckets)
+
+    def collect(self):
+        """ return a list of (name, kind, help text, samples) for all metrics
+        """
+        with self.lock:
+            families = [(name, kind, help_text, list(family.items()))
+                        for name, (kind, help_text, family)
+                        in sorted(self.families.items())]
+        collected = []
+        for name, kind, help_text, family in families:
+            samples = []
+            for labels, metric in family:
+                try:
+                    samples.extend(metric.samples(name, labels))
+                except Exception:  # a gauge function may fail; skip it
+                    log.exception('Error reading metric ' + name)
+            collected.append((name, kind, help_text, samples))
+        return collected
+
+    def prometheus_text(self):
+        """ return all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for name, kind, help_text, samples in self.collect():
+            lines.append('# HELP ' + name + ' ' + help_text)
+            lines.append('# TYPE ' + name + ' ' + kind)
+            for sample_name, labels, value in samples:
+                lines.append(sample_name + self.label_text(labels) + ' ' +
+                             self.value_text(value))
+        return '\n'.join(lines) + '\n'
+
+    def status_text(self):
+        """ return a short, human readable report of all metrics
+
+        Histograms are reported as count and mean; buckets are left out.
+        """
+        lines = ['Up {:.0f} minutes.'.format((time() - self.start_time) / 60)]
+        for name, kind, _, samples in self.collect():
+            for sample_name, labels, value in samples:
+                if kind == 'histogram':
+                    if not sample_name.endswith('_count'):
+                        continue
+                    total = [v for n, l, v in samples
+                             if n == name + '_sum' and l == labels][0]
+                    mean = total / value if value else 0
+                    value = '{} (mean {:.3f})'.format(value, mean)
+                    sample_name = name
+                lines.append(sample_name + self.label_text(labels) + ': ' +
+                             self.value_text(value))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def label_text(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+    @staticmethod
+    def value_text(value):
+        if isinstance(value, float):
+            return '{:.6g}'.format(value)
+        return str(value)
+
+    def start_http_server(self, port, address='127.0.0.1'):
+        """ serve the metrics in Prometheus text format at /metrics
+
+        The server runs in a daemon thread and only listens on the local
+        address by default.
+
+        Parameters:
+            port (int): TCP port to listen on
+            address (str): address to listen on
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # do not write a log line for every scrape
+
+        server = ThreadingHTTPServer((address, port), MetricsHandler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True  # allows this thread to be auto-killed on program exit
+        t.name = 'Metrics HTTP Server'  # naming the thread helps with debugging
+        t.start()
+        return server
+
+metrics = MetricsRegistry()
@@ -5,15 +5,17 @@ License: MIT, see LICENSE for more details.
 """
 
 import os
-import psutil
+import sys
 import signal
 import logging
 import platform
 import threading
 import multiprocessing
-import numpy as np
 from time import sleep
-from helpers.utils import interval_timer
+from datetime import datetime
+from helpers.utils import interval_timer, heartbeats, systemd_notify
+
+log = logging.getLogger(__name__)
 
 class HealthMonitor:
     """ Methods and attributes to measure and tune network and system stability
@@ -30,21 +32,37 @@ class HealthMonitor:
     """
     def __init__(self, settings):
         self.sys_type = self.get_sys_type()
-        self.tiny_image = np.zeros((3,3), dtype="uint8")  # tiny blank image
+        self.tiny_image = None  # created only if heartbeat option is set
         self.heartbeat_event_text = '|'.join([settings.librarian_name, 'Heartbeat'])
         self.patience = settings.patience
+        heartbeats.set_patience(self.patience)  # shared with the stall watcher
         if settings.heartbeat:
+            import numpy as np  # numpy is only needed for heartbeat image
+            self.tiny_image = np.zeros((3,3), dtype="uint8")  # tiny blank image
             threading.Thread(daemon=True,
                 target=lambda: interval_timer(
                     settings.heartbeat, self.send_heartbeat)).start()
+        # track when each imagenode was last heard from in the event logs
+        self.liveness = NodeLiveness(settings.silent_intervals)
+        threading.Thread(daemon=True, name='Node Liveness Checker',
+            target=lambda: interval_timer(
+                self.liveness.check_seconds, self.liveness.check)).start()
         self.stall_p = None
-        if settings.stall_watcher:  # stall_watcher option set to True
+        # systemd sets WATCHDOG_USEC when the service file has WatchdogSec=
+        watchdog_usec = int(os.environ.get('WATCHDOG_USEC', 0))
+        if settings.stall_watcher or watchdog_usec:
             pid = os.getpid()
             self.stall_p = multiprocessing.Process(daemon=True,
-                               args=((pid, self.patience,)),
-                               target=self.stall_watcher)
+                               args=((pid, heartbeats, watchdog_usec / 1e6,)),
+                               target=stall_watcher)
             self.stall_p.start()
 
+    def set_patience(self, patience):
+        """ change the patience of the stall watcher, e.g. on a yaml reload
+        """
+        self.patience = patience
+        heartbeats.set_patience(patience)
+
     def send_heartbeat(self):
         """ send a heartbeat message to imagehub
         """
@@ -52,36 +70,6 @@ class HealthMonitor:
         text_and_image = (text, self.tiny_image)
         # self.send_q.append(text_and_image)
 
-    def stall_watcher(self, pid, patience):
-        """ Watch the main process cpu_times.user; sys.exit() if not advancing
-
-        This function is started in a separate process. It sleeps for
-        'patience' seconds, then checks if main process cpu_times.user
-        has advanced at least 1 second. If not, it ends the imagenode
-        program by killing the main process and performing sys.exit().
-        If the main process cpu_times.user is advancing normally, it sleeps
-        and checks again forever.  This catches any network or other
-        "stalls" or "hangs". Ending the imagenode program will allow automatic
-        restarting (if it is enabled in the imagenode service). See the
-        "stall_watcher" option documentation for more details.
-
-        Parameters:
-            pid (int): process ID of the main imagenode process
-            patience (int): how long to wait for each check repeated check
-        """
-        p = psutil.Process(pid)
-        main_time = p.cpu_times().user
-        sleep_time = patience
-        sleep(sleep_time)
-        while True:
-            last_main_time = main_time
-            main_time = p.cpu_times().user
-            delta_time = round(abs(main_time - last_main_time))
-            if delta_time < 1:
-                os.kill(pid, signal.SIGTERM) # p.terminate() # or os.kill(pid, signal.SIGTERM)
-                sys.exit()
-            sleep(sleep_time)
-
     def get_sys_type(self):
         """ determine system type, e.g., RPi or Mac
         """
@@ -107,6 +95,150 @@ class HealthMonitor:
     def check_ping(self, address='192.168.1.1'):
         return 'OK'  # for testing
 
+def stall_watcher(pid, heartbeats, watchdog_seconds=0):
+    """ Watch the progress heartbeats of the main process threads
+
+    This function is started in a separate process by HealthMonitor; it is a
+    module level function with plain arguments so that it can be pickled for
+    any multiprocessing start method. The main loop, the HubData ingest
+    thread and each comm channel thread stamp a shared memory heartbeat slot
+    as they make progress (see utils.Heartbeats). If any thread that is not
+    idle has not made progress for its stamping interval plus the patience
+    seconds in heartbeats, it ends the librarian program by sending SIGTERM
+    to the main process and performing sys.exit(). An idle librarian that is
+    simply waiting for queries is not stalled; a thread that is busy but
+    stuck is. Ending the librarian program will allow automatic restarting
+    (if it is enabled in the librarian service).
+
+    If systemd watchdog is enabled (WatchdogSec= in the service file), a
+    'WATCHDOG=1' notification is sent to systemd after each check that
+    finds no stalled threads, at least twice per watchdog interval.
+
+    Parameters:
+        pid (int): process ID of the main librarian process
+        heartbeats (Heartbeats): shared progress stamps of watched threads
+        watchdog_seconds (float): systemd watchdog interval; 0 if none
+    """
+    while True:
+        check_seconds = heartbeats.patience.value / 2  # may be reloaded
+        if watchdog_seconds:
+            check_seconds = min(check_seconds, watchdog_seconds / 2)
+        sleep(check_seconds)
+        stalled = heartbeats.stalled()
+        if stalled:
+            log.error('Stalled librarian threads: ' + ', '.join(stalled))
+            os.kill(pid, signal.SIGTERM) # p.terminate() # or os.kill(pid, signal.SIGTERM)
+            sys.exit()
+        if watchdog_seconds:
+            systemd_notify('WATCHDOG=1')
+
+class NodeLiveness:
+    """ Track when each imagenode was last heard from in its event stream
+
+    Every event series, like BackDeck Temp, has its last seen time and its
+    expected interval between events. The expected interval is learned from
+    the event datetimes: an exponentially weighted moving average (EWMA) of
+    the intervals between events. An interval longer than 'silent_intervals'
+    expected intervals, like a node powered off for a day, is an outage; it
+    is counted in the average only as that many intervals, so one outage
+    does not hide the next one. A series is silent when it has been quiet for
+    more than 'silent_intervals' expected intervals. A node is silent when
+    all of its series (that have enough intervals to learn from) are silent.
+    So a quiet series that is not regular (like motion) does not make a node
+    silent while its regular series (like temperature) are still heard.
+
+    Recording an event is O(1) and needs no network traffic. The silent nodes
+    can be checked by ssh probes (see nodewatcher.py) instead of all nodes.
+
+    Parameters:
+        silent_intervals (int): expected intervals before a series is silent
+    """
+    check_seconds = 60  # how often check() is run to look for silent nodes
+    min_intervals = 3  # intervals needed before a series can be silent
+    alpha = 0.2  # weight of newest interval in the moving average
+
+    def __init__(self, silent_intervals=3):
+        self.silent_intervals = silent_intervals
+        self.series = {}  # (node, event) -> [last seen, EWMA, count]
+        self.silent = set()  # nodes that are currently silent
+        self.silent_listeners = []  # functions called with (node, last_seen)
+        self.lock = threading.Lock()
+
+    def record(self, node_tuple):
+        """ record an event from a node; O(1) per event
+
+        Parameters:
+            node_tuple (tuple): (node, event, when, value) from parse_log_line
+        """
+        node = node_tuple[0].strip().lower()
+        if node == 'non-node':
+            return
+        key = (node, node_tuple[1].strip().lower())
+        when = node_tuple[2]
+        with self.lock:
+            stats = self.series.get(key, None)
+            if stats is None:
+                self.series[key] = [when, None, 0]
+                return
+            interval = (when - stats[0]).total_seconds()
+            if interval <= 0:  # already recorded, e.g. a reloaded log line
+                return
+            stats[0] = when
+            if stats[1] is None:
+                stats[1] = interval
+            else:  # an outage counts as only silent_intervals intervals
+                interval = min(interval, self.silent_intervals * stats[1])
+                stats[1] += self.alpha * (interval - stats[1])
+            stats[2] += 1
+            if node in self.silent:
+                self.silent.discard(node)
+                log.warning('Node ' + node + ' is sending events again.')
+
+    def learn(self, event_data, lock):
+        """ learn expected intervals from event data already loaded
+
+        Parameters:
+            event_data (dict): HubData.event_data; deques are newest first
+            lock (RLock): lock protecting event_data
+        """
+        with lock:
+            history = [(node, event, when, value)
+                       for node, events in event_data.items()
+                       for event, values in events.items()
+                       for when, value in reversed(values)]
+        for node_tuple in history:  # oldest to newest within each series
+            self.record(node_tuple)
+
+    def check(self):
+        """ find nodes that have gone silent; call silent_listeners for each
+        """
+        now = datetime.now()
+        quiet_nodes = {}  # node -> last event time, while all series are quiet
+        heard_nodes = set()  # nodes with at least one series not silent
+        with self.lock:
+            for (node, event), (last, ewma, count) in self.series.items():
+                if count < self.min_intervals or node in self.silent:
+                    continue
+                quiet = (now - last).total_seconds()
+                if quiet > self.silent_intervals * ewma:
+                    quiet_nodes[node] = max(last, quiet_nodes.get(node, last))
+                else:
+                    heard_nodes.add(node)
+            newly_silent = {node: last for node, last in quiet_nodes.items()
+                            if node not in heard_nodes}
+            self.silent.update(newly_silent)
+        for node, last in newly_silent.items():
+            log.warning('Node ' + node + ' is silent; last event at ' +
+                        last.isoformat())
+            for listener in self.silent_listeners:
+                listener(node, last)
+
+    def suspect_nodes(self):
+        """ return the set of nodes that are currently silent
+        """
+        with self.lock:
+            return set(self.silent)
+
 def main():
     settings = None
     health = HealthMonitor(settings)
@@ -5,8 +5,9 @@ send error messages to the systemctl / journalctl logs, but fail to exit and
 restart the program. They hang in modules that are written in C and give an
 error message to the systemctl / journalctl logs, but then stall / freeze. It
 takes a "sudo systemctl restart imagenode" to restart them. The purpose of this
-module is to run "systemctl status imagenode", recognize those errors and then
-run "sudo systemctl restart imagenode" to restart the imagenode.
+module is to run "systemctl show imagenode" and read the new imagenode journal
+lines, recognize those errors and then run "sudo systemctl restart imagenode"
+to restart the imagenode.
 
 This is an experimental module to try better ways of finding and fixing these
 imagenode stalls. Prior to restarting, the error messages are written to the
@@ -23,16 +24,37 @@ License: MIT, see LICENSE for more details.
 """
 
 import os
+import re
 import sys
+import shlex
 import signal
 import logging
 import traceback
 import subprocess
 import multiprocessing
 import logging.handlers
-from time import sleep
+from time import sleep, monotonic
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait
 from helpers.utils import clean_shutdown_when_killed
 
+class NodeUnreachable(Exception):
+    pass
+
+# Journal line patterns of known imagenode failures; matched ignoring case.
+# Only error text matches; imagenode also names its camera, sensor and ZMQ
+# modules in the lines it logs when it starts normally.
+FAILURE_SIGNATURES = {
+    'PiCamera': re.compile(r'mmal: .*failed|camera component couldn.t be '
+                           r'enabled|picamera.*(error|exception)', re.IGNORECASE),
+    'DHT-22': re.compile(r'dht.*(error|failed|timeout)|runtimeerror.*dht',
+                         re.IGNORECASE),
+    'ZMQ': re.compile(r'zmq\.error|zmqerror|resource temporarily unavailable',
+                      re.IGNORECASE),
+    'Traceback': re.compile(r'^traceback \(most recent call last\)',
+                            re.IGNORECASE),
+}
+
 class SystemctlMonitor:
     """ Use Linux systemctl command to monitor imagenode system stability
 
@@ -61,31 +83,75 @@ class SystemctlMonitor:
     To use in another program as a threading.Thread, use the code above and
     change "multiprocessing.Process" to "threading.Thread"
 
+    Each imagenode has one persistent ssh "ControlMaster" connection that is
+    shared by all the ssh commands sent to it, so the ssh login and key
+    exchange happen once instead of for every check. The master connection is
+    started explicitly in the background ("ssh -MNf") with its output sent to
+    /dev/null, so it never holds open the output pipes of a command. The
+    control sockets persist for 'control_persist' seconds after the last
+    command and are reconnected when a command fails to connect.
+
+    Parameters:
+        log (logger): the logger instance to log errors and restarts
+        ssh_timeout (int): seconds to wait for each ssh command
+        restart_timeout (int): seconds to wait for an imagenode restart; a
+            hung imagenode can take systemd's TimeoutStopSec (90) to stop
+        max_backoff (int): longest wait in seconds to recheck unreachable node
+        max_workers (int): maximum number of imagenodes checked at once
+        control_persist (int): seconds an idle ssh connection is kept open
+        runner (function): runs a command like subprocess.run; a fake runner
+            can stand in for real imagenodes when testing
+        control_dir (Path): directory of the ssh control sockets
     """
-    def __init__(self, log):
-        self.status_cmd = 'systemctl status imagenode'  # preferred approach
-        self.journal_cmd = 'journalctl -u imagenode'  # an alternative approach
+    def __init__(self, log, ssh_timeout=10, restart_timeout=120,
+                 max_backoff=960, max_workers=20, control_persist=600,
+                 runner=subprocess.run, control_dir=None):
+        self.show_cmd = ('systemctl show imagenode -p ActiveState,SubState,'
+                         'ExecMainStartTimestamp,NRestarts')
+        self.journal_cmd = 'journalctl -u imagenode --no-pager -o cat --show-cursor'
         self.restart_cmd = 'sudo systemctl restart imagenode'
         self.log = log
+        self.cursors = {}  # imagenode -> journal cursor of last line read
+        self.states = {}  # imagenode -> systemctl show properties last read
+        self.runner = runner
+        control_dir = Path(control_dir or Path.home() / '.ssh' / 'librarian-cm')
+        control_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # %C is a hash of the connection details; keeps socket paths short
+        self.control_options = ['-o', 'ControlPath=' + str(control_dir / '%C')]
+        self.control_persist = control_persist
+        self.masters = set()  # imagenodes with a master connection started
+        self.ssh_timeout = ssh_timeout  # seconds to wait for each ssh command
+        self.restart_timeout = restart_timeout  # seconds to wait for a restart
+        self.max_backoff = max_backoff  # longest wait to recheck unreachable node
+        self.backoff = {}  # imagenode -> (next check time, backoff seconds)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers,
+                                       thread_name_prefix='imagenode check')
 
     def systemctl_watcher(self, patience, imagenodes):
         """ Watch the imagenodes using "systemctl status imagenode"
 
         This method is started in a separate thread or process. It sleeps for
-        'patience' seconds, then checks each imagenode in the imagenodes list.
-        Then repeats forever.
+        'patience' seconds, then checks all the imagenodes in the imagenodes
+        list concurrently. Then repeats forever.
 
-        For each imagenode:
-        It runs the command "systemctl status imagenode", then
-        checkes that the last line of the returned contains
-        "Started Imagenode Service". If not, it restarts the imagenode using the
+        For each imagenode (each in its own thread of the check pool):
+        It reads the imagenode service state with "systemctl show" and the
+        journal lines added since the last check, then checks that the service
+        is active and running and that no new journal line matches a known
+        failure signature. If not, it restarts the imagenode using the
         command "sudo systemctl restart imagenode".
 
         This requires that each imagenode computer be setup up so that it has
         passwordless login from the computer that is running this program.
         It also assumes that the login user speciried in the imagenode list
         (often "pi") has sudo priveleges. If passwordless login fails, then
-        this program will fail without warning (TODO: fix this).
+        the imagenode is logged as unreachable (ssh runs with BatchMode=yes).
+
+        Each ssh command times out after 'ssh_timeout' seconds. An imagenode
+        that cannot be reached is not restarted; it is checked again after a
+        backoff time that doubles (up to 'max_backoff') each time it is still
+        unreachable. A sweep of all the imagenodes takes about as long as the
+        slowest single check.
 
         The list of imagenodes looks like:
             imagenodes = ['pi@rpi11', 'pi@rpi12', 'pi@rpi14', 'pi@rpi19']
@@ -96,42 +162,198 @@ class SystemctlMonitor:
         """
         while True:
             sleep(patience)
-            for imagenode in imagenodes:
-                if not self.imagenode_OK(imagenode):
-                    self.restart_imagenode(imagenode)
+            self.check_imagenodes(imagenodes, patience)
+
+    def check_imagenodes(self, imagenodes, patience):
+        """ check all imagenodes concurrently; wait for all checks to finish
+
+        Parameters:
+            patience (int): first backoff time for an unreachable imagenode
+            imagenodes (list): the list of imagenodes to check
+        """
+        now = monotonic()
+        due = [imagenode for imagenode in imagenodes
+               if self.backoff.get(imagenode, (0, 0))[0] <= now]
+        checks = [self.pool.submit(self.check_imagenode, imagenode, patience)
+                  for imagenode in due]
+        wait(checks)
+
+    def check_imagenode(self, imagenode, patience):
+        """ check a single imagenode; restart it or back off if needed
+
+        Parameters:
+            imagenode (str): the imagenode to check, e.g. 'pi@rpi11'
+            patience (int): first backoff time for an unreachable imagenode
+        """
+        try:
+            if not self.imagenode_OK(imagenode):
+                self.restart_imagenode(imagenode)
+        except NodeUnreachable:
+            _, delay = self.backoff.get(imagenode, (0, 0))
+            delay = min(max(delay * 2, patience), self.max_backoff)
+            self.backoff[imagenode] = (monotonic() + delay, delay)
+            self.log.error('imagenode ' + imagenode + ' unreachable; next' +
+                           ' check in ' + str(delay) + ' seconds')
+        except Exception:
+            self.log.exception('Error checking imagenode ' + imagenode)
+        else:
+            self.backoff.pop(imagenode, None)
+
+    def run_ssh(self, imagenode, cmd, timeout=None):
+        """ run a command on an imagenode using ssh with a timeout
+
+        Uses the imagenode's shared ssh connection, starting it if needed. The
+        command itself never becomes a master (ControlMaster=no); if the shared
+        connection is gone, it connects on its own. If the command fails to
+        connect, the shared connection is closed so the next command starts a
+        fresh one.
+
+        Parameters:
+            imagenode (str): the imagenode to run the command on
+            cmd (str): the command to run
+            timeout (int): seconds to wait for the command; None for ssh_timeout
+
+        Returns:
+            status (CompletedProcess): from subprocess.run
+
+        Raises:
+            NodeUnreachable: if ssh times out or cannot connect
+        """
+        if imagenode not in self.masters:
+            self.start_master(imagenode)
+        args = (['ssh', '-o', 'BatchMode=yes', '-o',
+                 'ConnectTimeout=' + str(self.ssh_timeout),
+                 '-o', 'ControlMaster=no'] +
+                self.control_options + [imagenode, cmd])
+        try:
+            status = self.runner(args, capture_output=True, text=True,
+                                 timeout=timeout or self.ssh_timeout)
+        except subprocess.TimeoutExpired:
+            self.close_connection(imagenode)
+            raise NodeUnreachable(imagenode)
+        if status.returncode == 255:  # ssh itself failed, e.g. no connection
+            self.close_connection(imagenode)
+            raise NodeUnreachable(imagenode)
+        return status
+
+    def start_master(self, imagenode):
+        """ start the shared ssh connection to an imagenode in the background
+
+        "ssh -MNf" logs in, then forks a master process that runs no command
+        and holds the control socket. Its input and output are /dev/null, so
+        the forked master cannot keep a pipe open and block this call.
+
+        Parameters:
+            imagenode (str): the imagenode to connect to
+
+        Raises:
+            NodeUnreachable: if ssh times out or cannot connect
+        """
+        args = (['ssh', '-MNf', '-o', 'BatchMode=yes', '-o',
+                 'ConnectTimeout=' + str(self.ssh_timeout), '-o',
+                 'ControlPersist=' + str(self.control_persist)] +
+                self.control_options + [imagenode])
+        try:
+            status = self.runner(args, stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL,
+                                 timeout=self.ssh_timeout)
+        except subprocess.TimeoutExpired:
+            raise NodeUnreachable(imagenode)
+        if status.returncode != 0:
+            raise NodeUnreachable(imagenode)
+        self.masters.add(imagenode)
+
+    def close_connection(self, imagenode):
+        """ close the shared ssh connection to an imagenode, if there is one
+
+        Parameters:
+            imagenode (str): the imagenode whose connection is closed
+        """
+        self.masters.discard(imagenode)
+        args = ['ssh'] + self.control_options + ['-O', 'exit', imagenode]
+        try:
+            self.runner(args, stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                        timeout=self.ssh_timeout)
+        except subprocess.TimeoutExpired:
+            pass  # a stale socket is replaced when the next master starts
 
     def imagenode_OK(self, imagenode):
-        """ check the imagenode is OK using systemctl status command.
+        """ check the imagenode is OK using systemctl show and journalctl
+
+        A single ssh command reads the service properties and only the journal
+        lines added after the journal cursor saved by the previous check. On
+        the first check of an imagenode, only a cursor is fetched; earlier
+        journal lines may be from before the last restart.
+
+        Parameters:
+            imagenode (str): the imagenode to check, e.g. 'pi@rpi11'
+
+        Returns:
+            True if the imagenode service is running without known failures
         """
-        # use ssh to run the systemctl status command
-        # TODO: add a timeout for case where ssh does not successfully log in
-        #       for example, if the imagenode computer is not running.
-        status = subprocess.run(['ssh', imagenode, self.status_cmd],
-                capture_output=True, text=True)
-        lines = status.stdout.splitlines()
-        if lines:  # were any lines returned?
-            if 'started imagenode service' in lines[-1].lower():
-                # last line of systemctl status contains above phrase then OK
-                return True
-            # elif (some_test_on.conditions):  #############  Need tests for Error, Exception,
-
-            # see this note in Evernote: Various imagenode error and exception notes -- List Note
-            # TODO: add a test for a Journal rotation line like:
-            # Warning: Journal has been rotated since unit was started.
-            # systemctl status  response lines like that should return True?
-            self.log.error("**imagenode error " + imagenode +
-                            ". Last lines from systemctl status:")
-            for line in lines[-5:]:
-                self.log.error('  ' + line)
-            return False
-        else:  # no lines were returned; imagenode not OK
-            return False
+        cursor = self.cursors.get(imagenode, None)
+        if cursor:
+            journal = self.journal_cmd + ' --after-cursor=' + shlex.quote(cursor)
+        else:
+            journal = self.journal_cmd + ' -n 1'
+        status = self.run_ssh(imagenode, self.show_cmd + '; echo; ' + journal)
+        show_part, _, journal_part = status.stdout.partition('\n\n')
+        state = dict(line.split('=', 1) for line in show_part.splitlines()
+                     if '=' in line)
+        lines = journal_part.splitlines()
+        if lines and lines[-1].startswith('-- cursor: '):
+            self.cursors[imagenode] = lines.pop()[len('-- cursor: '):]
+        previous = self.states.get(imagenode, None)
+        self.states[imagenode] = state
+        if previous and state.get('NRestarts') != previous.get('NRestarts'):
+            self.log.error('imagenode ' + imagenode + ' was restarted by systemd' +
+                           '; NRestarts=' + str(state.get('NRestarts')))
+        failures = self.classify_failures(lines) if cursor else []
+        running = (state.get('ActiveState') == 'active' and
+                   state.get('SubState') == 'running')
+        if running and not failures:
+            return True
+        self.log.error('**imagenode error ' + imagenode + ': ActiveState=' +
+                       str(state.get('ActiveState')) + ' SubState=' +
+                       str(state.get('SubState')) + ' failures: ' +
+                       ', '.join(failures))
+        for line in lines[-5:]:
+            self.log.error('  ' + line)
+        return False
+
+    def classify_failures(self, lines):
+        """ return the names of known failure signatures found in journal lines
+
+        Parameters:
+            lines (list): journal lines, e.g. from journalctl -o cat
+
+        Returns:
+            failures (list): names of FAILURE_SIGNATURES matched by any line
+        """
+        failures = []
+        for name, pattern in FAILURE_SIGNATURES.items():
+            if any(pattern.search(line) for line in lines):
+                failures.append(name)
+        return failures
 
     def restart_imagenode(self, imagenode):
         """ restart the imagenode using systemctl restart
+
+        A hung imagenode can take a long time to stop, so the restart has its
+        own, longer, timeout.
+
+        Returns:
+            True if the imagenode was restarted and is OK; False if not
         """
-        status = subprocess.run(['ssh', imagenode, self.restart_cmd],
-                capture_output=True, text=True)
+        status = self.run_ssh(imagenode, self.restart_cmd,
+                              timeout=self.restart_timeout)
+        if status.returncode != 0:
+            self.log.error('restart of imagenode ' + imagenode + ' failed' +
+                           ' with returncode ' + str(status.returncode) +
+                           ': ' + status.stderr.strip())
+            return False
         self.log.error("restarted imagenode " + imagenode)
         return self.imagenode_OK(imagenode)  # check imagenode status again
 
@@ -164,6 +386,9 @@ def main():
     except Exception as ex: # traceback will appear in log
         log.exception('Unanticipated error with no Exception handler.')
     finally:
+        if 'sm' in locals():
+            for imagenode in imagenodes:
+                sm.close_connection(imagenode)
         log.info('Exiting imagenode_watcher.py')
         sys.exit()
 
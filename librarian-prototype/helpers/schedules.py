@@ -8,20 +8,168 @@ License: MIT, see LICENSE for more details.
 """
 
 import sys
+import heapq
 import pprint
 import logging
-import schedule
 import threading
 import subprocess
-from time import sleep
 from pathlib import Path
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from collections import deque
-from helpers.comms.gmail import Gmail
 from helpers.utils import YamlOptionsError
+from helpers.metrics import metrics
 
 log = logging.getLogger(__name__)
 
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+            'saturday', 'sunday']
+
+class Job:
+    """ A job that runs an action at a time of day on some days of the week
+
+    Parameters:
+        at (str): time of day to run the job, like '10:30'
+        days (str or list): 'all', a weekday name like 'Tuesday' or a list
+            of weekday names
+        action (function): function to call when the job is due
+        args (tuple): arguments to pass to action
+    """
+    def __init__(self, at, days, action, args=()):
+        try:
+            self.at = datetime.strptime(at, '%H:%M').time()
+        except (TypeError, ValueError):
+            raise YamlOptionsError('Schedule time must be like "10:30" in quotes.')
+        self.weekdays = self.parse_days(days)
+        self.action = action
+        self.args = args
+
+    def parse_days(self, days):
+        """ convert the days option from the yaml file into a set of weekdays
+
+        Parameters:
+            days (str or list): 'all', a weekday name or list of weekday names
+
+        Returns:
+            weekdays (set): weekday numbers, where Monday is 0
+        """
+        if isinstance(days, str):
+            days = [days]
+        weekdays = set()
+        for day in days:
+            day = str(day).strip().lower()
+            if day == 'all':
+                return set(range(7))
+            if day not in WEEKDAYS:
+                raise YamlOptionsError('Unknown day in schedule: ' + day)
+            weekdays.add(WEEKDAYS.index(day))
+        return weekdays
+
+    def next_run(self, after):
+        """ return the first datetime later than 'after' when job should run
+
+        Parameters:
+            after (datetime): find the next run time after this datetime
+
+        Returns:
+            next run time (datetime)
+        """
+        day = after.date()
+        for i in range(8):  # the same weekday a week later is always found
+            when = datetime.combine(day + timedelta(days=i), self.at)
+            if when > after and when.weekday() in self.weekdays:
+                return when
+
+class Scheduler:
+    """ Runs Jobs at their scheduled times using a heap of next run times
+
+    A scheduler thread sleeps until the earliest next run time in the heap,
+    or until it is woken because a job was added or the jobs were cleared.
+    The scheduler thread only keeps time; due jobs are run by a small pool
+    of worker threads, so a slow job action (like a Gmail send that is being
+    retried) does not delay the jobs after it.
+    """
+    # longest single sleep; re-checks the heap after wall clock changes
+    max_wait = 3600
+    max_workers = 4  # job actions that can run at the same time
+
+    def __init__(self):
+        self.heap = []  # (next run datetime, sequence number, Job)
+        self.sequence = 0  # breaks ties between jobs with same run time
+        self.wake = threading.Condition()
+        self.pool = None  # job worker threads; created by start()
+        self.running = False
+        self.lag = metrics.histogram('librarian_scheduler_lag_seconds',
+            'Time from when a scheduled job was due until it started')
+
+    @property
+    def jobs(self):
+        return [job for _, _, job in self.heap]
+
+    def add_job(self, job):
+        """ add a Job to the heap and wake the scheduler thread
+
+        Parameters:
+            job (Job): the job to add
+        """
+        with self.wake:
+            self.push(job, job.next_run(datetime.now()))
+            self.wake.notify()
+
+    def clear(self):
+        """ remove all jobs and wake the scheduler thread
+        """
+        with self.wake:
+            self.heap = []
+            self.wake.notify()
+
+    def push(self, job, when):
+        self.sequence += 1
+        heapq.heappush(self.heap, (when, self.sequence, job))
+
+    def start(self):
+        """ start the scheduler thread and the job worker pool
+        """
+        if self.running:
+            return
+        self.running = True
+        self.pool = ThreadPoolExecutor(max_workers=self.max_workers,
+                                       thread_name_prefix='Scheduler Worker')
+        t = threading.Thread(target=self.scheduler_thread)
+        t.daemon = True  # allows this thread to be auto-killed on program exit
+        t.name = 'Scheduler Thread'  # naming the thread helps with debugging
+        t.start()
+
+    def scheduler_thread(self):
+        """ sleep until the next job is due, hand it to a worker, repeat
+        """
+        with self.wake:
+            while True:
+                if not self.heap:
+                    self.wake.wait()
+                    continue
+                when, _, job = self.heap[0]
+                wait = (when - datetime.now()).total_seconds()
+                if wait > 0:
+                    self.wake.wait(timeout=min(wait, self.max_wait))
+                    continue
+                heapq.heappop(self.heap)
+                self.pool.submit(self.run_job, when, job)
+                self.push(job, job.next_run(max(when, datetime.now())))
+
+    def run_job(self, when, job):
+        """ run the action of a due job in a worker thread
+
+        Parameters:
+            when (datetime): time the job was due
+            job (Job): the job to run
+        """
+        self.lag.observe((datetime.now() - when).total_seconds())
+        try:
+            job.action(*job.args)
+        except Exception:
+            log.exception('Error running scheduled job due at ' + str(when))
+
 class Schedule:
     """ Methods and attributes to manage schedules.
 
@@ -36,6 +184,7 @@ class Schedule:
         # get schedules dictionary from yaml file
         schedules = settings.schedules
         self.gmail = gmail
+        self.scheduler = Scheduler()
         if schedules:  # at least one schedled item in yaml
             schedule_types = self.load_schedule_data(schedules)  # e.g., reminders
             s = self.setup_schedule(schedule_types)
@@ -65,7 +214,7 @@ class Schedule:
         for event_type in schedule_types:  # e.g., reminders, backups, etc.
             for _, event_specs in event_type.items():  # events are nested dictionaries from yaml
                 if 'message' in event_specs:  # this event action is 'send message'
-                    # days = event_specs.get('days', 'all')  # maybe in future?
+                    days = event_specs.get('days', 'all')
                     times = event_specs.get('times', [])
                     # times is a list of times in strings, like '10:30'
                     # print('list of times', *times)
@@ -75,12 +224,23 @@ class Schedule:
                     # print('channel:', channel)
                     phone = event_specs.get('phone', '')
                     # print('phone:', phone)
-                    func = self.send_sms
-                    args = (phone, message)
                     for t in times:
-                        schedule.every().day.at(t).do(self.send_sms, phone, message)
-                    # print('A: Number of timed jobs:', len(schedule.jobs))
-        return schedule
+                        job = Job(t, days, self.send_sms, (phone, message))
+                        self.scheduler.add_job(job)
+                    # print('A: Number of timed jobs:', len(self.scheduler.jobs))
+        return self.scheduler
+
+    def reschedule(self, settings):
+        """ replace all scheduled jobs with those in newly loaded settings
+
+        Parameters:
+            settings (Settings object): settings reloaded from YAML file
+        """
+        self.scheduler.clear()
+        if settings.schedules:
+            schedule_types = self.load_schedule_data(settings.schedules)
+            s = self.setup_schedule(schedule_types)
+            self.schedule_run(s)
 
     def send_sms(self, phone, message):
         """ send an SMS message
@@ -98,20 +258,11 @@ class Schedule:
         # a possible setup of the backup section of schedules is in example3.yaml
         pass
 
-    def schedule_run(self, schedule):
-        """ run all scheduled jobs that have been setup in schedule
+    def schedule_run(self, scheduler):
+        """ run all scheduled jobs that have been setup in scheduler
         Parameters:
-          schedule (schedule object): contains all scheduled jobs
+          scheduler (Scheduler object): contains all scheduled jobs
         """
 
-        if len(schedule.jobs):  # no need to start thread if no jobs in queue
-            t = threading.Thread(target=self.scheduler_thread)
-            # print('Starting scheduler thread')
-            t.daemon = True  # allows this thread to be auto-killed on program exit
-            t.name = 'Scheduler Thread'  # naming the thread helps with debugging
-            t.start()
-
-    def scheduler_thread(self):
-        while True:
-            schedule.run_pending()
-            sleep(1)
+        if len(scheduler.jobs):  # no need to start threads if no jobs in heap
+            scheduler.start()
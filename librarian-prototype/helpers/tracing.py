@@ -0,0 +1,148 @@
+"""tracing: sampled timing spans around librarian hot paths
+
+Provides the Tracer class, which times named spans, such as parsing a log
+line or composing a reply, for a sampled fraction of events and queries.
+Spans nest: a span started while another span is running in the same thread
+is recorded as its child. For each sampled stack of spans, the time spent in
+the innermost span is accumulated so that a stack profile in the "collapsed
+stack" format used by flamegraph.pl and speedscope can be written at exit.
+Per-span latencies are also recorded in the librarian_span_seconds histogram.
+
+A single Tracer instance, tracer, is shared by all librarian modules. It is
+off unless librarian.py is started with --trace. When off, a traced function
+costs one extra function call and one attribute check.
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import random
+import logging
+import threading
+import functools
+from time import perf_counter
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+from helpers.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+class Tracer:
+    """ Methods and attributes to record sampled timing spans
+
+    Sampling is decided once per outermost span (e.g. once per batch of new
+    log lines or once per query); all the spans nested inside a sampled span
+    are recorded, so each sampled stack is complete.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 0.0
+        self.local = threading.local()  # per thread stack of running spans
+        self.stacks = defaultdict(float)  # 'thread;span;span' -> self seconds
+        self.stacks_lock = threading.Lock()
+        self.histograms = {}  # span name -> librarian_span_seconds histogram
+
+    def start(self, sample_rate=0.01):
+        """ start recording spans
+
+        Parameters:
+            sample_rate (float): fraction of outermost spans to record, 0 to 1
+        """
+        self.sample_rate = sample_rate
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def span(self, name):
+        """ return a context manager that times a span if tracing is on
+
+        Parameters:
+            name (str): name of the span, e.g. 'HubData.parse_log_line'
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self.timed_span(name)
+
+    def traced(self, name):
+        """ decorator that times each call of a function as a span
+
+        Parameters:
+            name (str): name of the span, e.g. 'ChatBot.respond_to'
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.timed_span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def timed_span(self, name):
+        local = self.local
+        if not hasattr(local, 'stack'):
+            local.stack = []  # list of [name, child seconds] being timed
+            local.skipped = 0  # depth of spans inside an unsampled span
+        if local.skipped or (not local.stack and
+                             random.random() >= self.sample_rate):
+            local.skipped += 1  # not sampled; neither are its children
+            try:
+                yield
+            finally:
+                local.skipped -= 1
+            return
+        frame = [name, 0.0]
+        local.stack.append(frame)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            key = ';'.join([threading.current_thread().name] +
+                           [f[0] for f in local.stack])
+            local.stack.pop()
+            if local.stack:
+                local.stack[-1][1] += elapsed  # parent's time in children
+            with self.stacks_lock:
+                self.stacks[key] += elapsed - frame[1]
+            self.histogram(name).observe(elapsed)
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name, None)
+        if histogram is None:
+            histogram = metrics.histogram('librarian_span_seconds',
+                'Time spent in sampled tracing spans', {'span': name},
+                buckets=(0.00001, 0.0001, 0.001, 0.01, 0.1, 1, 10))
+            self.histograms[name] = histogram
+        return histogram
+
+    def collapsed_stacks(self):
+        """ return the sampled stacks in collapsed stack format
+
+        Each line is a semicolon separated stack of span names, starting with
+        the thread name, followed by the microseconds spent in the innermost
+        span. This is the input format of flamegraph.pl and speedscope.
+
+        Returns:
+            lines (list): lines like 'HubData;HubData.add_new_log_lines 1234'
+        """
+        with self.stacks_lock:
+            stacks = sorted(self.stacks.items())
+        return [key.replace(' ', '_') + ' ' + str(round(seconds * 1e6))
+                for key, seconds in stacks]
+
+    def write_collapsed_stacks(self, path):
+        """ write the sampled stacks to a file in collapsed stack format
+
+        Parameters:
+            path (str): file to write, e.g. librarian.folded
+        """
+        lines = self.collapsed_stacks()
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        log.warning('Wrote ' + str(len(lines)) + ' traced stacks to ' + path)
+
+tracer = Tracer()
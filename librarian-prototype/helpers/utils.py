@@ -4,11 +4,16 @@ Copyright (c) 2017 by Jeff Bass.
 License: MIT, see LICENSE for more details.
 """
 
+import os
 import sys
 import time
 import signal
+import socket
 import logging
+import builtins
+import threading
 import multiprocessing
+from contextlib import contextmanager
 
 def clean_shutdown_when_killed(signum, *args):
     """Close all connections cleanly and log shutdown
@@ -46,6 +51,83 @@ def interval_timer(interval, action):
 class YamlOptionsError(Exception):
     pass
 
+class StartupProfiler:
+    """ Time module imports and subsystem initialization during startup
+
+    Subsystem init times are always recorded, since timing a few subsystems
+    costs almost nothing. Import times are recorded only between calls to
+    start_import_timing() and stop_import_timing(), which replace the builtin
+    __import__ function with a timed version. Import times include the time
+    to import any modules that the imported module imports in turn.
+
+    A single instance, startup_profiler, is shared by all librarian modules.
+    """
+    def __init__(self):
+        self.import_times = {}  # module name -> seconds for its first import
+        self.init_times = {}  # subsystem name -> seconds to initialize
+        self.original_import = None
+        self.lock = threading.Lock()
+
+    def start_import_timing(self):
+        """ replace builtins.__import__ with a version that times imports
+        """
+        if self.original_import:
+            return
+        self.original_import = original_import = builtins.__import__
+        import_times = self.import_times
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if level or name in sys.modules:  # relative or already imported
+                return original_import(name, globals, locals, fromlist, level)
+            start = time.perf_counter()
+            try:
+                return original_import(name, globals, locals, fromlist, level)
+            finally:
+                import_times.setdefault(name, time.perf_counter() - start)
+
+        builtins.__import__ = timed_import
+
+    def stop_import_timing(self):
+        """ restore the original builtins.__import__
+        """
+        if self.original_import:
+            builtins.__import__ = self.original_import
+            self.original_import = None
+
+    @contextmanager
+    def timing(self, name):
+        """ context manager that records the time to initialize a subsystem
+
+        Parameters:
+            name (str): name of the subsystem, e.g. 'HubData'
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.init_times[name] = time.perf_counter() - start
+
+    def report(self, n_imports=20):
+        """ return report lines of slowest imports and all subsystem times
+
+        Parameters:
+            n_imports (int): number of slowest imports to report
+
+        Returns:
+            lines (list): lines of text reporting the startup times
+        """
+        lines = ['Startup profile: slowest imports (seconds, inclusive)']
+        slowest = sorted(self.import_times.items(), key=lambda item: -item[1])
+        for name, seconds in slowest[:n_imports]:
+            lines.append('  {:8.3f}  {}'.format(seconds, name))
+        lines.append('Startup profile: subsystem init (seconds)')
+        for name, seconds in self.init_times.items():
+            lines.append('  {:8.3f}  {}'.format(seconds, name))
+        return lines
+
+startup_profiler = StartupProfiler()
+
 class Patience:
     """Timing class using system ALARM signal.
 
@@ -74,32 +156,107 @@ class Patience:
     def raise_timeout(self, *args):
         raise Patience.Timeout()
 
-class StallWatcher:
-    def __init__(self):
-        self.stall_p = None
-        if settings.stall_watcher:  # stall_watcher option set to True
-            pid = os.getpid()
-            self.stall_p = multiprocessing.Process(daemon=True,
-                               args=((pid, self.patience,)),
-                               target=self.stall_watcher)
-            self.stall_p.start()
+class Heartbeats:
+    """ Shared memory progress stamps for the librarian's main threads
 
-    def stall_watcher(self, pid, patience):
-        """ Watch the main process cpu_times.user; sys.exit() if not advancing
+    Each watched thread has a slot in a multiprocessing.Array that a stall
+    watcher process can read. A thread calls stamp() each time it makes
+    progress. Before it blocks waiting for outside input (like a CLI query),
+    it calls idle(), since waiting for input is not a stall. A slot that is
+    0 is not checked; a slot that is not 0 holds the time.monotonic() of the
+    last progress, which is the same clock in every process on the computer.
+    The patience and each slot's stamping interval are shared memory too, so
+    a change in the main process is seen by the stall watcher process. A
+    thread is stalled after its interval plus patience seconds without
+    progress, so a thread that stamps once per log_check_interval is not
+    stalled between stamps.
+
+    Parameters:
+        names (list): names of the watched threads, one slot per name
+    """
+    def __init__(self, names):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.stamps = multiprocessing.Array('d', len(self.names), lock=False)
+        self.intervals = multiprocessing.Array('d', len(self.names), lock=False)
+        self.patience = multiprocessing.Value('d', 10.0, lock=False)
+
+    def stamp(self, name):
+        """ record that the named thread has made progress
+        """
+        self.stamps[self.index[name]] = time.monotonic()
+
+    def idle(self, name):
+        """ record that the named thread is waiting for input; not checked
+        """
+        self.stamps[self.index[name]] = 0.0
+
+    def set_interval(self, name, seconds):
+        """ set the usual seconds between stamps of the named thread
+        """
+        self.intervals[self.index[name]] = seconds
+
+    @contextmanager
+    def blocking(self, name, seconds):
+        """ context manager for a step that may block for up to seconds
+
+        A step like a Gmail send can take much longer than the usual interval
+        between stamps. The named thread is stamped and given the longer
+        interval for the step; then it is stamped again and its interval is
+        restored, even if the step raises an exception.
 
         Parameters:
-            pid (int): process ID of the main imagenode process
-            patience (int): how long to wait for each check repeated check
+            name (str): name of the watched thread, e.g. 'main loop'
+            seconds (float): longest time the step may take
         """
-        p = psutil.Process(pid)
-        main_time = p.cpu_times().user
-        sleep_time = patience
-        sleep(sleep_time)
-        while True:
-            last_main_time = main_time
-            main_time = p.cpu_times().user
-            delta_time = round(abs(main_time - last_main_time))
-            if delta_time < 1:
-                os.kill(pid, signal.SIGTERM) # p.terminate() # or os.kill(pid, signal.SIGTERM)
-                sys.exit()
-            sleep(sleep_time)
+        i = self.index[name]
+        interval = self.intervals[i]
+        self.stamps[i] = time.monotonic()
+        self.intervals[i] = seconds
+        try:
+            yield
+        finally:
+            self.stamps[i] = time.monotonic()
+            self.intervals[i] = interval
+
+    def set_patience(self, patience):
+        """ set the seconds without progress before a thread is stalled
+        """
+        self.patience.value = patience
+
+    def stalled(self):
+        """ return the names of threads without progress for their stamping
+        interval plus patience seconds
+        """
+        now = time.monotonic()
+        patience = self.patience.value
+        return [name for name, stamp, interval
+                in zip(self.names, self.stamps, self.intervals)
+                if stamp and now - stamp > interval + patience]
+
+# one Heartbeats instance shared by all librarian modules and the stall watcher
+heartbeats = Heartbeats(['main loop', 'HubData ingest',
+                         'CLI QueryReceiver', 'Gmail QueryReceiver'])
+
+def systemd_notify(state):
+    """ send a state like 'WATCHDOG=1' to systemd, if running as a service
+
+    Uses the NOTIFY_SOCKET set by systemd for the sd_notify protocol. When the
+    notification is sent by a child process (like the stall watcher), the
+    service file needs "NotifyAccess=all".
+
+    Parameters:
+        state (str): the notification, e.g. 'WATCHDOG=1'
+
+    Returns:
+        True if the notification was sent; False if not running under systemd
+    """
+    address = os.environ.get('NOTIFY_SOCKET', None)
+    if not address:
+        return False
+    if address.startswith('@'):  # abstract namespace socket
+        address = '\0' + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.connect(address)
+        sock.sendall(state.encode())
+    return True
@@ -19,28 +19,78 @@ import signal
 import logging
 import logging.handlers
 import time
+import argparse
+import threading
 import traceback
-from helpers.library import Settings
-from helpers.library import Librarian
-from helpers.utils import clean_shutdown_when_killed
+from helpers.utils import clean_shutdown_when_killed, startup_profiler
+from helpers.utils import heartbeats
+from helpers.metrics import metrics
+from helpers.tracing import tracer
+
+# seconds a reply send (a Gmail send may retry) or a settings reload may take;
+# the main loop is stalled if one takes longer than this plus patience
+SEND_SECONDS = 120
+RELOAD_SECONDS = 60
 
 def main():
+    args = parse_args()
+    if args.profile_startup:  # time imports, including helpers.library below
+        startup_profiler.start_import_timing()
+    if args.trace:  # record sampled timing spans of hot paths
+        tracer.start(args.trace)
+    start_time = time.perf_counter()
+    # helpers.library is imported here so that its imports can be timed
+    from helpers.library import Settings
+    from helpers.library import Librarian
     # set up controlled shutdown when Kill Process or SIGTERM received
     signal.signal(signal.SIGTERM, clean_shutdown_when_killed)
+    # reload changed settings from librarian.yaml when SIGHUP received
+    reload_requested = threading.Event()
+    signal.signal(signal.SIGHUP, lambda *args: reload_requested.set())
     log = start_logging()
     try:
         log.warning('Starting librarian.py')
         settings = Settings()  # get settings for hubs, communications channels
         librarian = Librarian(settings)  # start all the librarian processes
+        if args.profile_startup:  # wait for all subsystems to report timing
+            librarian.wait_until_ready()
+            startup_profiler.stop_import_timing()
+            report_startup_profile(log, time.perf_counter() - start_time)
+        # answer queries as soon as the event data is loaded, even while
+        # slower subsystems, like the Gmail channel or the ImageCatalog, are
+        # still starting; image and detection queries are told to ask again
+        librarian.wait_until_ready('ChatBot')
         # forever event loop
         while True:
+            heartbeats.stamp('main loop')  # progress seen by stall_watcher
+            if reload_requested.is_set() or settings.file_changed():
+                reload_requested.clear()
+                librarian.reload_pending = True
+            # raise any subsystem startup error; reload once all are ready
+            if librarian.check_subsystems() and librarian.reload_pending:
+                with heartbeats.blocking('main loop', RELOAD_SECONDS):
+                    settings = librarian.reload_settings(settings)
+            channels = list(librarian.comm_channels)  # channels that are ready
+            # the loop sleeps 1 second per channel between stamps
+            interval = max(1, len(channels))
+            heartbeats.set_interval('main loop', interval)
+            if not channels:
+                time.sleep(1)  # wait for a channel to finish starting
             # for each initialized librarian communications channel
-            for channel in librarian.comm_channels:
+            for channel in channels:
                 # Listen for and respond to incoming questions
                 request = channel.next_query()
                 if request:
-                    reply = librarian.compose_reply(request)
-                    channel.send_reply(reply)
+                    start = time.perf_counter()
+                    with tracer.span('Librarian.reply'):  # one query's stack
+                        reply = librarian.compose_reply(request, channel.name)
+                        # a Gmail send can block and retry for a while
+                        with heartbeats.blocking('main loop', SEND_SECONDS):
+                            channel.send_reply(reply)
+                    metrics.histogram('librarian_reply_seconds',
+                        'Time to compose and send a reply to a query',
+                        {'channel': channel.name}).observe(
+                        time.perf_counter() - start)
                 time.sleep(1)  # sleep before next channel check
 
     except (KeyboardInterrupt, SystemExit):
@@ -50,9 +100,29 @@ def main():
     finally:
         if 'librarian' in locals():
             librarian.closeall(settings) # close files and communications
+        if args.trace:
+            tracer.write_collapsed_stacks(args.trace_file)
         log.info('Exiting librarian.py')
         sys.exit()
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='librarian: answer questions '
+        'using imagehub event messages, images and sensor data')
+    parser.add_argument('--profile-startup', action='store_true',
+        help='report per-import and per-subsystem startup times')
+    parser.add_argument('--trace', type=float, default=0, metavar='FRACTION',
+        help='time hot path spans for this fraction of events and queries')
+    parser.add_argument('--trace-file', default='librarian.folded',
+        help='collapsed stack profile written at exit for flamegraph.pl')
+    return parser.parse_args()
+
+def report_startup_profile(log, total_seconds):
+    lines = startup_profiler.report()
+    lines.append('  {:8.3f}  {}'.format(total_seconds, 'Total startup'))
+    for line in lines:
+        print(line)
+        log.warning(line)
+
 def start_logging():
     log = logging.getLogger()
     handler = logging.handlers.RotatingFileHandler('librarian.log',
@@ -0,0 +1,143 @@
+"""test_alerts: test AlertRules matching, debouncing and sending
+
+Run from the top directory of the repository:
+    python -m pytest tests
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import sys
+import threading
+from pathlib import Path
+from datetime import datetime, timedelta
+
+LIBRARIAN = Path(__file__).resolve().parents[1] / 'librarian-prototype'
+sys.path.insert(0, str(LIBRARIAN))
+
+import pytest
+from helpers.utils import YamlOptionsError
+from helpers.alerts import AlertRule, AlertRules
+
+class AlertSettings:
+    def __init__(self, alerts):
+        self.alerts = alerts
+        self.queuemax = 50
+
+class FakeGmail:
+    def __init__(self):
+        self.sent = []
+        self.all_sent = threading.Event()
+        self.expected = 1
+
+    def gmail_send_SMS(self, phone, message):
+        self.sent.append((phone, message))
+        if len(self.sent) >= self.expected:
+            self.all_sent.set()
+
+HOT = {'garage_too_hot': {'node': 'Garage', 'event': 'Temp', 'above': 95,
+                          'phone': '8055551212', 'message': 'Garage is hot',
+                          'repeat_minutes': 30}}
+
+def blocked_rules(alerts, gmail_ready):
+    """ AlertRules whose sender waits for gmail_ready, so alerts stay queued
+    """
+    return AlertRules(AlertSettings(alerts), lambda: gmail_ready.wait() and None)
+
+def queued(rules):
+    return [rules.alert_q.get_nowait() for _ in range(rules.alert_q.qsize())]
+
+def test_matching_alert_is_debounced():
+    gmail_ready = threading.Event()
+    rules = blocked_rules(HOT, gmail_ready)
+    start = datetime(2021, 9, 4, 14, 0)
+    for minutes, temp in [(0, '96'), (10, '97'), (20, '90'), (31, '98')]:
+        rules.check_event(('Garage', 'Temp', start + timedelta(minutes=minutes),
+                           temp))
+    assert queued(rules) == [('8055551212', 'Garage is hot')] * 2
+    gmail_ready.set()
+
+def test_event_already_checked_is_skipped():
+    gmail_ready = threading.Event()
+    rules = blocked_rules(HOT, gmail_ready)
+    when = datetime(2021, 9, 4, 14, 0)
+    rules.check_event(('Garage', 'Temp', when, '96'))
+    rules.rules[('garage', 'temp')][0].last_sent = None  # not debounced
+    rules.check_event(('Garage', 'Temp', when, '96'))  # a reloaded log line
+    assert len(queued(rules)) == 1
+    gmail_ready.set()
+
+def test_duration_rule_alerts_after_minutes():
+    alerts = {'door_open': {'node': 'Garage', 'event': 'Door', 'value': 'open',
+                            'minutes': 10, 'phone': '8055551212'}}
+    gmail_ready = threading.Event()
+    rules = blocked_rules(alerts, gmail_ready)
+    now = datetime.now()
+    rules.check_event(('Garage', 'Door', now - timedelta(minutes=5), 'open'))
+    rules.check_durations()
+    assert queued(rules) == []
+    rules.check_event(('Garage', 'Door', now - timedelta(minutes=4), 'closed'))
+    rules.check_event(('Garage', 'Door', now - timedelta(minutes=15), 'open'))
+    rules.check_durations()  # the older open event was skipped; still closed
+    assert queued(rules) == []
+    rules.check_event(('Garage', 'Door', now - timedelta(minutes=3), 'open'))
+    rules.duration_rules[0].armed_since = now - timedelta(minutes=11)
+    rules.check_durations()
+    assert queued(rules) == [('8055551212', 'Garage Door alert')]
+    gmail_ready.set()
+
+def test_alerts_checked_before_gmail_is_ready_are_sent():
+    gmail = FakeGmail()
+    gmail_ready = threading.Event()
+
+    def wait_for_gmail():
+        gmail_ready.wait()
+        return gmail
+
+    rules = AlertRules(AlertSettings(HOT), wait_for_gmail)
+    rules.check_event(('Garage', 'Temp', datetime(2021, 9, 4, 14, 0), '99'))
+    assert gmail.sent == []
+    gmail_ready.set()
+    assert gmail.all_sent.wait(5)
+    assert gmail.sent == [('8055551212', 'Garage is hot')]
+
+def test_rule_matches_value_limits_and_time_window():
+    when = datetime(2021, 9, 4, 23, 30)
+    moving = AlertRule('night_motion', {'node': 'Barn', 'event': 'motion',
+                       'value': 'Moving', 'between': ['23:00', '05:00']})
+    assert moving.matches(when, 'moving')
+    assert moving.matches(when.replace(hour=4), 'moving')  # past midnight
+    assert not moving.matches(when.replace(hour=12), 'moving')
+    assert not moving.matches(when, 'still')
+    cold = AlertRule('cold', {'node': 'Barn', 'event': 'Temp',
+                              'above': 32, 'below': 40})
+    assert cold.matches(when, '35')
+    assert not cold.matches(when, '32') and not cold.matches(when, '40')
+    assert not cold.matches(when, 'unknown')
+    assert cold.message == 'Barn Temp alert'
+    with pytest.raises(YamlOptionsError):
+        AlertRule('no_event', {'node': 'Barn'})
+
+def test_events_checked_only_against_their_rules():
+    gmail_ready = threading.Event()
+    rules = blocked_rules(HOT, gmail_ready)
+    when = datetime(2021, 9, 4, 14, 0)
+    rules.check_event(('Barn', 'Temp', when, '99'))  # no rule for the barn
+    rules.check_event((' garage ', 'TEMP', when, ' 99 '))
+    assert queued(rules) == [('8055551212', 'Garage is hot')]
+    assert list(rules.newest) == [('garage', 'temp')]
+    gmail_ready.set()
+
+def test_reloaded_rules_replace_the_old_ones():
+    gmail_ready = threading.Event()
+    rules = blocked_rules(HOT, gmail_ready)
+    rules.load_rules({'barn_cold': {'node': 'Barn', 'event': 'Temp',
+                                    'below': 32, 'phone': '8055551212'}})
+    when = datetime(2021, 9, 4, 14, 0)
+    rules.check_event(('Garage', 'Temp', when, '99'))
+    rules.check_event(('Barn', 'Temp', when, '20'))
+    assert queued(rules) == [('8055551212', 'Barn Temp alert')]
+    rules.load_rules(None)  # the alerts section was removed
+    rules.check_event(('Barn', 'Temp', when + timedelta(hours=2), '20'))
+    assert queued(rules) == []
+    gmail_ready.set()
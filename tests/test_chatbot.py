@@ -0,0 +1,76 @@
+"""test_chatbot: test ChatBot replies about motion images
+
+Run from the top directory of the repository:
+    python -m pytest tests
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import sys
+from pathlib import Path
+from datetime import datetime, timedelta
+
+LIBRARIAN = Path(__file__).resolve().parents[1] / 'librarian-prototype'
+sys.path.insert(0, str(LIBRARIAN))
+
+from helpers.comms.chatbot import ChatBot
+from helpers.image_skills import MotionBurst, ImageFile
+
+class FakeEventImages:
+    def __init__(self, burst):
+        self.burst = burst
+
+    def latest_burst(self, node, with_images=True):
+        return self.burst
+
+class FakePreviews:
+    def __init__(self, preview):
+        self.preview = preview
+        self.bursts = []
+
+    def burst_preview(self, burst):
+        self.bursts.append(burst)
+        return self.preview
+
+def mailbox_burst():
+    when = datetime.now() - timedelta(minutes=5)
+    burst = MotionBurst('driveway mailbox', when)
+    for i in range(3):
+        name = 'Driveway-Mailbox-{}.jpg'.format(
+            (when + timedelta(seconds=i)).strftime('%Y-%m-%dT%H.%M.%S'))
+        burst.add_image(ImageFile(when, 'driveway mailbox', '/images/' + name))
+    return burst
+
+def test_burst_cited_by_full_size_image_without_previews():
+    burst = mailbox_burst()
+    chatbot = ChatBot(event_images=FakeEventImages(burst))
+    reply = chatbot.report_images({'driveway mailbox'})
+    assert '3 images, first Driveway-Mailbox-' in reply
+
+def test_burst_cited_by_preview():
+    burst = mailbox_burst()
+    previews = FakePreviews(Path('/data/previews/0a1b.jpg'))
+    chatbot = ChatBot(event_images=FakeEventImages(burst), previews=previews)
+    reply = chatbot.report_images({'driveway mailbox'})
+    assert previews.bursts == [burst]
+    assert '3 images, preview /data/previews/0a1b.jpg.' in reply
+    assert 'Driveway-Mailbox-' not in reply
+
+def test_burst_cited_by_image_when_preview_cannot_be_made():
+    burst = mailbox_burst()
+    chatbot = ChatBot(event_images=FakeEventImages(burst),
+                      previews=FakePreviews(None))
+    reply = chatbot.report_images({'driveway mailbox'})
+    assert 'first Driveway-Mailbox-' in reply
+
+def test_queries_about_stores_still_loading():
+    chatbot = ChatBot(loading=['event_images', 'detections'])
+    reply = chatbot.respond_to('pictures from the driveway mailbox')
+    assert 'Still loading images' in reply
+    assert 'Still loading detected objects' in chatbot.respond_to(
+        'any coyotes seen this week?')
+    chatbot.attach(event_images=FakeEventImages(mailbox_burst()))
+    assert chatbot.loading == {'detections'}
+    reply = chatbot.report_images({'driveway mailbox'})
+    assert '3 images, first Driveway-Mailbox-' in reply
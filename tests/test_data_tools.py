@@ -0,0 +1,333 @@
+"""test_data_tools: test HubData event storage, retention and history
+
+Each test writes small imagehub event logs into a temporary directory.
+Run from the top directory of the repository:
+    python -m pytest tests
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import os
+import sys
+from pathlib import Path
+from datetime import datetime, timedelta
+
+LIBRARIAN = Path(__file__).resolve().parents[1] / 'librarian-prototype'
+sys.path.insert(0, str(LIBRARIAN))
+
+import pytest
+np = pytest.importorskip('numpy')
+from helpers.data_tools import HubData, SeriesTiers, EPOCH
+
+class HubSettings:
+    """ The settings HubData uses, without a yaml file
+    """
+    def __init__(self, log_dir, lib_dir, retention=None, log_archive=False):
+        self.log_directory = str(log_dir)
+        self.lib_dir = Path(lib_dir)
+        self.log_check_interval = 60  # these tests do not follow the log
+        self.retention = retention
+        self.log_archive = log_archive
+
+def log_line(when, node, event, value):
+    return '{},{:03d} ~ {}|{}|{}\n'.format(when.strftime('%Y-%m-%d %H:%M:%S'),
+        when.microsecond // 1000, node, event, value)
+
+def write_logs(log_dir, days, per_day):
+    """ write dated logs for days before today and a current log for today;
+    every line is a Barn Temp value with a fraction that float32 rounds
+    """
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    for day in range(days, -1, -1):
+        date = today - timedelta(days=day)
+        name = 'imagehub.log' + ('.' + date.strftime('%Y-%m-%d') if day else '')
+        with open(Path(log_dir) / name, 'w') as f:
+            for i in range(per_day):
+                when = date + timedelta(minutes=7 * i)
+                f.write(log_line(when, 'Barn', 'Temp', '{:.1f}'.format(
+                    60 + (i % 37) / 10)))
+                if i % 5 == 0:
+                    f.write(log_line(when, 'Barn', 'motion', 'moving'))
+
+def make_hub(tmp_path, retention=None, log_archive=False, lib='lib'):
+    lib_dir = tmp_path / lib
+    lib_dir.mkdir(exist_ok=True)
+    hub = HubData(HubSettings(tmp_path / 'logs', lib_dir, retention, log_archive))
+    hub.close()  # stop saving tiers; tests call save_tiers themselves
+    return hub
+
+@pytest.fixture
+def logs(tmp_path):
+    (tmp_path / 'logs').mkdir()
+    write_logs(tmp_path / 'logs', days=2, per_day=100)
+    return tmp_path
+
+def tier_columns(hub, key):
+    return [(list(rollup.starts), list(rollup.mins), list(rollup.maxs),
+             list(rollup.sums), list(rollup.counts))
+            for name, rollup in hub.tiers[key].tiers]
+
+def test_text_and_archive_paths_give_the_same_tiers(logs):
+    from helpers.log_archive import convert_directory
+    text_hub = make_hub(logs)
+    archive_dir = logs / 'archived' / 'log_archive'
+    archive_dir.mkdir(parents=True)
+    convert_directory(logs / 'logs', archive_dir, 'imagehub.log',
+                      HubData.parse_log_line)
+    archive_hub = make_hub(logs, log_archive=True, lib='archived')
+    assert archive_hub.event_data == text_hub.event_data
+    assert (tier_columns(archive_hub, ('barn', 'temp')) ==
+            tier_columns(text_hub, ('barn', 'temp')))
+    assert ('barn', 'motion') not in text_hub.tiers  # not a numeric series
+
+def test_saved_tiers_are_not_counted_twice(logs):
+    hub = make_hub(logs)
+    hub.save_tiers()
+    reloaded = make_hub(logs)  # loads the saved tiers, then the same logs
+    key = ('barn', 'temp')
+    assert tier_columns(reloaded, key) == tier_columns(hub, key)
+    assert reloaded.tiers[key].loaded_through == hub.tiers[key].newest
+
+def test_saved_tiers_outlast_the_loaded_logs(logs):
+    hub = make_hub(logs)
+    hub.save_tiers()
+    day_counts = sum(hub.tiers[('barn', 'temp')].tiers[-1][1].counts)
+    assert day_counts == 300  # 3 days of 100 values
+    for path in (logs / 'logs').glob('imagehub.log.*'):
+        path.unlink()  # the dated logs are gone, e.g. pruned by the imagehub
+    reloaded = make_hub(logs)
+    assert sum(reloaded.tiers[('barn', 'temp')].tiers[-1][1].counts) == 300
+
+def test_series_tiers_skip_values_already_loaded():
+    tiers = SeriesTiers()
+    when = datetime(2021, 9, 24, 12, 0)
+    tiers.loaded_through = (when - EPOCH).total_seconds()
+    tiers.add(when, 70.0)  # no newer than the saved tiers
+    tiers.add(when + timedelta(seconds=1), 71.0)
+    ts = np.array([(when - EPOCH).total_seconds() + s for s in (-60, 0, 2)])
+    tiers.add_many(ts, np.array([1.0, 2.0, 72.0]))
+    name, hourly = tiers.tiers[1]
+    assert list(hourly.counts) == [2.0]
+    assert list(hourly.sums) == [143.0]
+
+def test_retention_policies_from_yaml():
+    from helpers.data_tools import Retention
+    from helpers.utils import YamlOptionsError
+    retention = Retention({'default': {'count': 10},
+                           'series': {'Barn|Temp': {'days': 7, 'memory_kb': 2}}})
+    assert retention.policy('barn', 'temp') == (None, timedelta(days=7), 2048)
+    assert retention.policy('barn', 'motion') == (10, None, None)
+    assert retention.max_days == 7  # enough dated logs for the longest span
+    assert Retention(None).policy('barn', 'temp').count == 300
+    assert Retention(None).max_days == 3
+    with pytest.raises(YamlOptionsError):
+        Retention({'series': {'Barn Temp': {'count': 5}}})
+
+def test_series_trimmed_by_count_and_age(logs):
+    hub = make_hub(logs, {'default': {'count': 10},
+                          'series': {'Barn|motion': {'days': 1}}})
+    temps = hub.event_data['barn']['temp']
+    assert len(temps) == 10
+    assert temps[0][0] > temps[-1][0]  # newest first
+    newest = temps[0][0]
+    assert temps[-1][0] == newest - timedelta(minutes=7 * 9)  # the newest 10
+    motion = hub.event_data['barn']['motion']
+    assert motion[0][0] - motion[-1][0] <= timedelta(days=1)
+    assert len(motion) > 10  # count of the default policy does not apply
+
+def test_memory_cap_trims_largest_series_first(logs):
+    hub = make_hub(logs, {'memory_mb': 0.01})
+    cap = hub.retention.max_bytes
+    assert hub.data_bytes <= cap
+    assert hub.data_bytes == sum(hub.series_bytes.values())
+    temps, motion = hub.event_data['barn']['temp'], hub.event_data['barn']['motion']
+    assert 0 < len(motion) <= len(temps)  # temp had the most values
+    assert len(temps) < 300
+    assert hub.evicted.value > 0
+
+def test_time_index_extend_merges_out_of_order_batches():
+    from helpers.data_tools import TimeIndex
+    start = datetime(2021, 9, 24, 12, 0)
+    index = TimeIndex()
+    index.extend([(start + timedelta(minutes=m), m) for m in (5, 1, 3)])
+    assert index.items == [1, 3, 5]
+    index.extend([(start + timedelta(minutes=m), m) for m in (6, 7)])  # appended
+    index.extend([(start + timedelta(minutes=m), m) for m in (4, 0)])  # merged
+    assert index.items == [0, 1, 3, 4, 5, 6, 7]
+    assert index.times == sorted(index.times)
+    index.add(start + timedelta(minutes=2), 2)
+    assert index.between(start + timedelta(minutes=2),
+                         start + timedelta(minutes=4)) == [2, 3, 4]
+    assert index.latest(before=start + timedelta(seconds=90)) == 1
+    assert index.latest(before=start - timedelta(minutes=1)) is None
+    index.discard_oldest(3)
+    assert index.items == [3, 4, 5, 6, 7]
+
+def write_log(path, start, count, seconds_apart=1.0, mode='w'):
+    """ write count Barn Temp lines, seconds_apart; return their datetimes
+    """
+    times = []
+    with open(path, mode) as f:
+        for i in range(count):
+            when = start + timedelta(seconds=i * seconds_apart)
+            f.write(log_line(when, 'Barn', 'Temp', str(i)))
+            times.append(when)
+    return times
+
+def times_between(mapped, start, end):
+    return [when for when in (HubData.parse_log_line(line)[2]
+            for line in mapped.lines_between(start, end)) if start <= when <= end]
+
+def test_mapped_log_finds_every_line_in_range(tmp_path, monkeypatch):
+    from helpers.data_tools import MappedLog
+    monkeypatch.setattr(MappedLog, 'index_bytes', 500)
+    path = tmp_path / 'imagehub.log'
+    times = write_log(path, datetime(2021, 9, 24, 12, 0), 1000)
+    mapped = MappedLog(path)
+    assert 50 < len(mapped.times) < 200  # a sparse index
+    for first, last in [(0, 999), (0, 0), (999, 999), (123, 456), (500, 501)]:
+        expected = times[first:last + 1]
+        assert times_between(mapped, times[first], times[last]) == expected
+    assert len(mapped.lines_between(times[123], times[456])) < 600  # not all
+    before = datetime(2021, 9, 24, 11, 0)
+    assert times_between(mapped, before, before + timedelta(minutes=30)) == []
+    mapped.close()
+
+def test_mapped_log_finds_lines_at_start_before_an_index_entry(tmp_path,
+                                                                monkeypatch):
+    from helpers.data_tools import MappedLog
+    monkeypatch.setattr(MappedLog, 'index_bytes', 500)
+    path = tmp_path / 'imagehub.log'
+    start = datetime(2021, 9, 24, 12, 0)
+    for second in range(4):  # 100 lines with each datetime
+        write_log(path, start + timedelta(seconds=second), 100, 0, mode='a')
+    mapped = MappedLog(path)
+    at = start + timedelta(seconds=1)
+    assert len(times_between(mapped, at, at)) == 100
+    mapped.close()
+
+def test_mapped_log_refresh_indexes_appended_and_replaced_files(tmp_path):
+    from helpers.data_tools import MappedLog
+    path = tmp_path / 'imagehub.log'
+    start = datetime(2021, 9, 24, 12, 0)
+    write_log(path, start, 10)
+    mapped = MappedLog(path)
+    later = start + timedelta(hours=1)
+    write_log(path, later, 5, mode='a')
+    assert times_between(mapped, later, later + timedelta(hours=1)) == []
+    mapped.refresh()
+    assert len(times_between(mapped, later, later + timedelta(hours=1))) == 5
+    replacement = tmp_path / 'new.log'  # e.g. the log was rotated
+    write_log(replacement, start + timedelta(days=1), 3)
+    os.replace(replacement, path)
+    mapped.refresh()
+    assert times_between(mapped, start, later + timedelta(hours=1)) == []
+    assert len(times_between(mapped, start, start + timedelta(days=2))) == 3
+    mapped.close()
+
+def test_history_reads_dated_and_current_logs(logs):
+    hub = make_hub(logs)
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    start, end = today - timedelta(hours=13), today + timedelta(hours=1)
+    history = hub.fetch_history('Barn', 'Temp', start, end)
+    times = [when for when, value in history]
+    assert times == sorted(times)
+    assert times[0] >= start and times[-1] <= end
+    # yesterday 11:05 through 11:33 and today 00:00 through 00:56
+    assert len(times) == 5 + 9
+    assert today in times
+    for mapped in hub.history.logs.values():
+        mapped.close()
+
+class DetectionSettings:
+    def __init__(self, detections_directory):
+        self.detections_directory = str(detections_directory)
+        self.log_check_interval = 3600  # tests call check_for_new_detections
+
+DETECTIONS = """\
+2021-09-23 16:58:47,437 ~ Driveway Mailbox|Mail Truck|0.92|Driveway-Mailbox-2021-09-23T16.58.47.437149.jpg|12,40,210,180
+2021-09-23 17:10:02,000 ~ Barn|coyote|0.71
+2021-09-23 18:30:00,500 ~ Garage|coyote|0.88||1.5,2,3,4
+not a detection line
+2021-09-23 18:31:00,000 ~ Garage|
+2021-09-23 18:32:00,000
+"""
+
+def test_detections_indexed_by_label_node_and_hour(tmp_path):
+    from helpers.data_tools import DetectionStore
+    (tmp_path / 'yolo').mkdir()
+    (tmp_path / 'yolo' / 'detected-objects.txt').write_text(DETECTIONS)
+    store = DetectionStore(DetectionSettings(tmp_path))
+    assert store.labels() == {'mail truck', 'coyote'}
+    truck = store.last_seen('Mail Truck')
+    assert truck.node == 'driveway mailbox'
+    assert truck.confidence == 0.92 and truck.box == (12, 40, 210, 180)
+    coyote = store.last_seen('coyote')
+    assert coyote.node == 'garage' and coyote.box is None  # malformed box
+    assert store.last_seen('coyote', node='Barn').when == datetime(
+        2021, 9, 23, 17, 10, 2)
+    assert store.last_seen('coyote', node='Driveway Mailbox') is None
+    day = datetime(2021, 9, 23)
+    assert len(store.seen_between('coyote', day, day + timedelta(hours=18))) == 1
+    assert [d.label for d in store.node_detections('garage', day,
+            day + timedelta(days=1))] == ['coyote']
+    assert store.label_counts(day, day + timedelta(days=1)) == {
+        'mail truck': 1, 'coyote': 2}
+    assert store.label_counts(day + timedelta(hours=17, minutes=30),
+                              day + timedelta(hours=17, minutes=45)) == {
+        'coyote': 1}  # whole hours
+
+def test_detection_files_followed_like_the_event_log(tmp_path):
+    from helpers.data_tools import DetectionStore, Detection
+    path = tmp_path / 'detected-objects.txt'
+    path.write_text(DETECTIONS)
+    store = DetectionStore(DetectionSettings(tmp_path))
+    with open(path, 'a') as f:
+        f.write('2021-09-24 06:00:00,000 ~ Barn|deer|0.6\n2021-09-24 06:0')
+    store.check_for_new_detections()
+    assert store.last_seen('deer').node == 'barn'
+    with open(path, 'a') as f:  # the partial line is finished
+        f.write('1:00,000 ~ Barn|deer|0.7\n')
+    store.check_for_new_detections()
+    assert store.last_seen('deer').confidence == 0.7
+    replacement = tmp_path / 'new.txt'
+    replacement.write_text('2021-09-25 06:00:00,000 ~ Barn|fox\n')
+    os.replace(replacement, path)  # a rotated file is read from its start
+    store.check_for_new_detections()
+    assert store.last_seen('fox') is not None
+    when = datetime(2021, 9, 25, 7, 0, 0, 250000)
+    store.record_detections([Detection(when, 'Barn', 'owl', 0.5,
+                                       '/images/Barn-x.jpg', (1, 2, 3, 4))])
+    assert store.last_seen('owl') == Detection(when, 'barn', 'owl', 0.5,
+                                               'Barn-x.jpg', (1, 2, 3, 4))
+    reloaded = DetectionStore(DetectionSettings(tmp_path))  # after a restart
+    assert reloaded.last_seen('owl') == store.last_seen('owl')
+    assert reloaded.last_seen('fox') is not None
+    assert reloaded.last_seen('deer') is None  # its file was replaced
+
+def test_detection_lines_without_datetime_node_or_label_are_skipped(tmp_path):
+    from helpers.data_tools import DetectionStore
+    store = DetectionStore(DetectionSettings(tmp_path))
+    for line in ['2021-09-23 18:32:00,000', '2021-09-23 18:32:00,000 ~ Barn',
+                 'Barn|coyote', '']:
+        assert store.parse_detection_line(line) is None
+    assert store.parse_detection_line(
+        '2021-09-23 18:32:00,000 ~ Barn|Coyote').label == 'coyote'
+
+def test_recorded_events_are_ingested_like_new_log_lines(logs):
+    hub = make_hub(logs, {'memory_mb': 0.01})
+    heard = []
+    hub.event_listeners.append(heard.append)
+    newest = hub.event_data['barn']['temp'][0][0]
+    events = [('WaterMeter', 'water_flow', newest + timedelta(seconds=s), str(s))
+              for s in (2, 1, 3)]
+    events.append(('Barn', 'Temp', newest - timedelta(minutes=1), '70'))
+    hub.record_events(events)
+    flow = hub.event_data['watermeter']['water_flow']
+    assert [value for when, value in flow] == ['3', '2', '1']  # newest first
+    assert hub.event_data['barn']['temp'][0][0] == newest  # older one skipped
+    assert [event[3] for event in heard] == ['1', '2', '3']
+    assert hub.data_bytes <= hub.retention.max_bytes
+    hub.record_events([('WaterMeter', 'water_flow', newest, '0')])  # too old
+    assert len(flow) == 3
@@ -0,0 +1,107 @@
+"""test_fake_gmail: test the in-memory Gmail API used for benchmarks
+
+Run from the top directory of the repository:
+    python -m pytest tests
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import sys
+import base64
+from time import perf_counter
+from pathlib import Path
+from email.mime.text import MIMEText
+
+LIBRARIAN = Path(__file__).resolve().parents[1] / 'librarian-prototype'
+sys.path.insert(0, str(LIBRARIAN))
+
+import pytest
+from helpers.comms.fake_gmail import FakeGmailService, FakeHttpError
+
+def raw_message(text, thread_id):
+    raw = base64.urlsafe_b64encode(MIMEText(text).as_bytes()).decode()
+    return {'raw': raw, 'threadId': thread_id}
+
+def test_latency_by_method():
+    service = FakeGmailService(latency={'messages.list': 0.05})
+    start = perf_counter()
+    service.users().messages().list(userId='me').execute()
+    assert perf_counter() - start >= 0.05
+    start = perf_counter()
+    service.users().history().list(userId='me', startHistoryId='0').execute()
+    assert perf_counter() - start < 0.05
+    assert service.calls == {'messages.list': 1, 'history.list': 1}
+
+def test_injected_errors_are_counted_and_repeatable():
+    service = FakeGmailService(error_rate={'drafts.send': 1.0})
+    draft = service.users().drafts().create(userId='me', body={
+        'message': raw_message('hi', 't1')}).execute()
+    with pytest.raises(FakeHttpError):
+        service.users().drafts().send(userId='me', body=draft).execute()
+    assert service.errors == {'drafts.send': 1}
+    assert service.sent == []
+
+    def error_pattern(seed):
+        service = FakeGmailService(error_rate=0.5, seed=seed)
+        pattern = []
+        for _ in range(40):
+            try:
+                service.users().messages().list(userId='me').execute()
+                pattern.append(False)
+            except FakeHttpError:
+                pattern.append(True)
+        return pattern
+
+    pattern = error_pattern(seed=3)
+    assert pattern == error_pattern(seed=3)
+    assert 5 < sum(pattern) < 35
+
+def test_history_lists_changes_after_start_id():
+    service = FakeGmailService()
+    start = service.history_id
+    history = service.users().history()
+    assert 'history' not in history.list(userId='me',
+                                         startHistoryId=str(start)).execute()
+    msg_id, thread_id = service.add_SMS('8055551212', 'Is the water running?')
+    results = history.list(userId='me', startHistoryId=str(start)).execute()
+    assert results['historyId'] == str(start + 1)
+    assert results['history'] == [{'id': str(start + 1),
+                                   'messages': [{'id': msg_id}]}]
+    service.users().messages().modify(userId='me', id=msg_id, body={
+        'removeLabelIds': ['UNREAD']}).execute()  # a label change is a change
+    results = history.list(userId='me', startHistoryId=str(start + 1),
+                           maxResults=10).execute()
+    assert [change['id'] for change in results['history']] == [str(start + 2)]
+
+def test_labels_and_SMS_searches():
+    service = FakeGmailService()
+    messages = service.users().messages()
+    first, _ = service.add_SMS('8055551212', 'Barn temp?')
+    second, _ = service.add_SMS('8055553434', 'Water?')
+    unread = messages.list(userId='me', labelIds=['UNREAD']).execute()
+    assert [m['id'] for m in unread['messages']] == [second, first]  # newest
+    messages.modify(userId='me', id=second, body={
+        'removeLabelIds': ['UNREAD'], 'addLabelIds': ['Label_1']}).execute()
+    unread = messages.list(userId='me', labelIds=['UNREAD']).execute()
+    assert [m['id'] for m in unread['messages']] == [first]
+    assert messages.get(userId='me', id=second).execute()['labelIds'] == [
+        'INBOX', 'Label_1']
+    found = messages.list(userId='me', q='SMS 805 555 1212').execute()
+    assert [m['id'] for m in found['messages']] == [first]
+    assert messages.list(userId='me', labelIds=['SPAM']).execute() == {
+        'resultSizeEstimate': 0}
+    text = messages.get(userId='me', id=first).execute()['snippet']
+    assert 'Barn temp?' in text
+
+def test_sent_replies_are_recorded():
+    service = FakeGmailService()
+    service.users().messages().send(userId='me',
+        body=raw_message('Water is off.', 't1')).execute()
+    draft = service.users().drafts().create(userId='me', body={
+        'message': raw_message('Barn is 70 F.', 't2')}).execute()
+    assert not service.wait_for_sent(2, 0.01)
+    service.users().drafts().send(userId='me', body=draft).execute()
+    assert service.wait_for_sent(2, 1)
+    assert [(thread, text) for when, thread, text in service.sent] == [
+        ('t1', 'Water is off.'), ('t2', 'Barn is 70 F.')]
@@ -0,0 +1,54 @@
+"""test_gmail: test the Gmail channel's mailbox history polling
+
+Uses a FakeGmailService instead of the Gmail API.
+Run from the top directory of the repository:
+    python -m pytest tests
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import sys
+import threading
+from pathlib import Path
+
+LIBRARIAN = Path(__file__).resolve().parents[1] / 'librarian-prototype'
+sys.path.insert(0, str(LIBRARIAN))
+
+import pytest
+pytest.importorskip('imagezmq')  # imported by the gmail module
+from helpers.comms.gmail import Gmail
+from helpers.comms.fake_gmail import FakeGmailService
+
+def poll_in_thread(service, history_list, mail_check_seconds):
+    """ run mailbox_changed in a thread; return the thread and its results
+    """
+    gmail = Gmail.__new__(Gmail)  # no contacts, credentials or ZMQ needed
+    results = []
+    t = threading.Thread(target=lambda: results.append(gmail.mailbox_changed(
+        service, history_list, ['emptyToken'], mail_check_seconds)))
+    t.daemon = True
+    t.start()
+    return t, results
+
+def test_changes_before_the_first_check_return_at_once():
+    service = FakeGmailService()
+    history_list = [str(service.history_id)]
+    service.add_SMS('8055551212', 'Is the water running?')  # while busy
+    t, results = poll_in_thread(service, history_list, mail_check_seconds=60)
+    t.join(5)  # not after a 60 second wait
+    assert results == [True]
+    assert history_list == [str(service.history_id)]
+    assert service.calls == {'history.list': 1}
+
+def test_polls_until_the_mailbox_changes():
+    service = FakeGmailService()
+    history_list = [str(service.history_id)]
+    t, results = poll_in_thread(service, history_list, mail_check_seconds=0.02)
+    t.join(0.2)
+    assert t.is_alive() and results == []  # no changes yet
+    service.add_SMS('8055551212', 'Barn temp?')
+    t.join(5)
+    assert results == [True]
+    assert history_list == [str(service.history_id)]
+    assert service.calls['history.list'] > 2
@@ -0,0 +1,356 @@
+"""test_image_skills: test the image catalog, motion bursts, previews and skills
+
+Run from the top directory of the repository:
+    python -m pytest tests
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import os
+import sys
+import threading
+from queue import Queue
+from pathlib import Path
+from datetime import datetime, timedelta
+from concurrent.futures import Future
+
+LIBRARIAN = Path(__file__).resolve().parents[1] / 'librarian-prototype'
+sys.path.insert(0, str(LIBRARIAN))
+
+import pytest
+np = pytest.importorskip('numpy')
+from helpers.metrics import metrics
+from helpers.image_skills import (ImageSkills, ImageFile, WaterMeter,
+                                  ImageCatalog, EventImages, PreviewCache,
+                                  normalize_node, parse_image_name)
+
+class FakeCatalog:
+    def __init__(self, duplicates):
+        self.duplicates = set(duplicates)
+
+    def is_duplicate(self, path):
+        return path in self.duplicates
+
+class RecordingSkill:
+    """ An image skill that records the paths of the images it processes
+    """
+    name = 'recording'
+    nodes = {'barn'}
+
+    def __init__(self, every_frame):
+        self.every_frame = every_frame
+        self.seen = []
+
+    def process(self, node, images, frames):
+        assert len(images) == len(frames)
+        self.seen.extend(image.path for image in images)
+
+def make_skills(duplicates, skills):
+    """ an ImageSkills without its decode pool and pipeline thread
+    """
+    image_skills = ImageSkills.__new__(ImageSkills)
+    image_skills.catalog = FakeCatalog(duplicates)
+    image_skills.detections = None
+    image_skills.skills = skills
+    image_skills.image_q = Queue(maxsize=10)
+    image_skills.processed = metrics.counter('test_processed_total', '')
+    image_skills.dropped = metrics.counter('test_dropped_total', '')
+    image_skills.found = metrics.counter('test_found_total', '')
+    return image_skills
+
+def decoded(frame):
+    future = Future()
+    future.set_result(frame)
+    return future
+
+def burst(n):
+    start = datetime(2021, 9, 4, 8, 2, 38)
+    return [ImageFile(start + timedelta(seconds=i), 'barn', 'frame' + str(i))
+            for i in range(n)]
+
+def test_duplicates_reach_only_every_frame_skills():
+    images = burst(4)
+    every, unique = RecordingSkill(True), RecordingSkill(False)
+    image_skills = make_skills({'frame1', 'frame2'}, [every, unique])
+    frames = [decoded(np.full((4, 4, 3), i, dtype=np.uint8)) for i in range(4)]
+    image_skills.run_skills(images, frames)
+    assert every.seen == ['frame0', 'frame1', 'frame2', 'frame3']
+    assert unique.seen == ['frame0', 'frame3']
+
+def test_duplicates_queued_only_for_every_frame_skills():
+    images = burst(2)
+    image_skills = make_skills({'frame1'}, [RecordingSkill(False)])
+    for image in images:
+        image_skills.record_image(image)
+    assert image_skills.image_q.qsize() == 1
+    image_skills.skills.append(RecordingSkill(True))
+    image_skills.record_image(images[1])
+    assert image_skills.image_q.qsize() == 2
+
+class FakeHubData:
+    def __init__(self, event_data=None):
+        self.events = []
+        self.event_data = event_data or {}  # node -> event -> newest first
+        self.event_data_lock = threading.RLock()
+        self.event_listeners = []
+
+    def record_events(self, node_tuples):
+        self.events.extend(node_tuples)
+
+def needle_frames(angles):
+    """ 40x40 light dials with a dark needle drawn at each angle in degrees
+    """
+    frames = np.full((len(angles), 40, 40, 3), 220, dtype=np.uint8)
+    for frame, angle in zip(frames, angles):
+        for r in range(2, 18):
+            x = int(20 + r * np.cos(np.radians(angle)))
+            y = int(20 + r * np.sin(np.radians(angle)))
+            frame[y, x] = 0
+    return frames
+
+def test_water_meter_loads_flow_estimates_into_hub_data():
+    hub_data = FakeHubData()
+    meter = WaterMeter({'node': 'WaterMeter'}, hub_data)
+    images = [ImageFile(datetime(2021, 9, 4, 8, 0, 0) + timedelta(seconds=i / 4),
+                        'watermeter', 'meter' + str(i)) for i in range(8)]
+    detections = meter.process('watermeter', images,
+                               needle_frames([i * 30 for i in range(8)]))
+    assert detections[0].label == 'water flowing'
+    assert len(hub_data.events) == 7  # one estimate per pair of frames
+    node, event, when, value = hub_data.events[0]
+    assert (node, event) == ('WaterMeter', 'water_flow')
+    assert when == images[1].when
+    assert float(value) > 0
+    still = meter.process('watermeter', images, needle_frames([90] * 8))
+    assert still[0].label == 'water off'
+    assert float(hub_data.events[-1][3]) == 0.0
+
+def test_image_names_parse_to_normalized_node_and_datetime():
+    assert parse_image_name('Driveway-Mailbox-2021-09-04T08.02.38.105390.jpg') == (
+        'driveway mailbox', datetime(2021, 9, 4, 8, 2, 38, 105390))
+    assert parse_image_name('Barn-2021-04-19T23.43.20.5.jpg') == (
+        'barn', datetime(2021, 4, 19, 23, 43, 20, 500000))
+    assert parse_image_name('Barn-2021-04-19T23.43.20.jpg')[1] == datetime(
+        2021, 4, 19, 23, 43, 20)
+    assert parse_image_name('Barn-2021-04-19T23.43.20.png') is None
+    assert parse_image_name('Barn-2021-02-30T23.43.20.jpg') is None  # no date
+    assert parse_image_name('notes.jpg') is None
+    for name in ['Driveway Mailbox', 'driveway-mailbox', ' Driveway_Mailbox ']:
+        assert normalize_node(name) == 'driveway mailbox'
+
+class CatalogSettings:
+    def __init__(self, image_directory):
+        self.image_directory = str(image_directory)
+        self.dedupe_images = False
+        self.log_check_interval = 3600  # tests call check_for_new_images
+
+def write_images(image_dir, node, start, count):
+    """ write empty image files, one second apart, in a dated directory
+    """
+    day_dir = Path(image_dir) / start.strftime('%Y-%m-%d')
+    day_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(count):
+        when = start + timedelta(seconds=i)
+        path = day_dir / '{}-{}.jpg'.format(node.replace(' ', '-'),
+                                             when.strftime('%Y-%m-%dT%H.%M.%S.%f'))
+        path.touch()
+        paths.append(str(path))
+    return paths
+
+def test_image_catalog_finds_images_by_node_and_time(tmp_path):
+    start = datetime(2021, 9, 4, 8, 0, 0)
+    barn = write_images(tmp_path, 'Barn', start, 5)
+    mailbox = write_images(tmp_path, 'Driveway Mailbox', start, 3)
+    catalog = ImageCatalog(CatalogSettings(tmp_path))
+    assert catalog.nodes() == {'barn', 'driveway mailbox'}
+    assert catalog.image_count() == 8
+    assert catalog.latest('Barn').path == barn[-1]
+    assert catalog.latest('Driveway Mailbox',
+                          before=start + timedelta(seconds=1.5)).path == mailbox[1]
+    assert catalog.latest('Barn', before=start - timedelta(seconds=1)) is None
+    assert catalog.latest('Garage') is None
+    found = catalog.between('barn', start + timedelta(seconds=1),
+                            start + timedelta(seconds=3))
+    assert [image.path for image in found] == barn[1:4]
+
+def test_image_catalog_adds_new_and_drops_removed_images(tmp_path):
+    start = datetime(2021, 9, 4, 8, 0, 0)
+    write_images(tmp_path, 'Barn', start, 2)
+    catalog = ImageCatalog(CatalogSettings(tmp_path))
+    added = []
+    catalog.image_listeners.append(added.append)
+    assert catalog.check_for_new_images() == []  # no directory changed
+    next_day = write_images(tmp_path, 'Barn', start + timedelta(days=1), 2)
+    new_images = catalog.check_for_new_images()
+    assert [image.path for image in new_images] == next_day
+    assert added == new_images
+    assert catalog.latest('Barn').path == next_day[-1]
+    for path in next_day:
+        Path(path).unlink()
+    Path(next_day[0]).parent.rmdir()  # e.g. the imagehub pruned a day
+    catalog.check_for_new_images()
+    assert catalog.image_count() == 2
+    assert catalog.latest('Barn').when == start + timedelta(seconds=1)
+
+def motion(hub_data, node, when, value):
+    for listener in hub_data.event_listeners:
+        listener((node, 'motion', when, value))
+
+def test_images_written_before_the_event_line_join_its_burst(tmp_path):
+    start = datetime(2021, 9, 4, 8, 0, 0)
+    early = write_images(tmp_path, 'Driveway Mailbox', start, 4)
+    catalog = ImageCatalog(CatalogSettings(tmp_path))
+    hub_data = FakeHubData()
+    event_images = EventImages(hub_data, catalog)
+    changed = []
+    event_images.burst_listeners.append(changed.append)
+    motion(hub_data, 'Driveway Mailbox', start + timedelta(seconds=0.5), 'moving')
+    motion(hub_data, 'Driveway Mailbox', start + timedelta(seconds=1), 'still')
+    burst = event_images.latest_burst('driveway mailbox')
+    assert burst.images == early  # within lead and tail of the burst
+    assert changed == [burst]
+    write_images(tmp_path, 'Driveway Mailbox', start + timedelta(seconds=4), 1)
+    catalog.check_for_new_images()  # after 'still' + tail; not in the burst
+    assert burst.images == early
+    assert event_images.images_for('Driveway Mailbox',
+                                   start + timedelta(minutes=1)) == early
+
+def test_images_written_after_the_event_line_join_its_burst(tmp_path):
+    start = datetime(2021, 9, 4, 8, 0, 0)
+    catalog = ImageCatalog(CatalogSettings(tmp_path))
+    hub_data = FakeHubData()
+    event_images = EventImages(hub_data, catalog)
+    changed = []
+    event_images.burst_listeners.append(changed.append)
+    motion(hub_data, 'Barn', start, 'moving')
+    assert event_images.latest_burst('Barn') is None  # no images yet
+    assert event_images.latest_burst('Barn', with_images=False).images == []
+    paths = write_images(tmp_path, 'Barn', start, 3)
+    catalog.check_for_new_images()
+    burst = event_images.latest_burst('Barn')
+    assert burst.images == paths
+    assert burst.end is None  # open for max_burst until the next event
+    assert changed == [burst] * 3  # once for each new image
+
+def test_loaded_motion_events_are_linked_at_startup(tmp_path):
+    start = datetime(2021, 9, 4, 8, 0, 0)
+    first = write_images(tmp_path, 'Barn', start, 2)
+    second = write_images(tmp_path, 'Barn', start + timedelta(minutes=5), 2)
+    catalog = ImageCatalog(CatalogSettings(tmp_path))
+    events = [(start + timedelta(minutes=m), value) for m, value in
+              [(5.1, 'still'), (5, 'moving'), (0.1, 'still'), (0, 'moving')]]
+    hub_data = FakeHubData({'Barn': {'motion': events}})
+    event_images = EventImages(hub_data, catalog)
+    assert event_images.nodes() == {'barn'}
+    assert event_images.images_for('Barn', start + timedelta(minutes=1)) == first
+    assert event_images.latest_burst('Barn').images == second
+    assert event_images.images_for('Barn', start - timedelta(minutes=1)) == []
+
+class PreviewSettings:
+    def __init__(self, lib_dir):
+        self.lib_dir = Path(lib_dir)
+        self.preview_width = 32
+        self.preview_cache_mb = 1
+        self.preview_workers = 1
+
+class PreviewCatalog:
+    def __init__(self):
+        self.image_listeners = []
+
+    def is_duplicate(self, path):
+        return False
+
+    def unique(self, paths):
+        return list(paths)
+
+def write_image(path, seed):
+    cv2 = pytest.importorskip('cv2')
+    noise = np.random.default_rng(seed).integers(0, 256, (48, 64, 3))
+    cv2.imwrite(str(path), noise.astype(np.uint8))
+    return str(path)
+
+def test_previews_evicted_least_recently_used_first(tmp_path):
+    images = [write_image(tmp_path / (name + '.jpg'), seed)
+              for seed, name in enumerate('abc')]
+    cache = PreviewCache(PreviewSettings(tmp_path), PreviewCatalog())
+    a = cache.preview(images[0])
+    assert a.parent == tmp_path / 'previews'
+    cache.max_bytes = int(cache.size * 2.5)  # room for two previews
+    b = cache.preview(images[1])
+    assert cache.preview(images[0]) == a  # a cache hit; a is used last
+    c = cache.preview(images[2])
+    assert list(cache.entries) == [a.name, c.name]
+    assert not b.exists() and a.exists() and c.exists()
+    assert cache.size == a.stat().st_size + c.stat().st_size <= cache.max_bytes
+    restarted = PreviewCache(PreviewSettings(tmp_path), PreviewCatalog())
+    assert list(restarted.entries) == [a.name, c.name]  # by file mtime
+    assert restarted.size == cache.size
+
+def test_changed_image_gets_a_new_preview(tmp_path):
+    path = write_image(tmp_path / 'a.jpg', 0)
+    cache = PreviewCache(PreviewSettings(tmp_path), PreviewCatalog())
+    first = cache.preview(path)
+    assert first.stat().st_size < Path(path).stat().st_size  # shrunk
+    write_image(path, 1)  # the imagehub wrote the file again
+    mtime = Path(path).stat().st_mtime + 10
+    os.utime(path, (mtime, mtime))
+    second = cache.preview(path)
+    assert second != first
+    assert second.read_bytes() != first.read_bytes()
+    assert cache.preview(path) == second
+    Path(path).unlink()
+    assert cache.preview(path) is None
+
+def write_frame(image_dir, node, when, frame):
+    """ write a frame as an imagehub image file; return its ImageFile
+    """
+    cv2 = pytest.importorskip('cv2')
+    day_dir = Path(image_dir) / when.strftime('%Y-%m-%d')
+    day_dir.mkdir(parents=True, exist_ok=True)
+    path = str(day_dir / '{}-{}.jpg'.format(node,
+                                            when.strftime('%Y-%m-%dT%H.%M.%S.%f')))
+    cv2.imwrite(path, frame)
+    return ImageFile(when, normalize_node(node), path)
+
+def ramp(reverse=False, noise_seed=None):
+    """ 128x144 gray frame, brighter to the right (or left if reverse)
+    """
+    frame = np.tile(np.linspace(20, 235, 144), (128, 1))
+    if reverse:
+        frame = frame[:, ::-1]
+    if noise_seed is not None:  # like sensor noise between burst frames
+        frame = frame + np.random.default_rng(noise_seed).normal(0, 3, frame.shape)
+    return np.repeat(frame.clip(0, 255).astype(np.uint8)[:, :, None], 3, axis=2)
+
+def test_image_hash_distance_of_near_duplicates(tmp_path):
+    start = datetime(2021, 9, 4, 8, 0, 0)
+    frames = [ramp(), ramp(noise_seed=1), ramp(reverse=True)]
+    hashes = [ImageCatalog.image_hash(write_frame(tmp_path, 'Barn',
+              start + timedelta(seconds=i), frame).path)
+              for i, frame in enumerate(frames)]
+    assert bin(hashes[0] ^ hashes[1]).count('1') <= ImageCatalog.max_distance
+    assert bin(hashes[0] ^ hashes[2]).count('1') > 32
+    (tmp_path / 'broken.jpg').write_bytes(b'not a jpeg')
+    assert ImageCatalog.image_hash(str(tmp_path / 'broken.jpg')) is None
+
+def test_near_duplicates_grouped_with_the_first_frame(tmp_path):
+    pytest.importorskip('cv2')
+    settings = CatalogSettings(tmp_path)
+    settings.dedupe_images = True
+    catalog = ImageCatalog(settings)
+    start = datetime(2021, 9, 4, 8, 0, 0)
+    frames = [(0, ramp()), (1, ramp(noise_seed=1)), (2, ramp(noise_seed=2)),
+              (3, ramp(reverse=True)), (4, ramp(reverse=True, noise_seed=3)),
+              (30, ramp(reverse=True, noise_seed=4))]  # after max_gap
+    images = [write_frame(tmp_path, 'Barn', start + timedelta(seconds=s), f)
+              for s, f in frames]
+    write_frame(tmp_path, 'Garage', start, ramp(noise_seed=5))  # another node
+    catalog.check_for_new_images()
+    paths = [image.path for image in images]
+    assert catalog.duplicate_of == {paths[1]: paths[0], paths[2]: paths[0],
+                                    paths[4]: paths[3]}
+    assert catalog.unique(paths) == [paths[0], paths[3], paths[5]]
+    assert catalog.is_duplicate(paths[2])
+    assert not catalog.is_duplicate(catalog.latest('Garage').path)
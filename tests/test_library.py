@@ -0,0 +1,86 @@
+"""test_library: test Settings loading, reload change detection and the
+modules loaded by importing the library
+
+Each test writes a librarian.yaml into a temporary home directory.
+Run from the top directory of the repository:
+    python -m pytest tests
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import os
+import sys
+import subprocess
+from pathlib import Path
+
+LIBRARIAN = Path(__file__).resolve().parents[1] / 'librarian-prototype'
+sys.path.insert(0, str(LIBRARIAN))
+
+import pytest
+pytest.importorskip('imagezmq')  # imported by the comm channels
+from helpers.library import Settings
+
+YAML = """\
+librarian:
+  name: TestLibrarian
+  log_directory: {home}/imagehub_data/logs
+  log_file: imagehub.log
+  data_directory: librarian_data
+  reload_on_change: True
+comm_channels:
+  CLI:
+    port: 5556
+alerts:
+  garage_too_hot:
+    node: Garage
+    event: Temp
+    above: 95
+"""
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    (tmp_path / 'librarian_data').mkdir()
+    write_yaml(tmp_path, YAML)
+    return tmp_path
+
+def write_yaml(home, text):
+    (home / 'librarian.yaml').write_text(text.format(home=home))
+
+def test_settings_defaults(home):
+    settings = Settings()
+    assert settings.librarian_name == 'TestLibrarian'
+    assert settings.lib_dir == home / 'librarian_data'
+    assert settings.log_check_interval == 2
+    assert settings.preview_cache_mb == 0
+    assert settings.image_directory is None  # no imagehub_data/images
+
+def test_changes_names_changed_sections(home):
+    settings = Settings()
+    assert settings.changes(Settings()) == set()
+    write_yaml(home, YAML.replace('above: 95', 'above: 100') +
+               'retention:\n  memory_mb: 64\n')
+    assert settings.changes(Settings()) == {'alerts', 'retention'}
+    write_yaml(home, YAML.replace('port: 5556', 'port: 5557'))
+    assert settings.changes(Settings()) == {'comm_channels'}
+
+def test_file_changed_once_per_modification(home):
+    settings = Settings()
+    assert not settings.file_changed()
+    yaml_file = home / 'librarian.yaml'
+    mtime = os.stat(yaml_file).st_mtime + 10
+    os.utime(yaml_file, (mtime, mtime))
+    assert settings.file_changed()
+    assert not settings.file_changed()
+
+def test_import_does_not_load_heavy_optional_modules():
+    # OpenCV and the Google API packages are imported only by the subsystems
+    # that use them, so a fresh interpreter is needed to see what is loaded
+    code = ('import sys, helpers.library; '
+            'print(sorted(m for m in ("cv2", "googleapiclient") '
+            'if m in sys.modules))')
+    result = subprocess.run([sys.executable, '-c', code], cwd=str(LIBRARIAN),
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == '[]'
@@ -0,0 +1,115 @@
+"""test_log_archive: test writing and reading columnar event log archives
+
+Each test writes a small imagehub event log into a temporary directory.
+Run from the top directory of the repository:
+    python -m pytest tests
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import sys
+from pathlib import Path
+from datetime import datetime, timedelta
+
+LIBRARIAN = Path(__file__).resolve().parents[1] / 'librarian-prototype'
+sys.path.insert(0, str(LIBRARIAN))
+
+import pytest
+np = pytest.importorskip('numpy')
+from helpers.data_tools import HubData
+from helpers.log_archive import (LogArchive, archive_path, convert_directory,
+                                 convert_log, is_current, read_header)
+
+START = datetime(2021, 9, 23, 0, 0, 1, 250000)
+
+LINES = [  # (seconds after START, node, event, value)
+    (0, 'Barn', 'Temp', '61.3'),
+    (5, 'Driveway Mailbox', 'motion', 'moving'),
+    (9, 'Barn', 'Temp', '61.3'),
+    (3, 'Barn', 'Temp', '60.9'),  # a clock change wrote this line late
+    (12, 'Driveway Mailbox', 'motion', 'still'),
+]
+
+def write_log(path):
+    with open(path, 'w') as f:
+        f.write('a line without a datetime\n')
+        for seconds, node, event, value in LINES:
+            when = START + timedelta(seconds=seconds)
+            f.write('{},{:03d} ~ {}|{}|{}\n'.format(
+                when.strftime('%Y-%m-%d %H:%M:%S'), when.microsecond // 1000,
+                node, event, value))
+
+@pytest.fixture
+def log_path(tmp_path):
+    path = tmp_path / 'imagehub.log.2021-09-23'
+    write_log(path)
+    return path
+
+def test_archive_rows_match_the_log_in_time_order(log_path, tmp_path):
+    target = archive_path(log_path, tmp_path)
+    assert target.name == 'imagehub.log.2021-09-23.arc'
+    assert convert_log(log_path, target, HubData.parse_log_line) == 5
+    archive = LogArchive(target)
+    assert archive.rows == 5
+    times = [archive.to_datetime(ms) for ms in archive.times_ms()]
+    expected = sorted(LINES)
+    assert times == [START + timedelta(seconds=row[0]) for row in expected]
+    rows = [archive.series[s] + (archive.values[v],) for s, v in
+            zip(archive.columns['series'], archive.columns['value'])]
+    assert rows == [row[1:] for row in expected]
+    assert archive.values.count('61.3') == 1  # each distinct value once
+
+def test_rows_of_one_series_and_numbers(log_path, tmp_path):
+    target = archive_path(log_path, tmp_path)
+    convert_log(log_path, target, HubData.parse_log_line)
+    archive = LogArchive(target)
+    barn = archive.series.index(('Barn', 'Temp'))
+    rows = archive.rows_of(barn)
+    assert list(rows) == [0, 1, 3]
+    assert [archive.values[v] for v in archive.columns['value'][rows]] == [
+        '61.3', '60.9', '61.3']
+    numbers = archive.columns['number']
+    assert numbers[1] == np.float32(60.9)
+    assert np.isnan(numbers[archive.rows_of(1 - barn)]).all()
+
+def test_columns_start_on_8_byte_boundaries(log_path, tmp_path):
+    target = archive_path(log_path, tmp_path)
+    convert_log(log_path, target, HubData.parse_log_line)
+    header, first = read_header(target)
+    offsets = sorted(header['columns'].values())
+    assert offsets[0] >= first
+    assert all(offset % 8 == 0 for offset in offsets)
+    assert not list(tmp_path.glob('*.part'))
+
+def test_empty_log_makes_an_empty_archive(tmp_path):
+    path = tmp_path / 'imagehub.log.2021-09-24'
+    path.write_text('no events today\n')
+    target = archive_path(path, tmp_path)
+    assert convert_log(path, target, HubData.parse_log_line) == 0
+    archive = LogArchive(target)
+    assert archive.rows == 0
+    assert len(archive.times_ms()) == 0
+
+def test_archive_is_made_again_when_its_log_changes(log_path, tmp_path):
+    archive_dir = tmp_path / 'log_archive'
+    archive_dir.mkdir()
+    (tmp_path / 'imagehub.log').write_text('')  # the current log is not archived
+    assert convert_directory(tmp_path, archive_dir, 'imagehub.log',
+                             HubData.parse_log_line) == [log_path]
+    target = archive_path(log_path, archive_dir)
+    assert is_current(log_path, target)
+    assert convert_directory(tmp_path, archive_dir, 'imagehub.log',
+                             HubData.parse_log_line) == []
+    with open(log_path, 'a') as f:
+        f.write('2021-09-23 00:01:00,000 ~ Barn|Temp|62.0\n')
+    assert not is_current(log_path, target)
+    assert convert_directory(tmp_path, archive_dir, 'imagehub.log',
+                             HubData.parse_log_line) == [log_path]
+    assert LogArchive(target).rows == 6
+
+def test_other_files_are_not_archives(log_path, tmp_path):
+    assert not is_current(log_path, tmp_path / 'missing.arc')
+    assert not is_current(log_path, log_path)  # no MAGIC
+    with pytest.raises(ValueError):
+        read_header(log_path)
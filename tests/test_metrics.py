@@ -0,0 +1,104 @@
+"""test_metrics: test the metrics registry, its text formats and endpoint
+
+Run from the top directory of the repository:
+    python -m pytest tests
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import sys
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+LIBRARIAN = Path(__file__).resolve().parents[1] / 'librarian-prototype'
+sys.path.insert(0, str(LIBRARIAN))
+
+import pytest
+from helpers.metrics import MetricsRegistry
+
+def test_counter_and_gauge_exposition():
+    registry = MetricsRegistry()
+    lines = registry.counter('lines_total', 'Lines read')
+    lines.inc()
+    lines.inc(4)
+    registry.gauge('queue_depth', 'Queries waiting').set(2.5)
+    assert registry.prometheus_text() == (
+        '# HELP lines_total Lines read\n'
+        '# TYPE lines_total counter\n'
+        'lines_total 5\n'
+        '# HELP queue_depth Queries waiting\n'
+        '# TYPE queue_depth gauge\n'
+        'queue_depth 2.5\n')
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    latency = registry.histogram('reply_seconds', 'Reply time',
+                                 buckets=(0.1, 1))
+    for seconds in (0.05, 0.1, 0.5, 3):
+        latency.observe(seconds)
+    text = registry.prometheus_text()
+    assert 'reply_seconds_bucket{le="0.1"} 2\n' in text
+    assert 'reply_seconds_bucket{le="1"} 3\n' in text
+    assert 'reply_seconds_bucket{le="+Inf"} 4\n' in text
+    assert 'reply_seconds_sum 3.65\n' in text
+    assert 'reply_seconds_count 4\n' in text
+    assert 'reply_seconds: 4 (mean 0.912)' in registry.status_text()
+
+def test_labels_name_separate_metrics_of_a_family():
+    registry = MetricsRegistry()
+    cli = registry.counter('queries_total', 'Queries', {'channel': 'CLI'})
+    assert registry.counter('queries_total', 'Queries',
+                            {'channel': 'CLI'}) is cli
+    registry.counter('queries_total', 'Queries', {'channel': 'Gmail'}).inc()
+    cli.inc(2)
+    registry.histogram('send_seconds', 'Sends', {'channel': 'CLI', 'b': 'x'},
+                       buckets=(1,)).observe(0.5)
+    text = registry.prometheus_text()
+    assert text.count('# TYPE queries_total counter') == 1
+    assert 'queries_total{channel="CLI"} 2\n' in text
+    assert 'queries_total{channel="Gmail"} 1\n' in text
+    # labels are sorted by name; 'le' comes last in bucket samples
+    assert 'send_seconds_bucket{b="x",channel="CLI",le="1"} 1\n' in text
+    assert 'queries_total{channel="CLI"}: 2' in registry.status_text()
+
+class Queue:
+    def __init__(self, depth):
+        self.depth = depth
+
+def test_gauge_reads_the_latest_function():
+    registry = MetricsRegistry()
+    first, second = Queue(3), Queue(7)
+    gauge = registry.gauge('depth', 'Depth', function=lambda: first.depth)
+    assert 'depth 3\n' in registry.prometheus_text()
+    # e.g. a channel recreated by a settings reload registers its gauge again
+    assert registry.gauge('depth', 'Depth',
+                          function=lambda: second.depth) is gauge
+    assert 'depth 7\n' in registry.prometheus_text()
+    registry.gauge('depth', 'Depth')  # asked for without a function
+    assert 'depth 7\n' in registry.prometheus_text()
+
+def test_failing_gauge_function_is_skipped():
+    registry = MetricsRegistry()
+    registry.gauge('broken', 'Fails', function=lambda: 1 / 0)
+    registry.counter('ok_total', 'Works').inc()
+    text = registry.prometheus_text()
+    assert '# TYPE broken gauge\n' in text
+    assert 'ok_total 1\n' in text
+
+def test_http_endpoint_serves_metrics():
+    registry = MetricsRegistry()
+    registry.counter('lines_total', 'Lines read').inc(3)
+    server = registry.start_http_server(0)  # any free port
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        with urllib.request.urlopen(url + '/metrics', timeout=5) as response:
+            assert response.headers['Content-Type'].startswith('text/plain')
+            assert b'lines_total 3\n' in response.read()
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + '/other', timeout=5)
+        assert error.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,104 @@
+"""test_nodehealth: test NodeLiveness learning of event intervals and the
+stall watcher
+
+Run from the top directory of the repository:
+    python -m pytest tests
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import sys
+import time
+import signal
+import socket
+import threading
+import subprocess
+from pathlib import Path
+from datetime import datetime, timedelta
+
+LIBRARIAN = Path(__file__).resolve().parents[1] / 'librarian-prototype'
+sys.path.insert(0, str(LIBRARIAN))
+
+from helpers.utils import Heartbeats
+from helpers.nodehealth import NodeLiveness, stall_watcher
+
+def send_events(liveness, start, count, seconds, node='Barn'):
+    """ record count Temp events seconds apart; return the last time
+    """
+    when = start
+    for i in range(count):
+        when = start + timedelta(seconds=i * seconds)
+        liveness.record((node, 'Temp', when, '70'))
+    return when
+
+def test_regular_node_silent_after_expected_intervals():
+    liveness = NodeLiveness(silent_intervals=3)
+    now = datetime.now()
+    send_events(liveness, now - timedelta(seconds=600 * 10 + 1000), 10, 600)
+    liveness.check()  # quiet for 1000 seconds; less than 3 intervals
+    assert liveness.suspect_nodes() == set()
+    liveness.series[('barn', 'temp')][0] = now - timedelta(seconds=2000)
+    liveness.check()
+    assert liveness.suspect_nodes() == {'barn'}
+
+def test_node_heard_again_is_not_silent():
+    liveness = NodeLiveness()
+    start = datetime.now() - timedelta(hours=5)
+    last = send_events(liveness, start, 10, 600)
+    liveness.check()
+    assert liveness.suspect_nodes() == {'barn'}
+    liveness.record(('Barn', 'Temp', last + timedelta(hours=4), '70'))
+    assert liveness.suspect_nodes() == set()
+
+def test_short_silence_after_long_outage_is_seen():
+    liveness = NodeLiveness(silent_intervals=3)
+    now = datetime.now()
+    start = now - timedelta(days=2)
+    last = send_events(liveness, start, 20, 600)
+    # powered off for a day, then 5 normal events ending 3000 seconds ago
+    restart = now - timedelta(seconds=3000 + 4 * 600)
+    assert restart - last > timedelta(hours=24)
+    send_events(liveness, restart, 5, 600)
+    liveness.check()
+    assert liveness.suspect_nodes() == {'barn'}
+
+def test_node_with_one_series_heard_is_not_silent():
+    liveness = NodeLiveness()
+    now = datetime.now()
+    send_events(liveness, now - timedelta(hours=5), 10, 600)  # quiet Temp
+    for i in range(10):  # Motion events that are still being heard
+        liveness.record(('Barn', 'Motion', now - timedelta(seconds=60 * (10 - i)),
+                         'moving'))
+    liveness.check()
+    assert liveness.suspect_nodes() == set()
+
+def test_stall_watcher_notifies_systemd_then_ends_a_stalled_process(
+        tmp_path, monkeypatch):
+    heartbeats = Heartbeats(['main loop'])
+    heartbeats.set_patience(0.2)
+    heartbeats.stamp('main loop')
+    librarian = subprocess.Popen([sys.executable, '-c',
+                                  'import time; time.sleep(30)'])
+    path = str(tmp_path / 'notify')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.bind(path)
+        sock.settimeout(5)
+        monkeypatch.setenv('NOTIFY_SOCKET', path)
+        exited = threading.Event()
+
+        def watch():  # stall_watcher runs in a process; sys.exit() ends it
+            try:
+                stall_watcher(librarian.pid, heartbeats, 0.1)
+            except SystemExit:
+                exited.set()
+
+        watcher = threading.Thread(target=watch)
+        watcher.daemon = True
+        watcher.start()
+        for _ in range(3):  # keeps stamping, so the watchdog is notified
+            heartbeats.stamp('main loop')
+            assert sock.recv(100) == b'WATCHDOG=1'
+        heartbeats.stamps[0] = time.monotonic() - 1  # the main loop is stuck
+        assert librarian.wait(5) == -signal.SIGTERM
+        assert exited.wait(5)
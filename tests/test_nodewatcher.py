@@ -0,0 +1,120 @@
+"""test_nodewatcher: test SystemctlMonitor with a fake command runner
+
+A FakeRunner stands in for subprocess.run and for the imagenodes, so these
+tests need no ssh server. Run from the top directory of the repository:
+    python -m pytest tests
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import sys
+import logging
+import subprocess
+from pathlib import Path
+
+LIBRARIAN = Path(__file__).resolve().parents[1] / 'librarian-prototype'
+sys.path.insert(0, str(LIBRARIAN))
+
+import pytest
+from helpers.nodewatcher import SystemctlMonitor, NodeUnreachable
+
+RUNNING = ('ActiveState=active\nSubState=running\n'
+           'ExecMainStartTimestamp=Sat 2021-09-25 08:00:00 PDT\nNRestarts=0\n')
+
+class FakeRunner:
+    """ Records each command and answers it like an imagenode would
+
+    Parameters:
+        returncodes (dict): returncode of commands containing a key, e.g.
+            {'-MNf': 255} makes every master connection fail
+    """
+    def __init__(self, returncodes=None):
+        self.calls = []  # (args, kwargs) of each command run
+        self.returncodes = returncodes or {}
+        self.journal = []  # journal lines returned by the next check
+
+    def __call__(self, args, **kwargs):
+        self.calls.append((args, kwargs))
+        returncode = 0
+        for key, code in self.returncodes.items():
+            if any(key in arg for arg in args):
+                returncode = code
+        stdout = ''
+        if 'systemctl show' in args[-1]:
+            stdout = (RUNNING + '\n' + ''.join(line + '\n' for line in
+                      self.journal) + '-- cursor: s=1\n')
+            self.journal = []
+        return subprocess.CompletedProcess(args, returncode, stdout, '')
+
+    def commands(self, flag):
+        return [(args, kwargs) for args, kwargs in self.calls if flag in args]
+
+def make_monitor(tmp_path, runner):
+    return SystemctlMonitor(logging.getLogger('test'), runner=runner,
+                            control_dir=tmp_path)
+
+def test_master_started_once_with_output_to_devnull(tmp_path):
+    runner = FakeRunner()
+    sm = make_monitor(tmp_path, runner)
+    for _ in range(3):
+        assert sm.imagenode_OK('pi@rpi11')
+    masters = runner.commands('-MNf')
+    assert len(masters) == 1
+    args, kwargs = masters[0]
+    assert kwargs['stdout'] == kwargs['stderr'] == subprocess.DEVNULL
+    assert 'capture_output' not in kwargs
+    checks = runner.calls[1:]
+    assert len(checks) == 3
+    for args, kwargs in checks:
+        assert 'ControlMaster=no' in args  # a check never becomes a master
+
+def test_failed_check_restarts_master(tmp_path):
+    runner = FakeRunner()
+    sm = make_monitor(tmp_path, runner)
+    sm.imagenode_OK('pi@rpi11')
+    runner.returncodes = {'systemctl show': 255}
+    with pytest.raises(NodeUnreachable):
+        sm.imagenode_OK('pi@rpi11')
+    assert runner.commands('exit')  # the broken master is closed
+    runner.returncodes = {}
+    sm.imagenode_OK('pi@rpi11')
+    assert len(runner.commands('-MNf')) == 2
+
+def test_unreachable_node_backs_off(tmp_path):
+    runner = FakeRunner({'-MNf': 255})
+    sm = make_monitor(tmp_path, runner)
+    sm.check_imagenodes(['pi@rpi11'], 30)
+    assert sm.backoff['pi@rpi11'][1] == 30
+    sm.check_imagenodes(['pi@rpi11'], 30)  # not due yet; not checked
+    assert len(runner.commands('-MNf')) == 1
+
+def test_zmq_signature_ignores_normal_zmq_lines(tmp_path):
+    sm = make_monitor(tmp_path, FakeRunner())
+    assert sm.classify_failures(['Connecting to imagehub with zmq REQ',
+                                 'zmq version 4.3.4']) == []
+    assert sm.classify_failures(['zmq.error.Again: Resource temporarily '
+                                 'unavailable']) == ['ZMQ']
+    assert sm.classify_failures(['ZMQError: Operation cannot be '
+                                 'accomplished in current state']) == ['ZMQ']
+
+def test_normal_startup_journal_has_no_failures(tmp_path):
+    sm = make_monitor(tmp_path, FakeRunner())
+    startup = ['Started imagenode.service.',
+               'Starting imagenode.py',
+               'Using PiCamera with resolution (640, 480)',
+               'picamera version 1.13; mmal camera port initialized',
+               'Sensor DHT22 on GPIO 4 using adafruit_blinka and libgpiod',
+               'Connecting to imagehub with zmq REQ',
+               'zmq version 4.3.4']
+    assert sm.classify_failures(startup) == []
+
+def test_camera_and_sensor_errors_are_failures(tmp_path):
+    sm = make_monitor(tmp_path, FakeRunner())
+    assert sm.classify_failures(['mmal: mmal_vc_component_enable: failed to '
+                                 'enable component: ENOSPC']) == ['PiCamera']
+    assert sm.classify_failures(['picamera.exc.PiCameraMMALError: Camera '
+                                 'component couldn\'t be enabled']) == ['PiCamera']
+    assert sm.classify_failures(['RuntimeError: DHT sensor not found, '
+                                 'check wiring']) == ['DHT-22']
+    assert sm.classify_failures(['DHT22 read timeout']) == ['DHT-22']
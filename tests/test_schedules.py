@@ -0,0 +1,66 @@
+"""test_schedules: test Job run times and the Scheduler heap order
+
+Run from the top directory of the repository:
+    python -m pytest tests
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import sys
+import threading
+from pathlib import Path
+from datetime import datetime, timedelta
+
+LIBRARIAN = Path(__file__).resolve().parents[1] / 'librarian-prototype'
+sys.path.insert(0, str(LIBRARIAN))
+
+import pytest
+from helpers.utils import YamlOptionsError
+from helpers.schedules import Job, Scheduler
+
+def test_next_run_is_later_today_or_on_a_scheduled_day():
+    job = Job('10:30', 'all', print)
+    morning = datetime(2021, 9, 22, 9, 0)  # a Wednesday
+    assert job.next_run(morning) == datetime(2021, 9, 22, 10, 30)
+    at_time = datetime(2021, 9, 22, 10, 30)  # due now; next run is tomorrow
+    assert job.next_run(at_time) == datetime(2021, 9, 23, 10, 30)
+    weekly = Job('10:30', ['Tuesday'], print)
+    assert weekly.next_run(morning) == datetime(2021, 9, 28, 10, 30)
+
+def test_bad_job_options_raise_yaml_errors():
+    with pytest.raises(YamlOptionsError):
+        Job('10.30', 'all', print)
+    with pytest.raises(YamlOptionsError):
+        Job('10:30', 'someday', print)
+
+def test_due_jobs_run_in_time_order():
+    scheduler = Scheduler()
+    scheduler.max_workers = 1  # one worker runs the jobs one after another
+    ran = []
+    all_ran = threading.Event()
+
+    def action(name):
+        ran.append(name)
+        if len(ran) == 4:
+            all_ran.set()
+
+    now = datetime.now()
+    at = (now + timedelta(hours=1)).strftime('%H:%M')  # not due again soon
+    for name, seconds_ago in [('b', 2), ('d', 0.5), ('a', 3), ('c', 2)]:
+        scheduler.push(Job(at, 'all', action, (name,)),
+                       now - timedelta(seconds=seconds_ago))
+    scheduler.start()
+    assert all_ran.wait(5)
+    assert ran == ['a', 'b', 'c', 'd']  # b and c are due at once; b was first
+    assert len(scheduler.jobs) == 4  # each job is scheduled again
+
+def test_added_job_wakes_scheduler():
+    scheduler = Scheduler()
+    scheduler.start()  # sleeps with an empty heap until a job is added
+    done = threading.Event()
+    job = Job('10:30', 'all', done.set)
+    with scheduler.wake:
+        scheduler.push(job, datetime.now())
+        scheduler.wake.notify()
+    assert done.wait(5)
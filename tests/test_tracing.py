@@ -0,0 +1,93 @@
+"""test_tracing: test sampled timing spans and the collapsed stack output
+
+Run from the top directory of the repository:
+    python -m pytest tests
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import sys
+import threading
+from pathlib import Path
+
+LIBRARIAN = Path(__file__).resolve().parents[1] / 'librarian-prototype'
+sys.path.insert(0, str(LIBRARIAN))
+
+import helpers.tracing
+from helpers.tracing import Tracer
+
+class FakeClock:
+    """ perf_counter replacement that returns the times it is given
+    """
+    def __init__(self, times):
+        self.times = list(times)
+
+    def __call__(self):
+        return self.times.pop(0)
+
+def test_nested_spans_record_self_time(monkeypatch):
+    tracer = Tracer()
+    tracer.start(1.0)
+    # outer starts at 0, inner runs from 1 to 3, outer ends at 6
+    monkeypatch.setattr(helpers.tracing, 'perf_counter', FakeClock([0, 1, 3, 6]))
+    with tracer.span('outer'):
+        with tracer.span('inner'):
+            pass
+    assert tracer.collapsed_stacks() == ['MainThread;outer 4000000',
+                                         'MainThread;outer;inner 2000000']
+
+def test_sampling_is_decided_once_per_outermost_span(monkeypatch):
+    tracer = Tracer()
+    tracer.start(0.5)
+    draws = [0.7, 0.2]  # the first root is not sampled, the second one is
+    monkeypatch.setattr(helpers.tracing.random, 'random', lambda: draws.pop(0))
+    for _ in range(2):
+        with tracer.span('root'):
+            with tracer.span('child'):
+                with tracer.span('grandchild'):
+                    pass
+    assert draws == []  # children did not draw again
+    stacks = [line.rsplit(' ', 1)[0] for line in tracer.collapsed_stacks()]
+    assert stacks == ['MainThread;root', 'MainThread;root;child',
+                      'MainThread;root;child;grandchild']
+
+def test_traced_function_when_off_is_not_timed(monkeypatch):
+    tracer = Tracer()
+
+    @tracer.traced('Test.double')
+    def double(x):
+        return 2 * x
+
+    def fail(name):
+        raise AssertionError('timed while tracing is off')
+
+    monkeypatch.setattr(tracer, 'timed_span', fail)
+    assert double(4) == 8
+    assert double.__name__ == 'double'
+    with tracer.span('off'):
+        pass
+    monkeypatch.undo()
+    tracer.start(1.0)
+    assert double(5) == 10
+    assert tracer.collapsed_stacks()[0].startswith('MainThread;Test.double ')
+
+def test_collapsed_stacks_file_has_one_line_per_thread_stack(tmp_path):
+    tracer = Tracer()
+    tracer.start(1.0)
+
+    def work():
+        with tracer.span('HubData.add_new_log_lines'):
+            pass
+
+    t = threading.Thread(target=work, name='HubData reader')
+    t.start()
+    t.join()
+    work()
+    path = tmp_path / 'librarian.folded'
+    tracer.write_collapsed_stacks(str(path))
+    lines = path.read_text().splitlines()
+    assert [line.rsplit(' ', 1)[0] for line in lines] == [
+        'HubData_reader;HubData.add_new_log_lines',  # spaces replaced
+        'MainThread;HubData.add_new_log_lines']
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
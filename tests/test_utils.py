@@ -0,0 +1,95 @@
+"""test_utils: test heartbeats, systemd notification and startup profiling
+
+Run from the top directory of the repository:
+    python -m pytest tests
+
+Copyright (c) 2021 by Jeff Bass.
+License: MIT, see LICENSE for more details.
+"""
+
+import sys
+import time
+import socket
+from pathlib import Path
+
+LIBRARIAN = Path(__file__).resolve().parents[1] / 'librarian-prototype'
+sys.path.insert(0, str(LIBRARIAN))
+
+import pytest
+from helpers.utils import Heartbeats, StartupProfiler, systemd_notify
+
+def test_threads_stalled_after_interval_plus_patience():
+    heartbeats = Heartbeats(['main loop', 'ingest'])
+    heartbeats.set_patience(10)
+    assert heartbeats.stalled() == []  # 0 stamps are not checked
+    heartbeats.stamp('main loop')
+    heartbeats.stamp('ingest')
+    assert heartbeats.stalled() == []
+    now = time.monotonic()
+    heartbeats.stamps[0] = heartbeats.stamps[1] = now - 12
+    assert heartbeats.stalled() == ['main loop', 'ingest']
+    heartbeats.set_interval('ingest', 5)  # stamps once per 5 seconds
+    assert heartbeats.stalled() == ['main loop']
+    heartbeats.idle('main loop')  # waiting for input is not a stall
+    assert heartbeats.stalled() == []
+
+def test_blocking_step_gets_a_longer_interval():
+    heartbeats = Heartbeats(['main loop'])
+    heartbeats.set_patience(10)
+    heartbeats.set_interval('main loop', 2)
+    with heartbeats.blocking('main loop', 120):
+        assert heartbeats.intervals[0] == 120
+        heartbeats.stamps[0] = time.monotonic() - 60  # a slow send
+        assert heartbeats.stalled() == []
+    assert heartbeats.intervals[0] == 2
+    assert time.monotonic() - heartbeats.stamps[0] < 1  # stamped after it
+
+def test_blocking_step_restores_interval_when_it_raises():
+    heartbeats = Heartbeats(['main loop'])
+    heartbeats.set_interval('main loop', 2)
+    with pytest.raises(OSError):
+        with heartbeats.blocking('main loop', 120):
+            raise OSError('send failed')
+    assert heartbeats.intervals[0] == 2
+
+def test_systemd_notify_sends_to_notify_socket(tmp_path, monkeypatch):
+    monkeypatch.delenv('NOTIFY_SOCKET', raising=False)
+    assert not systemd_notify('WATCHDOG=1')  # not running under systemd
+    path = str(tmp_path / 'notify')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.bind(path)
+        sock.settimeout(5)
+        monkeypatch.setenv('NOTIFY_SOCKET', path)
+        assert systemd_notify('WATCHDOG=1')
+        assert sock.recv(100) == b'WATCHDOG=1'
+
+def test_startup_profiler_reports_imports_and_subsystems(tmp_path,
+                                                       monkeypatch):
+    import builtins
+    (tmp_path / 'slow_module.py').write_text('import time\ntime.sleep(0.01)\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    original_import = builtins.__import__
+    profiler = StartupProfiler()
+    profiler.start_import_timing()
+    try:
+        profiler.start_import_timing()  # a second start changes nothing
+        __import__('json')  # already imported; not timed
+        __import__('slow_module')
+    finally:
+        profiler.stop_import_timing()
+        sys.modules.pop('slow_module', None)
+    assert builtins.__import__ is original_import
+    assert 'json' not in profiler.import_times
+    assert profiler.import_times['slow_module'] >= 0.01
+    with pytest.raises(ValueError):
+        with profiler.timing('HubData'):  # recorded even if init fails
+            time.sleep(0.01)
+            raise ValueError('bad yaml')
+    with profiler.timing('ChatBot'):
+        pass
+    lines = profiler.report(n_imports=1)
+    assert lines[0] == 'Startup profile: slowest imports (seconds, inclusive)'
+    assert lines[1].split()[1] == 'slow_module'
+    assert lines[2] == 'Startup profile: subsystem init (seconds)'
+    assert [line.split()[1] for line in lines[3:]] == ['HubData', 'ChatBot']
+    assert float(lines[3].split()[0]) >= 0.01